@@ -1,8 +1,19 @@
+"""Downloads the datasets, labels their anomalies and splits them into train and test sets
+
+    python 0_download_dataset.py [--workers 8] [--skip_download] [--columnar]
+
+Every raw file is parsed in bulk, labeled with array masks built from the `anomaly_intervals` table, and saved as
+dataset/<data>/labeled/{whole,train,test}/<name>.pkl, the train and test sets being the `splits` of the file.
+The files are processed in parallel across a process pool.
+"""
+
+import argparse
 import requests
-import os
-from pathlib import Path
 import pickle
+import numpy as np
+from pathlib import Path
 from shutil import unpack_archive
+from concurrent.futures import ProcessPoolExecutor
 
 urls = dict()
 urls['ecg']=['http://www.cs.ucr.edu/~eamonn/discords/ECG_data.zip',
@@ -16,7 +27,56 @@ urls['respiration']=['http://www.cs.ucr.edu/~eamonn/discords/nprs44.txt',
                      'http://www.cs.ucr.edu/~eamonn/discords/nprs43.txt']
 urls['power_demand']=['http://www.cs.ucr.edu/~eamonn/discords/power_data.txt']
 
-for dataname in urls:
+# Anomalous points of every raw file: the line numbers i with start < i < end for any (start, end).
+anomaly_intervals = {
+    'chfdbchf15.txt': [(2250, 2400)],
+    'xmitdb_x108_0.txt': [(4020, 4400)],
+    'mitdb__100_180.txt': [(1800, 1990)],
+    'chfdb_chf01_275.txt': [(2330, 2600)],
+    'ltstdb_20221_43.txt': [(650, 780)],
+    'ltstdb_20321_240.txt': [(710, 850)],
+    'chfdb_chf13_45590.txt': [(2800, 2960)],
+    'stdb_308_0.txt': [(2290, 2550)],
+    'qtdbsel102.txt': [(4230, 4430)],
+    'ann_gun_CentroidA.txt': [(2070, 2810)],
+    'TEK16.txt': [(4270, 4370)],
+    'TEK17.txt': [(2100, 2145)],
+    'TEK14.txt': [(1100, 1200), (1455, 1955)],
+    'nprs44.txt': [(16192, 16638), (20457, 20911)],
+    'nprs43.txt': [(12929, 13432), (14877, 15086), (15729, 15924)],
+    'power_data.txt': [(8254, 8998), (11348, 12143), (33883, 34601)],
+    'nyc_taxi.csv': [(150, 250), (5970, 6050), (8500, 8650), (8750, 8890), (10000, 10200), (14700, 14800)],
+}
+
+# (train, test) slices of every labeled file.
+splits = {
+    'chfdb_chf13_45590.txt': (slice(None, 2439), slice(2439, 3726)),
+    'chfdb_chf01_275.txt': (slice(None, 1833), slice(1833, 3674)),
+    'chfdbchf15.txt': (slice(3381, 14244), slice(33, 3381)),
+    'qtdbsel102.txt': (slice(10093, 44828), slice(211, 10093)),
+    'mitdb__100_180.txt': (slice(2328, 5271), slice(73, 2328)),
+    'stdb_308_0.txt': (slice(2986, 5359), slice(265, 2986)),
+    'ltstdb_20321_240.txt': (slice(1520, 3531), slice(73, 1520)),
+    'xmitdb_x108_0.txt': (slice(424, 3576), slice(3576, 5332)),
+    'ltstdb_20221_43.txt': (slice(1121, 3731), slice(0, 1121)),
+    'ann_gun_CentroidA.txt': (slice(3000, None), slice(None, 3000)),
+    'nprs44.txt': (slice(363, 12955), slice(12955, 24082)),
+    'nprs43.txt': (slice(4285, 10498), slice(10498, 17909)),
+    'power_data.txt': (slice(15287, 33432), slice(501, 15287)),
+    'TEK17.txt': (slice(2469, 4588), slice(1543, 2469)),
+    'TEK16.txt': (slice(521, 3588), slice(3588, 4539)),
+    'TEK14.txt': (slice(2089, 4098), slice(97, 2089)),
+    'nyc_taxi.csv': (slice(None, 13104), slice(13104, None)),
+}
+
+# Files whose missing values (zeros) are filled in with the mean of their neighbours.
+gap_filled = ['ann_gun_CentroidA.txt']
+
+# Files whose label column is pickled as int (0/1) rather than float, as the original nyc_taxi labeling did.
+integer_labels = ['nyc_taxi.csv']
+
+
+def download(dataname):
     raw_dir = Path('dataset', dataname, 'raw')
     raw_dir.mkdir(parents=True, exist_ok=True)
     for url in urls[dataname]:
@@ -32,168 +92,90 @@ for dataname in urls:
             unpack_archive(str(filename), extract_dir=str(raw_dir))
 
 
-
-    for filepath in raw_dir.glob('*.txt'):
+def read_raw(filepath):
+    """Parses a raw file into an array [ seq_len * feature_size ]."""
+    if filepath.suffix == '.csv':
+        # The first column is a timestamp.
         with open(str(filepath)) as f:
-            # Label anomaly points as 1 in the dataset
-            labeled_data=[]
-            for i, line in enumerate(f):
-                tokens = [float(token) for token in line.split()]
-                if raw_dir.parent.name== 'ecg':
-                    # Remove time-step channel
-                    tokens.pop(0)
-                if filepath.name == 'chfdbchf15.txt':
-                    tokens.append(1.0) if 2250 < i < 2400 else tokens.append(0.0)
-                elif filepath.name == 'xmitdb_x108_0.txt':
-                    tokens.append(1.0) if 4020 < i < 4400 else tokens.append(0.0)
-                elif filepath.name == 'mitdb__100_180.txt':
-                    tokens.append(1.0) if 1800 < i < 1990 else tokens.append(0.0)
-                elif filepath.name == 'chfdb_chf01_275.txt':
-                    tokens.append(1.0) if 2330 < i < 2600 else tokens.append(0.0)
-                elif filepath.name == 'ltstdb_20221_43.txt':
-                    tokens.append(1.0) if 650 < i < 780 else tokens.append(0.0)
-                elif filepath.name == 'ltstdb_20321_240.txt':
-                    tokens.append(1.0) if 710 < i < 850 else tokens.append(0.0)
-                elif filepath.name == 'chfdb_chf13_45590.txt':
-                    tokens.append(1.0) if 2800 < i < 2960 else tokens.append(0.0)
-                elif filepath.name == 'stdb_308_0.txt':
-                    tokens.append(1.0) if 2290 < i < 2550 else tokens.append(0.0)
-                elif filepath.name == 'qtdbsel102.txt':
-                    tokens.append(1.0) if 4230 < i < 4430 else tokens.append(0.0)
-                elif filepath.name == 'ann_gun_CentroidA.txt':
-                    tokens.append(1.0) if 2070 < i < 2810 else tokens.append(0.0)
-                elif filepath.name == 'TEK16.txt':
-                    tokens.append(1.0) if 4270 < i < 4370 else tokens.append(0.0)
-                elif filepath.name == 'TEK17.txt':
-                    tokens.append(1.0) if 2100 < i < 2145 else tokens.append(0.0)
-                elif filepath.name == 'TEK14.txt':
-                    tokens.append(1.0) if 1100 < i < 1200 or 1455 < i < 1955 else tokens.append(0.0)
-                elif filepath.name == 'nprs44.txt':
-                    tokens.append(1.0) if 16192 < i < 16638 or 20457 < i < 20911 else tokens.append(0.0)
-                elif filepath.name == 'nprs43.txt':
-                    tokens.append(1.0) if 12929 < i < 13432 or 14877 < i < 15086 or 15729 < i < 15924 else tokens.append(0.0)
-                elif filepath.name == 'power_data.txt':
-                    tokens.append(1.0) if 8254 < i < 8998 or 11348 < i < 12143 or 33883 < i < 34601 else tokens.append(0.0)
-                labeled_data.append(tokens)
-
-            # Fill in the point where there is no signal value.
-            if filepath.name == 'ann_gun_CentroidA.txt':
-                for i, datapoint in enumerate(labeled_data):
-                    for j,channel in enumerate(datapoint[:-1]):
-                        if channel == 0.0:
-                            labeled_data[i][j] = 0.5 * labeled_data[i - 1][j] + 0.5 * labeled_data[i + 1][j]
-
-            # Save the labeled dataset as .pkl extension
-            labeled_whole_dir = raw_dir.parent.joinpath('labeled', 'whole')
-            labeled_whole_dir.mkdir(parents=True, exist_ok=True)
-            with open(str(labeled_whole_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                pickle.dump(labeled_data, pkl)
-
-            # Divide the labeled dataset into trainset and testset, then save them
-            labeled_train_dir = raw_dir.parent.joinpath('labeled','train')
-            labeled_train_dir.mkdir(parents=True,exist_ok=True)
-            labeled_test_dir = raw_dir.parent.joinpath('labeled','test')
-            labeled_test_dir.mkdir(parents=True,exist_ok=True)
-            if filepath.name == 'chfdb_chf13_45590.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[:2439], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[2439:3726], pkl)
-            elif filepath.name == 'chfdb_chf01_275.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[:1833], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[1833:3674], pkl)
-            elif filepath.name == 'chfdbchf15.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[3381:14244], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[33:3381], pkl)
-            elif filepath.name == 'qtdbsel102.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[10093:44828], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[211:10093], pkl)
-            elif filepath.name == 'mitdb__100_180.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[2328:5271], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[73:2328], pkl)
-            elif filepath.name == 'stdb_308_0.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[2986:5359], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[265:2986], pkl)
-            elif filepath.name == 'ltstdb_20321_240.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[1520:3531], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[73:1520], pkl)
-            elif filepath.name == 'xmitdb_x108_0.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[424:3576], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[3576:5332], pkl)
-            elif filepath.name == 'ltstdb_20221_43.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[1121:3731], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[0:1121], pkl)
-            elif filepath.name == 'ann_gun_CentroidA.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[3000:], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[:3000], pkl)
-            elif filepath.name == 'nprs44.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[363:12955], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[12955:24082], pkl)
-            elif filepath.name == 'nprs43.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[4285:10498], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[10498:17909], pkl)
-            elif filepath.name == 'power_data.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[15287:33432], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[501:15287], pkl)
-            elif filepath.name == 'TEK17.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[2469:4588], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[1543:2469], pkl)
-            elif filepath.name == 'TEK16.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[521:3588], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[3588:4539], pkl)
-            elif filepath.name == 'TEK14.txt':
-                with open(str(labeled_train_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[2089:4098], pkl)
-                with open(str(labeled_test_dir.joinpath(filepath.name).with_suffix('.pkl')), 'wb') as pkl:
-                    pickle.dump(labeled_data[97:2089], pkl)
-
-nyc_taxi_raw_path = Path('dataset/nyc_taxi/raw/nyc_taxi.csv')
-labeled_data = []
-with open(str(nyc_taxi_raw_path),'r') as f:
-    for i, line in enumerate(f):
-        tokens = [float(token) for token in line.strip().split(',')[1:]]
-        tokens.append(1) if 150 < i < 250 or   \
-                            5970 < i < 6050 or \
-                            8500 < i < 8650 or \
-                            8750 < i < 8890 or \
-                            10000 < i < 10200 or \
-                            14700 < i < 14800 \
-                          else tokens.append(0)
-        labeled_data.append(tokens)
-nyc_taxi_train_path = nyc_taxi_raw_path.parent.parent.joinpath('labeled','train',nyc_taxi_raw_path.name).with_suffix('.pkl')
-nyc_taxi_train_path.parent.mkdir(parents=True, exist_ok=True)
-with open(str(nyc_taxi_train_path),'wb') as pkl:
-    pickle.dump(labeled_data[:13104], pkl)
-
-nyc_taxi_test_path = nyc_taxi_raw_path.parent.parent.joinpath('labeled','test',nyc_taxi_raw_path.name).with_suffix('.pkl')
-nyc_taxi_test_path.parent.mkdir(parents=True, exist_ok=True)
-with open(str(nyc_taxi_test_path),'wb') as pkl:
-    pickle.dump(labeled_data[13104:], pkl)
\ No newline at end of file
+            ncolumns = len(f.readline().split(','))
+        data = np.loadtxt(str(filepath), delimiter=',', usecols=range(1, ncolumns), ndmin=2)
+    else:
+        data = np.loadtxt(str(filepath), ndmin=2)
+        if filepath.parent.parent.name == 'ecg':
+            # Remove time-step channel
+            data = data[:, 1:]
+    return data
+
+
+def label(filepath, data):
+    """Appends the anomaly label column to the data."""
+    index = np.arange(len(data))
+    anomaly = np.zeros(len(data), dtype=bool)
+    for start, end in anomaly_intervals.get(filepath.name, []):
+        anomaly |= (start < index) & (index < end)
+    return np.concatenate([data, anomaly[:, np.newaxis].astype(data.dtype)], axis=1)
+
+
+def fill_gaps(labeled_data):
+    """Fills in the points where there is no signal value, in the same order as a row-by-row pass would."""
+    for i, j in zip(*np.nonzero(labeled_data[:, :-1] == 0.0)):
+        labeled_data[i, j] = 0.5 * labeled_data[i - 1, j] + 0.5 * labeled_data[i + 1, j]
+    return labeled_data
+
+
+def save(path, labeled_data, columnar=False, integer_label=False):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    rows = labeled_data.tolist()
+    if integer_label:
+        rows = [row[:-1] + [int(row[-1])] for row in rows]
+    with open(str(path), 'wb') as pkl:
+        pickle.dump(rows, pkl)
+    if columnar:
+        import preprocess_data
+        preprocess_data.save_columnar(path.with_suffix(preprocess_data.COLUMNAR_SUFFIX),
+                                      labeled_data[:, :-1], labeled_data[:, -1])
+
+
+def process(filepath, columnar=False):
+    """Labels a raw file and saves it as the whole, train and test sets."""
+    # Label anomaly points as 1 in the dataset
+    labeled_data = label(filepath, read_raw(filepath))
+    if filepath.name in gap_filled:
+        labeled_data = fill_gaps(labeled_data)
+
+    labeled_dir = filepath.parent.parent.joinpath('labeled')
+    integer_label = filepath.name in integer_labels
+    save(labeled_dir.joinpath('whole', filepath.name).with_suffix('.pkl'), labeled_data, columnar, integer_label)
+    # Divide the labeled dataset into trainset and testset, then save them
+    if filepath.name in splits:
+        train_slice, test_slice = splits[filepath.name]
+        save(labeled_dir.joinpath('train', filepath.name).with_suffix('.pkl'), labeled_data[train_slice], columnar,
+             integer_label)
+        save(labeled_dir.joinpath('test', filepath.name).with_suffix('.pkl'), labeled_data[test_slice], columnar,
+             integer_label)
+    return filepath
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download, label and split the datasets')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of processes labeling files in parallel (default: number of CPUs)')
+    parser.add_argument('--skip_download', action='store_true',
+                        help='only process the raw files that are already downloaded')
+    parser.add_argument('--columnar', action='store_true',
+                        help='also save every labeled file in the binary columnar format')
+    args = parser.parse_args()
+
+    if not args.skip_download:
+        for dataname in urls:
+            download(dataname)
+
+    filepaths = [filepath for dataname in urls for filepath in Path('dataset', dataname, 'raw').glob('*.txt')]
+    filepaths.append(Path('dataset/nyc_taxi/raw/nyc_taxi.csv'))
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for filepath in executor.map(process, filepaths, [args.columnar] * len(filepaths)):
+            print('Labeled', filepath)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,137 +1,416 @@
 from torch.autograd import Variable
 import torch
 import numpy as np
+from model.model import autocast
 
-def fit_norm_distribution_param(args, model, train_dataset, channel_idx=0):
-    predictions = []
-    organized = []
-    errors = []
-    with torch.no_grad():
-        # Turn on evaluation mode which disables dropout.
-        model.eval()
-        pasthidden = model.init_hidden(1)
-        for t in range(len(train_dataset)):
-            out, hidden = model.forward(train_dataset[t].unsqueeze(0), pasthidden)
-            predictions.append([])
-            organized.append([])
-            errors.append([])
-            predictions[t].append(out.data.cpu()[0][0][channel_idx])
-            pasthidden = model.repackage_hidden(hidden)
-            for prediction_step in range(1,args.prediction_window_size):
-                out, hidden = model.forward(out, hidden)
-                predictions[t].append(out.data.cpu()[0][0][channel_idx])
-
-            if t >= args.prediction_window_size:
-                for step in range(args.prediction_window_size):
-                    organized[t].append(predictions[step+t-args.prediction_window_size][args.prediction_window_size-1-step])
-                organized[t]= torch.FloatTensor(organized[t]).to(args.device)
-                errors[t] = organized[t] - train_dataset[t][0][channel_idx]
-                errors[t] = errors[t].unsqueeze(0)
-
-    errors_tensor = torch.cat(errors[args.prediction_window_size:],dim=0)
-    mean = errors_tensor.mean(dim=0)
-    cov = errors_tensor.t().mm(errors_tensor)/errors_tensor.size(0) - mean.unsqueeze(1).mm(mean.unsqueeze(0))
-    # cov: positive-semidefinite and symmetric.
-
-    return mean, cov
-
-
-def anomalyScore(args, model, dataset, mean, cov, channel_idx=0, score_predictor=None):
-    predictions = []
-    rearranged = []
-    errors = []
+def multistep_prediction(args, model, dataset):
+    """Predicts the next `prediction_window_size` steps from every point of the dataset.
+
+    The teacher-forced pass is run once over the series, and the recursive rollouts from all the
+    starting points are run together, with the starting points stacked in the batch dimension.
+    At most `args.rollout_batch_size` starting points are rolled out at once.
+
+    :param dataset: [ seq_len * batch_size * feature_size ]
+    :return: predictions: [ seq_len * batch_size * prediction_window_size * feature_size ]
+             hiddens: hidden states of the last layer [ seq_len * batch_size * rnn_hid_size ] (on cpu)
+    """
+    seq_len, bsz, feature_dim = dataset.size()
+    predictions = dataset.new_zeros(seq_len, bsz, args.prediction_window_size, feature_dim)
     hiddens = []
-    predicted_scores = []
-    with torch.no_grad():
+    for start, end, predictions_, hiddens_ in multistep_prediction_chunks(args, model, dataset):
+        predictions[start:end] = predictions_
+        hiddens.append(hiddens_)
+
+    return predictions, torch.cat(hiddens, dim=0)
+
+
+def multistep_prediction_chunks(args, model, dataset):
+    """Same as `multistep_prediction`, one chunk of `args.rollout_batch_size` starting points at a time.
+    The model runs in `args.inference_precision` (fp32 by default), the predictions are returned in float32.
+
+    :return: generator of (start, end, predictions[start:end], hiddens[start:end])
+    """
+    seq_len, bsz, feature_dim = dataset.size()
+    window = args.prediction_window_size
+    chunk_len = max(1, getattr(args, 'rollout_batch_size', 1024) // bsz)
+    with torch.no_grad(), autocast(dataset.device, getattr(args, 'inference_precision', 'fp32')):
         # Turn on evaluation mode which disables dropout.
         model.eval()
-        pasthidden = model.init_hidden(1)
-        for t in range(len(dataset)):
-            out, hidden = model.forward(dataset[t].unsqueeze(0), pasthidden)
-            predictions.append([])
-            rearranged.append([])
-            errors.append([])
-            hiddens.append(model.extract_hidden(hidden))
-            if score_predictor is not None:
-                predicted_scores.append(score_predictor.predict(model.extract_hidden(hidden).numpy()))
-
-            predictions[t].append(out.data.cpu()[0][0][channel_idx])
-            pasthidden = model.repackage_hidden(hidden)
-            for prediction_step in range(1, args.prediction_window_size):
-                out, hidden = model.forward(out, hidden)
-                predictions[t].append(out.data.cpu()[0][0][channel_idx])
-
-            if t >= args.prediction_window_size:
-                for step in range(args.prediction_window_size):
-                    rearranged[t].append(
-                        predictions[step + t - args.prediction_window_size][args.prediction_window_size - 1 - step])
-                rearranged[t] =torch.FloatTensor(rearranged[t]).to(args.device).unsqueeze(0)
-                errors[t] = rearranged[t] - dataset[t][0][channel_idx]
-            else:
-                rearranged[t] = torch.zeros(1,args.prediction_window_size).to(args.device)
-                errors[t] = torch.zeros(1, args.prediction_window_size).to(args.device)
+        pasthidden = model.init_hidden(bsz)
+        for start in range(0, seq_len, chunk_len):
+            end = min(start + chunk_len, seq_len)
+            predictions = dataset.new_zeros(end - start, bsz, window, feature_dim)
+            outs, starthiddens = [], []
+            for t in range(start, end):
+                out, pasthidden = model.forward(dataset[t].unsqueeze(0), pasthidden)
+                outs.append(out)
+                starthiddens.append(pasthidden)
+            # Every starting point of the chunk becomes a column of the rollout batch.
+            out = torch.cat(outs, dim=1) # [ 1 * (chunk_len x batch_size) * feature_size ]
+            hidden = model.concat_hidden(starthiddens)
+            hiddens = model.extract_hidden(hidden).view(end - start, bsz, -1)
+            predictions[:, :, 0] = out.view(end - start, bsz, feature_dim)
+            outs, _ = model.rollout(out, hidden, window - 1, mode=getattr(args, 'rollout', 'fused'))
+            predictions[:, :, 1:] = outs.view(window - 1, end - start, bsz, feature_dim).permute(1, 2, 0, 3)
+            yield start, end, predictions, hiddens
+
+
+def prediction_trace_chunks(args, model, dataset):
+    """The prediction errors and the hidden states of the dataset, one chunk of timesteps at a time, without keeping
+    the whole rollout.
+
+    :param dataset: [ seq_len * 1 * feature_size ]
+    :return: generator of (start, end, errors [ channels * (end - start) * prediction_window_size ],
+             hiddens [ (end - start) * rnn_hid_size ]), the errors being zero for the first prediction_window_size
+             timesteps, as in `rearrange_predictions`
+    """
+    window = args.prediction_window_size
+    # The predictions of the last W timesteps, which the errors of the next chunk are made of
+    past_predictions = dataset.new_zeros(0, 1, window, dataset.size(-1))
+    for start, end, predictions, hiddens in multistep_prediction_chunks(args, model, dataset):
+        offset = start - len(past_predictions)
+        predictions = torch.cat([past_predictions, predictions], dim=0)
+        _, errors = rearrange_predictions(args, predictions, dataset[offset:end])
+        past_predictions = predictions[-window:]
+        yield start, end, errors[start - offset:, 0].permute(2, 0, 1), hiddens[:, 0]
+
+
+def prediction_error_chunks(args, model, dataset):
+    """The prediction errors of the dataset, one chunk of timesteps at a time, without keeping the whole rollout.
+
+    :param dataset: [ seq_len * 1 * feature_size ]
+    :return: generator of errors [ channels * chunk_len * prediction_window_size ] of consecutive timesteps, from
+             t = prediction_window_size on
+    """
+    window = args.prediction_window_size
+    for start, end, errors, _ in prediction_trace_chunks(args, model, dataset):
+        skip = max(0, window - start)
+        if end - start > skip:
+            yield errors[:, skip:]
+
+
+class GaussianEstimator(object):
+    """Streaming estimate of the multivariate gaussian of the prediction errors of every channel.
+
+    The mean and the sum of squared deviations are updated batch by batch with Welford/Chan updates (in float64),
+    so the errors never need to be kept in memory. Estimators fitted on different chunks of data can be merged, and
+    a fitted estimator can be updated with new normal data.
+    """
+
+    def __init__(self, nchannels, window, device='cpu'):
+        self.count = 0
+        self.mean = torch.zeros(nchannels, window, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(nchannels, window, window, dtype=torch.float64, device=device)
+
+    def update(self, errors):
+        """:param errors: [ channels * n * prediction_window_size ]"""
+        errors = errors.to(self.mean)
+        count = errors.size(1)
+        if count == 0:
+            return self
+        mean = errors.mean(dim=1)
+        deviations = errors - mean.unsqueeze(1)
+        self.combine(count, mean, deviations.transpose(1, 2).bmm(deviations))
+        return self
+
+    def merge(self, other):
+        """Adds the data of another estimator to this one."""
+        self.combine(other.count, other.mean.to(self.mean), other.m2.to(self.m2))
+        return self
+
+    def combine(self, count, mean, m2):
+        total = self.count + count
+        if total == 0:
+            return
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (count / total)
+        self.m2 = self.m2 + m2 + delta.unsqueeze(2).bmm(delta.unsqueeze(1)) * (self.count * count / total)
+        self.count = total
+
+    @property
+    def means(self):
+        """[ channels * prediction_window_size ] (float64)"""
+        return self.mean.clone()
+
+    @property
+    def covs(self):
+        """Covariance matrices [ channels * prediction_window_size * prediction_window_size ] (float64)"""
+        return self.m2 / max(self.count, 1)
+
+    def state_dict(self):
+        return {'count': self.count, 'mean': self.mean.cpu(), 'm2': self.m2.cpu()}
+
+    @classmethod
+    def from_state_dict(cls, state_dict, device='cpu'):
+        nchannels, window = state_dict['mean'].size()
+        estimator = cls(nchannels, window, device=device)
+        estimator.count = state_dict['count']
+        estimator.mean = state_dict['mean'].to(estimator.mean)
+        estimator.m2 = state_dict['m2'].to(estimator.m2)
+        return estimator
+
+
+def predict_columns(args, model, dataset, threads):
+    """multistep_prediction of some batch columns, in a worker process of `windowed_multistep_prediction`."""
+    torch.set_num_threads(threads)
+    predictions, hiddens = multistep_prediction(args, model, dataset)
+    return predictions.cpu(), hiddens
+
+
+def windowed_multistep_prediction(args, model, dataset, chunk_len, burn_in, workers=0):
+    """Approximation of `multistep_prediction` for very long series, whose chunks are predicted independently.
+
+    The series is split into chunks of chunk_len timesteps. Every chunk is predicted from a zero hidden state that
+    is warmed up on the burn_in timesteps before it, so the chunks are independent: they are stacked in the batch
+    dimension and predicted together, or split between `workers` processes (on the cpu). The predictions are then
+    stitched back together. They differ from the sequential ones by the effect of the hidden state before the
+    burn-in, which fades with burn_in (see benchmarks/burnin.py).
+
+    :param dataset: [ seq_len * 1 * feature_size ]
+    :param burn_in: number of warm-up timesteps, at least prediction_window_size
+    :param workers: number of processes (0: all the chunks in one batch, in this process)
+    :return: same as `multistep_prediction`
+    """
+    if burn_in < args.prediction_window_size:
+        raise ValueError('The burn-in ({}) must be at least the prediction window size ({})'.format(
+            burn_in, args.prediction_window_size))
+    seq_len, _, feature_dim = dataset.size()
+    starts = list(range(0, seq_len, chunk_len))
+    begins = [max(0, start - burn_in) for start in starts]
+    ends = [min(start + chunk_len, seq_len) for start in starts]
+    # The chunks are padded at the end, which does not change the predictions before the padding
+    batch = dataset.new_zeros(max(end - begin for begin, end in zip(begins, ends)), len(starts), feature_dim)
+    for column, (begin, end) in enumerate(zip(begins, ends)):
+        batch[:end - begin, column] = dataset[begin:end, 0]
+
+    if workers > 0:
+        import torch.multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor
+
+        columns = torch.arange(len(starts)).tensor_split(min(workers, len(starts)))
+        threads = max(1, torch.get_num_threads() // len(columns))
+        with ProcessPoolExecutor(len(columns), mp_context=mp.get_context('spawn')) as pool:
+            results = list(pool.map(predict_columns, *zip(*[(args, model, batch[:, column].cpu(), threads)
+                                                            for column in columns])))
+        predictions = torch.cat([predictions for predictions, _ in results], dim=1).to(dataset.device)
+        hiddens = torch.cat([hiddens for _, hiddens in results], dim=1)
+    else:
+        predictions, hiddens = multistep_prediction(args, model, batch)
+
+    stitched_predictions = dataset.new_zeros(seq_len, 1, args.prediction_window_size, feature_dim)
+    stitched_hiddens = hiddens.new_zeros(seq_len, 1, hiddens.size(-1))
+    for column, (start, begin, end) in enumerate(zip(starts, begins, ends)):
+        stitched_predictions[start:end, 0] = predictions[start - begin:end - begin, column]
+        stitched_hiddens[start:end, 0] = hiddens[start - begin:end - begin, column]
+
+    return stitched_predictions, stitched_hiddens
+
+
+def scoring_prediction(args, model, dataset):
+    """The predictions used to score a dataset: `windowed_multistep_prediction` if args.score_chunk_len is set (with
+    args.burn_in and args.score_workers), `multistep_prediction` otherwise."""
+    if getattr(args, 'score_chunk_len', 0):
+        return windowed_multistep_prediction(args, model, dataset, args.score_chunk_len, args.burn_in,
+                                             getattr(args, 'score_workers', 0))
+    return multistep_prediction(args, model, dataset)
 
+
+def rearrange_predictions(args, predictions, dataset):
+    """Gathers, for every timestep t, the predictions of x_t made at t-W, ..., t-1.
+
+    :param predictions: output of `multistep_prediction` [ seq_len * batch_size * W * feature_size ]
+    :param dataset: [ seq_len * batch_size * feature_size ]
+    :return: rearranged predictions and their errors [ seq_len * batch_size * W * feature_size ],
+             both zero for the first W timesteps.
+    """
+    seq_len, bsz, window, feature_dim = predictions.size()
+    rearranged = predictions.new_zeros(seq_len, bsz, window, feature_dim)
+    errors = predictions.new_zeros(seq_len, bsz, window, feature_dim)
+    if seq_len > window:
+        t = torch.arange(window, seq_len, device=predictions.device).unsqueeze(1)
+        step = torch.arange(window, device=predictions.device).unsqueeze(0)
+        # rearranged[t][step] = predictions[t-W+step][W-1-step]
+        rearranged[window:] = predictions.transpose(1, 2)[t - window + step, window - 1 - step].transpose(1, 2)
+        errors[window:] = rearranged[window:] - dataset[window:].unsqueeze(2)
+
+    return rearranged, errors
+
+
+def fit_norm_distribution_param(args, model, train_dataset, channel_idx=0):
+    means, covs = fit_norm_distribution_param_multichannel(args, model, train_dataset)
+
+    return means[channel_idx], covs[channel_idx]
+
+
+def fit_norm_distribution_param_multichannel(args, model, train_dataset):
+    """Fits the multivariate gaussian of the prediction errors of every channel from one rollout.
+
+    :return: means: [ channels * prediction_window_size ]
+             covs: [ channels * prediction_window_size * prediction_window_size ]
+    """
+    estimator = fit_gaussian_estimator(args, model, train_dataset)
+
+    return estimator.means, estimator.covs
+
+
+def fit_gaussian_estimator(args, model, dataset, estimator=None, trace=None):
+    """Updates (or fits) a GaussianEstimator with the prediction errors of the dataset, chunk by chunk.
+
+    :param dataset: [ seq_len * 1 * feature_size ]
+    :param trace: optional model.trace.TraceWriter, to which the errors and hidden states are also written
+    """
+    if estimator is None:
+        estimator = GaussianEstimator(dataset.size(-1), args.prediction_window_size, device=dataset.device)
+    window = args.prediction_window_size
+    for start, end, errors, hiddens in prediction_trace_chunks(args, model, dataset):
+        if trace is not None:
+            trace.write(start, end, errors, hiddens)
+        skip = max(0, window - start)
+        if end - start > skip:
+            estimator.update(errors[:, skip:])
+
+    return estimator
+
+
+def anomalyScore(args, model, dataset, mean, cov, channel_idx=0, score_predictor=None, chol=None):
+    predictions, hiddens = scoring_prediction(args, model, dataset)
+    rearranged, errors = rearrange_predictions(args, predictions, dataset)
+    rearranged = rearranged[:, 0, :, channel_idx] # [ seq_len * prediction_window_size ]
+    errors = errors[:, 0, :, channel_idx] # [ seq_len * prediction_window_size ]
+    hiddens = hiddens[:, 0] # [ seq_len * rnn_hid_size ]
+
+    predicted_scores = []
+    if score_predictor is not None:
+        predicted_scores = score_predictor.predict(hiddens.numpy()).reshape(-1, 1)
     predicted_scores = np.array(predicted_scores)
-    scores = []
-    for error in errors:
-        mult1 = error-mean.unsqueeze(0) # [ 1 * prediction_window_size ]
-        mult2 = torch.inverse(cov) # [ prediction_window_size * prediction_window_size ]
-        mult3 = mult1.t() # [ prediction_window_size * 1 ]
-        score = torch.mm(mult1,torch.mm(mult2,mult3))
-        scores.append(score[0][0])
-
-    scores = torch.stack(scores)
-    rearranged = torch.cat(rearranged,dim=0)
-    errors = torch.cat(errors,dim=0)
+
+    if chol is None:
+        chol = cholesky_factor(cov)
+    scores = gaussian_score(errors, mean, chol)
 
     return scores, rearranged, errors, hiddens, predicted_scores
 
 
+def anomalyScore_multichannel(args, model, dataset, means, covs, score_predictors=None, chols=None,
+                              score_baseline=None):
+    """Scores every channel of the dataset from one rollout.
+
+    :param means: [ channels * prediction_window_size ]
+    :param covs: [ channels * prediction_window_size * prediction_window_size ]
+    :param score_predictors: optional list with one anomaly score predictor per channel
+    :param score_baseline: optional fitted scoreBaseline.ScoreBaseline, predicting the scores of all the channels
+    :param chols: Cholesky factors of covs, computed if not given
+    :return: scores: [ channels * seq_len ]
+             rearranged, errors: [ channels * seq_len * prediction_window_size ]
+             hiddens: [ seq_len * rnn_hid_size ]
+             predicted_scores: [ channels * seq_len * 1 ] (empty if no score predictor or baseline is given)
+    """
+    predictions, hiddens = scoring_prediction(args, model, dataset)
+    rearranged, errors = rearrange_predictions(args, predictions, dataset)
+    rearranged = rearranged[:, 0].permute(2, 0, 1) # [ channels * seq_len * prediction_window_size ]
+    errors = errors[:, 0].permute(2, 0, 1) # [ channels * seq_len * prediction_window_size ]
+    hiddens = hiddens[:, 0] # [ seq_len * rnn_hid_size ]
+
+    predicted_scores = []
+    if score_predictors is not None:
+        predicted_scores = [score_predictor.predict(hiddens.numpy()).reshape(-1, 1)
+                            for score_predictor in score_predictors]
+    if score_baseline is not None:
+        predicted_scores = score_baseline.predict(hiddens).cpu().numpy()[..., np.newaxis]
+    predicted_scores = np.array(predicted_scores)
+
+    if chols is None:
+        chols = cholesky_factor(covs)
+    scores = gaussian_score(errors, means, chols)
+
+    return scores, rearranged, errors, hiddens, predicted_scores
+
+
+def cholesky_factor(cov, eps=1e-6, max_tries=8):
+    """Lower Cholesky factor of one or a batch of covariance matrices.
+
+    A near-singular covariance gets an increasing multiple of its mean variance added to the diagonal
+    until the factorization succeeds. The factor is computed and returned in float64.
+    """
+    cov = cov.to(torch.float64)
+    chol, info = torch.linalg.cholesky_ex(cov)
+    eye = torch.eye(cov.size(-1), dtype=cov.dtype, device=cov.device)
+    scale = cov.diagonal(dim1=-2, dim2=-1).mean(dim=-1).clamp(min=eps)[..., None, None]
+    jitter = eps
+    for _ in range(max_tries):
+        failed = info > 0
+        if not failed.any():
+            break
+        chol_, info_ = torch.linalg.cholesky_ex(cov + jitter * scale * eye)
+        chol = torch.where(failed[..., None, None], chol_, chol)
+        info = torch.where(failed, info_, info)
+        jitter *= 10
+    if (info > 0).any():
+        raise ValueError('The covariance matrix could not be made positive-definite')
+
+    return chol
+
+
+def gaussian_score(errors, mean, chol):
+    """Anomaly scores (squared Mahalanobis distances) of the prediction errors under N(mean, L L^T).
+    The scores are computed in float64, whatever the precision of the errors.
+
+    :param errors: [ (channels) * seq_len * prediction_window_size ]
+    :param mean: [ (channels) * prediction_window_size ]
+    :param chol: lower Cholesky factor of the covariance [ (channels) * prediction_window_size * prediction_window_size ]
+    :return: scores [ (channels) * seq_len ]
+    """
+    errors, mean, chol = errors.to(torch.float64), mean.to(torch.float64), chol.to(torch.float64)
+    diff = (errors - mean.unsqueeze(-2)).transpose(-1, -2) # [ (channels) * prediction_window_size * seq_len ]
+    z = torch.linalg.solve_triangular(chol, diff, upper=False)
+
+    return z.pow(2).sum(dim=-2)
+
+
 def get_precision_recall(args, score, label, num_samples, beta=1.0, sampling='log', predicted_score=None):
     '''
     :param args:
     :param score: anomaly scores
     :param label: anomaly labels
-    :param num_samples: the number of threshold samples
+    :param num_samples: the number of threshold samples, or None to use every distinct score as a threshold
     :param beta:
-    :param scale:
-    :return:
+    :param sampling: 'log' or 'linear' spacing of the sampled thresholds
+    :return: precision, recall, f_beta and the thresholds they were obtained with
     '''
     if predicted_score is not None:
         score = score - torch.FloatTensor(predicted_score).squeeze().to(args.device)
 
     maximum = score.max()
-    if sampling=='log':
+    if num_samples is None:
+        th = torch.unique(score)
+    elif sampling=='log':
         # Sample thresholds logarithmically
         # The sampled thresholds are logarithmically spaced between: math:`10 ^ {start}` and: math:`10 ^ {end}`.
-        th = torch.logspace(0, torch.log10(torch.tensor(maximum)), num_samples).to(args.device)
+        th = torch.logspace(0, torch.log10(maximum).item(), num_samples).to(args.device)
     else:
         # Sample thresholds equally
         # The sampled thresholds are equally spaced points between: attr:`start` and: attr:`end`
-        th = torch.linspace(0, maximum, num_samples).to(args.device)
-
-    precision = []
-    recall = []
-
-    for i in range(len(th)):
-        anomaly = (score > th[i]).float()
-        idx = anomaly * 2 + label
-        tn = (idx == 0.0).sum().item()  # tn
-        fn = (idx == 1.0).sum().item()  # fn
-        fp = (idx == 2.0).sum().item()  # fp
-        tp = (idx == 3.0).sum().item()  # tp
+        th = torch.linspace(0, maximum.item(), num_samples).to(args.device)
+    th = th.to(score.dtype)
 
-        p = tp / (tp + fp + 1e-7)
-        r = tp / (tp + fn + 1e-7)
+    # A threshold flags the points whose score is above it, i.e. a prefix of the points sorted by descending score,
+    # so the true positives of every threshold can be read from the cumulative sum of the sorted labels.
+    sorted_score, order = torch.sort(score)
+    positives = label[order].double().flip(0).cumsum(0)
+    npred = len(score) - torch.searchsorted(sorted_score, th, right=True)
+    tp = torch.where(npred > 0, positives[(npred - 1).clamp(min=0)], torch.zeros_like(positives[0]))
+    fp = npred.double() - tp
+    fn = positives[-1] - tp
 
-        if p != 0 and r != 0:
-            precision.append(p)
-            recall.append(r)
+    p = tp / (tp + fp + 1e-7)
+    r = tp / (tp + fn + 1e-7)
+    valid = (p != 0) & (r != 0)
 
-    precision = torch.FloatTensor(precision)
-    recall = torch.FloatTensor(recall)
+    precision = p[valid].float().cpu()
+    recall = r[valid].float().cpu()
+    th = th[valid].cpu()
 
 
     f1 = (1 + beta ** 2) * (precision * recall).div(beta ** 2 * precision + recall + 1e-7)
 
-    return precision, recall, f1
\ No newline at end of file
+    return precision, recall, f1, th
@@ -0,0 +1,83 @@
+"""Measures how much chunked scoring (predict.py --score_chunk_len) differs from the exact sequential scoring, as a
+function of the burn-in length
+
+    python -m benchmarks.burnin --data ecg --filename chfdb_chf13_45590.pkl --chunk_len 1000 --burn_ins 10 50 100 500
+
+The test dataset (optionally repeated up to --length timesteps, to emulate a long series) is scored sequentially
+and then in independent chunks for every burn-in. For each, the scoring time, the maximum and mean difference of the
+scores relative to the largest sequential score, and the best f-beta score of every channel are reported.
+"""
+
+import argparse
+import time
+import torch
+import preprocess_data
+from streamingDetector import MultiStreamDetector
+from anomalyDetector import anomalyScore_multichannel, get_precision_recall
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the burn-in of chunked scoring')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='cuda or cpu')
+    parser.add_argument('--prediction_window_size', type=int, default=10,
+                        help='prediction_window_size')
+    parser.add_argument('--chunk_len', type=int, default=1000,
+                        help='number of timesteps of every chunk')
+    parser.add_argument('--burn_ins', type=int, nargs='+', default=[10, 50, 100, 500, 1000],
+                        help='burn-in lengths to compare (at least prediction_window_size)')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of processes the chunks are split between (0: one batch in this process)')
+    parser.add_argument('--length', type=int, default=None,
+                        help='repeat the test dataset up to this many timesteps (default: the test dataset)')
+    parser.add_argument('--rollout_batch_size', type=int, default=1024,
+                        help='number of starting points rolled out together')
+    parser.add_argument('--beta', type=float, default=1.0,
+                        help='beta value for f-beta score')
+    args = parser.parse_args()
+
+    detector = MultiStreamDetector.from_checkpoint(args.data, args.filename, device=args.device, capacity=1)
+    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                    augment_test_data=False, augment_train_data=False)
+    series, label = TimeseriesData.testData, TimeseriesData.testLabel
+    if args.length is not None:
+        repeats = -(-args.length // len(series))
+        series, label = series.repeat(repeats, 1)[:args.length], label.repeat(repeats)[:args.length]
+    test_dataset = TimeseriesData.batchify(args, series, bsz=1)
+    label = label[:len(test_dataset)].to(args.device)
+
+    def score(chunk_len, burn_in):
+        args.score_chunk_len, args.burn_in, args.score_workers = chunk_len, burn_in, args.workers
+        start_time = time.perf_counter()
+        scores = anomalyScore_multichannel(args, detector.model, test_dataset, detector.means, None,
+                                           chols=detector.chols)[0]
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        f_betas = [get_precision_recall(args, channel_score, label, num_samples=1000, beta=args.beta)[2].max().item()
+                   for channel_score in scores]
+        return scores, time.perf_counter() - start_time, f_betas
+
+    reference, reference_time, reference_f_betas = score(0, 0)
+    results = {burn_in: score(args.chunk_len, burn_in) for burn_in in args.burn_ins}
+
+    scale = reference.abs().max()
+    print('-' * 89)
+    print('| points {:d} | channels {:d} | window {:d} | chunk {:d} | workers {:d} | sequential {:.2f} s |'.format(
+        len(test_dataset), len(reference), args.prediction_window_size, args.chunk_len, args.workers, reference_time))
+    print('| {:>8} | {:>8} | {:>8} | {:>13} | {:>14} | {:>24} |'.format(
+        'burn-in', 'time s', 'speedup', 'max rel diff', 'mean rel diff', 'f-beta per channel (diff)'))
+    for burn_in, (scores, score_time, f_betas) in results.items():
+        diff = (scores - reference).abs() / scale
+        print('| {:>8d} | {:>8.2f} | {:>8.2f} | {:>13.3e} | {:>14.3e} | {} |'.format(
+            burn_in, score_time, reference_time / score_time, diff.max().item(), diff.mean().item(),
+            ' '.join('{:.4f} ({:+.4f})'.format(f_beta, f_beta - reference) for f_beta, reference in
+                     zip(f_betas, reference_f_betas))))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
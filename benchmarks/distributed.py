@@ -0,0 +1,79 @@
+"""Measures the scaling efficiency of data-parallel training (train.py --distributed)
+
+    python -m benchmarks.distributed --data ecg --filename chfdb_chf13_45590.pkl --nprocs 1 2 4 8 --threads 1
+
+For every number of processes, train.main is run in that many processes (the way torchrun launches it) on the same
+global batch, and the time spent in the training epochs is compared with the one of a single process:
+speedup = T(1) / T(n), efficiency = speedup / n.
+The runs work in a temporary directory, so the checkpoints and figures of the dataset are left untouched.
+"""
+
+import argparse
+import os
+import socket
+import tempfile
+import torch
+import torch.multiprocessing as mp
+from pathlib import Path
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def worker(rank, world_size, port, workdir, threads, train_args, results):
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank), 'WORLD_SIZE': str(world_size),
+                       'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    os.chdir(workdir)
+    torch.set_num_threads(threads)
+    import train
+    summary = train.main(train_args + ['--distributed'])
+    if rank == 0:
+        results.put(summary)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scaling of data-parallel training')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--nprocs', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of processes to benchmark')
+    parser.add_argument('--threads', type=int, default=1,
+                        help='number of torch threads of every process')
+    parser.add_argument('--epochs', type=int, default=2,
+                        help='number of training epochs of every run')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='global batch size, split between the processes')
+    args, train_args = parser.parse_known_args()
+
+    workdir = tempfile.mkdtemp()
+    os.symlink(str(Path('dataset').resolve()), os.path.join(workdir, 'dataset'))
+    train_args = ['--data', args.data, '--filename', args.filename, '--device', 'cpu',
+                  '--epochs', str(args.epochs), '--save_interval', str(args.epochs + 1),
+                  '--batch_size', str(args.batch_size), '--eval_batch_size', str(args.batch_size)] + train_args
+
+    times = {}
+    ctx = mp.get_context('spawn')
+    for nprocs in args.nprocs:
+        results = ctx.SimpleQueue()
+        mp.start_processes(worker, args=(nprocs, free_port(), workdir, args.threads, train_args, results),
+                           nprocs=nprocs, start_method='spawn')
+        times[nprocs] = results.get()['train_time'] / args.epochs
+
+    reference = min(times)
+    print('-' * 89)
+    print('| batch size {:d} | threads/process {:d} | epochs {:d} |'.format(args.batch_size, args.threads, args.epochs))
+    print('| {:>9} | {:>12} | {:>8} | {:>10} |'.format('processes', 's/epoch', 'speedup', 'efficiency'))
+    for nprocs, epoch_time in times.items():
+        speedup = times[reference] * reference / epoch_time
+        print('| {:>9d} | {:>12.3f} | {:>8.2f} | {:>10.2f} |'.format(
+            nprocs, epoch_time, speedup, speedup / nprocs))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
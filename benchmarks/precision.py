@@ -0,0 +1,99 @@
+"""Compares the throughput and the detection results of the model in fp32, bf16 and fp16
+
+    python -m benchmarks.precision --data ecg --filename chfdb_chf13_45590.pkl --device cpu
+
+For every precision, the test dataset is scored (the gaussian scoring itself is always done in float64), and the
+best f-beta score of every channel is compared with the one in fp32. The time of a training step (free running and
+teacher forcing passes, and backward) on a batch of the train dataset is also reported for every precision.
+"""
+
+import argparse
+import time
+import torch
+import preprocess_data
+from streamingDetector import MultiStreamDetector
+from anomalyDetector import anomalyScore_multichannel, get_precision_recall
+from model.model import autocast
+
+
+def timeit(fn, repeat, device):
+    result = fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    return result, (time.perf_counter() - start_time) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the precision of the RNN predictor')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='cuda or cpu')
+    parser.add_argument('--precisions', type=str, nargs='+', default=['fp32', 'bf16', 'fp16'],
+                        help='precisions to compare (the first one is the reference)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch size of the training step')
+    parser.add_argument('--bptt', type=int, default=50,
+                        help='sequence length of the training step')
+    parser.add_argument('--beta', type=float, default=1.0,
+                        help='beta value for f-beta score')
+    args = parser.parse_args()
+
+    detector = MultiStreamDetector.from_checkpoint(args.data, args.filename, device=args.device, capacity=1)
+    model = detector.model
+    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                    augment_test_data=False, augment_train_data=False)
+    test_dataset = TimeseriesData.batchify(args, TimeseriesData.testData, bsz=1)
+    label = TimeseriesData.testLabel.to(args.device)
+    train_batch = TimeseriesData.batchify(args, TimeseriesData.trainData, args.batch_size)[:args.bptt + 1]
+    args.prediction_window_size = detector.window
+
+    def train_step(precision):
+        model.train()
+        model.zero_grad()
+        hidden = model.init_hidden(args.batch_size)
+        with autocast(args.device, precision):
+            outSeq1, _, hids1 = model.rollout(train_batch[:1], hidden, args.bptt, return_hiddens=True)
+            outSeq2, _, hids2 = model.forward(train_batch[:-1], hidden, return_hiddens=True)
+            loss = (outSeq1.float() - train_batch[1:]).pow(2).mean() \
+                   + (outSeq2.float() - train_batch[1:]).pow(2).mean() \
+                   + (hids1.float() - hids2.float().detach()).pow(2).mean()
+        loss.backward()
+
+    results = {}
+    for precision in args.precisions:
+        args.inference_precision = precision
+        scores, score_time = timeit(lambda: anomalyScore_multichannel(args, model, test_dataset, detector.means, None,
+                                                                      chols=detector.chols)[0],
+                                    args.repeat, args.device)
+        _, train_time = timeit(lambda: train_step(precision), args.repeat, args.device)
+        f_betas = [get_precision_recall(args, score, label, num_samples=1000, beta=args.beta)[2].max().item()
+                   for score in scores]
+        results[precision] = scores, score_time, train_time, f_betas
+
+    reference_scores, _, _, reference_f_betas = results[args.precisions[0]]
+    print('-' * 89)
+    print('| points {:d} | channels {:d} | window {:d} | device {} | reference {} |'.format(
+        len(test_dataset), len(reference_scores), detector.window, args.device, args.precisions[0]))
+    print('| {:>9} | {:>14} | {:>13} | {:>20} | {:>24} |'.format(
+        'precision', 'scoring pts/s', 'train step ms', 'max rel. score diff', 'f-beta per channel (diff)'))
+    for precision, (scores, score_time, train_time, f_betas) in results.items():
+        score_diff = ((scores - reference_scores).abs().max() / reference_scores.abs().max()).item()
+        print('| {:>9} | {:>14.1f} | {:>13.2f} | {:>20.3e} | {} |'.format(
+            precision, len(test_dataset) / score_time, train_time * 1000, score_diff,
+            ' '.join('{:.4f} ({:+.4f})'.format(f_beta, f_beta - reference) for f_beta, reference in
+                     zip(f_betas, reference_f_betas))))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
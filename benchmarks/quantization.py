@@ -0,0 +1,107 @@
+"""Compares the exported (TorchScript, int8 dynamic quantization) detector with the float model
+
+    python export_model.py --data ecg --filename chfdb_chf13_45590.pkl
+    python -m benchmarks.quantization --data ecg --filename chfdb_chf13_45590.pkl
+
+The test dataset is streamed one point at a time through the float StreamingDetector and through the exported
+artifacts (quantized and float), on the cpu. For each, the per-point latency, the size of the model, the maximum
+relative difference of the scores to the float model and the best f-beta score of every channel are reported.
+"""
+
+import argparse
+import io
+import json
+import time
+import numpy as np
+import torch
+import preprocess_data
+from pathlib import Path
+from streamingDetector import StreamingDetector
+from anomalyDetector import get_precision_recall
+from export_model import export, initial_state
+
+
+def stream_float(detector, points):
+    scores, latencies = [], []
+    for x in points:
+        start_time = time.perf_counter()
+        scores.append(detector.update(x))
+        latencies.append(time.perf_counter() - start_time)
+    return torch.stack(scores, dim=1), np.array(latencies) * 1000
+
+
+def stream_exported(artifact, config, points):
+    h, c, predictions, t = initial_state(config, 1)
+    scores, latencies = [], []
+    with torch.no_grad():
+        for x in points:
+            start_time = time.perf_counter()
+            score, h, c, predictions, t = artifact(x.unsqueeze(0), h, c, predictions, t)
+            latencies.append(time.perf_counter() - start_time)
+            scores.append(score[0])
+    return torch.stack(scores, dim=1), np.array(latencies) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the exported anomaly detector')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--artifact', type=str, default=None,
+                        help='exported artifact to compare (default: save/<data>/export/<filename>.pt, or a '
+                             'quantized export made on the fly if it does not exist)')
+    parser.add_argument('--npoints', type=int, default=None,
+                        help='number of test points to stream (default: the whole test dataset)')
+    parser.add_argument('--beta', type=float, default=1.0,
+                        help='beta value for f-beta score')
+    args = parser.parse_args()
+    args.device = 'cpu'
+
+    detector = StreamingDetector.from_checkpoint(args.data, args.filename, device='cpu')
+    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                    augment_test_data=False, augment_train_data=False)
+    points = preprocess_data.reconstruct(TimeseriesData.testData, TimeseriesData.mean, TimeseriesData.std)
+    label = TimeseriesData.testLabel
+    if args.npoints is not None:
+        points, label = points[:args.npoints], label[:args.npoints]
+
+    models = {}
+    artifact_path = Path(args.artifact) if args.artifact else \
+        Path('save', args.data, 'export', args.filename).with_suffix('.pt')
+    if artifact_path.exists():
+        extra_files = {'config.json': ''}
+        artifact = torch.jit.load(str(artifact_path), _extra_files=extra_files)
+        models['exported'] = artifact, json.loads(extra_files['config.json']), artifact_path.stat().st_size
+    for quantize in [True, False]:
+        artifact, config = export(StreamingDetector.from_checkpoint(args.data, args.filename, device='cpu'),
+                                  quantize=quantize)
+        buffer = io.BytesIO()
+        torch.jit.save(artifact, buffer)
+        models['int8 export' if quantize else 'float export'] = artifact, config, buffer.tell()
+
+    buffer = io.BytesIO()
+    torch.save(detector.model.state_dict(), buffer)
+    results = {'float model': stream_float(detector, points) + (buffer.tell(),)}
+    for name, (artifact, config, size) in models.items():
+        results[name] = stream_exported(artifact, config, points) + (size,)
+
+    reference = results['float model'][0]
+    args.prediction_window_size = detector.window
+    print('-' * 89)
+    print('| points {:d} | window {:d} | threads {:d} |'.format(len(points), detector.window, torch.get_num_threads()))
+    print('| {:>12} | {:>10} | {:>10} | {:>10} | {:>13} | {:>18} |'.format(
+        'model', 'size KiB', 'p50 ms', 'p99 ms', 'max rel diff', 'f-beta per channel'))
+    for name, (scores, latencies, size) in results.items():
+        f_betas = [get_precision_recall(args, score, label, num_samples=1000, beta=args.beta)[2] for score in scores]
+        # The f-beta sweep is empty when the scored points hold no labeled anomaly
+        f_betas = [f_beta.max().item() if len(f_beta) else float('nan') for f_beta in f_betas]
+        print('| {:>12} | {:>10.1f} | {:>10.4f} | {:>10.4f} | {:>13.3e} | {:>18} |'.format(
+            name, size / 1024, np.percentile(latencies, 50), np.percentile(latencies, 99),
+            ((scores - reference).abs().max() / reference.abs().max()).item(),
+            ' '.join('{:.4f}'.format(f_beta) for f_beta in f_betas)))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
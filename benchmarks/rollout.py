@@ -0,0 +1,91 @@
+"""Compares the implementations of RNNPredictor.rollout (the free running loss of train.py)
+
+    python -m benchmarks.rollout --model LSTM --batch_sizes 1 64 1024 --steps 50 --device cpu
+
+Every mode is timed without gradient (as in scoring) and with the backward pass (as in training), on a randomly
+initialised model, and its outputs and gradients are compared with the ones of 'loop' with dropout turned off.
+"""
+
+import argparse
+import time
+import torch
+from model.model import RNNPredictor
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device != 'cpu':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) * 1000 / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the rollout of the RNN predictor')
+    parser.add_argument('--model', type=str, default='LSTM',
+                        help='type of recurrent net (RNN_TANH, RNN_RELU, LSTM, GRU)')
+    parser.add_argument('--feature_dim', type=int, default=2,
+                        help='number of channels of the series')
+    parser.add_argument('--nhid', type=int, default=32,
+                        help='number of hidden units per layer (and size of rnn input features)')
+    parser.add_argument('--nlayers', type=int, default=2,
+                        help='number of layers')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 64, 1024],
+                        help='batch sizes to benchmark')
+    parser.add_argument('--steps', type=int, default=50,
+                        help='number of recursive predictions (bptt in training)')
+    parser.add_argument('--modes', type=str, nargs='+', default=['loop', 'fused', 'compile'],
+                        help='rollout modes to benchmark')
+    parser.add_argument('--repeat', type=int, default=20,
+                        help='number of timed rollouts')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='cuda or cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(1111)
+    model = RNNPredictor(rnn_type=args.model, enc_inp_size=args.feature_dim, rnn_inp_size=args.nhid,
+                         rnn_hid_size=args.nhid, dec_out_size=args.feature_dim, nlayers=args.nlayers,
+                         dropout=0.2).to(args.device)
+
+    print('-' * 89)
+    print('| model {} | nhid {:d} | nlayers {:d} | steps {:d} | device {} |'.format(
+        args.model, args.nhid, args.nlayers, args.steps, args.device))
+    print('| {:>6} | {:>8} | {:>16} | {:>16} | {:>10} | {:>10} |'.format(
+        'batch', 'mode', 'no grad ms/call', 'backward ms/call', 'max |dout|', 'max |dgrad|'))
+    for batch_size in args.batch_sizes:
+        input = torch.randn(1, batch_size, args.feature_dim, device=args.device)
+        hidden = model.init_hidden(batch_size)
+        reference = None
+        for mode in args.modes:
+            def rollout_no_grad():
+                with torch.no_grad():
+                    return model.rollout(input, hidden, args.steps, mode=mode)
+
+            def rollout_backward():
+                model.zero_grad()
+                outs, _, hids = model.rollout(input, hidden, args.steps, return_hiddens=True, mode=mode)
+                (outs.pow(2).mean() + hids.pow(2).mean()).backward()
+                return outs
+
+            model.train()
+            no_grad_time = timeit(rollout_no_grad, args.repeat, args.device)
+            backward_time = timeit(rollout_backward, args.repeat, args.device)
+
+            model.eval()
+            outs = rollout_backward().detach()
+            grads = [parameter.grad.clone() for parameter in model.parameters()]
+            if reference is None:
+                reference = outs, grads
+            max_out_diff = (outs - reference[0]).abs().max().item()
+            max_grad_diff = max((grad - grad_).abs().max().item() for grad, grad_ in zip(grads, reference[1]))
+            print('| {:>6d} | {:>8} | {:>16.3f} | {:>16.3f} | {:>10.2e} | {:>10.2e} |'.format(
+                batch_size, mode, no_grad_time, backward_time, max_out_diff, max_grad_diff))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
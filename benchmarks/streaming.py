@@ -0,0 +1,91 @@
+"""Measures the per-point latency and the throughput of StreamingDetector on a test dataset
+
+    python -m benchmarks.streaming --data ecg --filename chfdb_chf13_45590.pkl --device cpu
+
+With --nstreams N, the test dataset is fed to N independent streams of a MultiStreamDetector at once
+(stream i lags i points behind stream 0), and the latency is the one of a call scoring all the streams.
+"""
+
+import argparse
+import time
+import numpy as np
+import torch
+import preprocess_data
+from streamingDetector import StreamingDetector, MultiStreamDetector
+from anomalyDetector import anomalyScore_multichannel
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the streaming anomaly detector')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='cuda or cpu')
+    parser.add_argument('--npoints', type=int, default=None,
+                        help='number of test points to stream (default: the whole test dataset)')
+    parser.add_argument('--warmup', type=int, default=50,
+                        help='number of points streamed before timing')
+    parser.add_argument('--nstreams', type=int, default=1,
+                        help='number of independent streams scored per call')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the streamed scores with the offline scores')
+    args = parser.parse_args()
+
+    if args.nstreams == 1:
+        detector = StreamingDetector.from_checkpoint(args.data, args.filename, device=args.device)
+    else:
+        detector = MultiStreamDetector.from_checkpoint(args.data, args.filename, device=args.device,
+                                                       capacity=args.nstreams)
+    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                    augment_test_data=False, augment_train_data=False)
+    stream = preprocess_data.reconstruct(TimeseriesData.testData, TimeseriesData.mean, TimeseriesData.std)
+    if args.npoints is not None:
+        stream = stream[:args.npoints]
+    stream_ids = list(range(args.nstreams))
+    # points[t]: the points received by all the streams at step t
+    points = torch.stack([stream.roll(stream_id, dims=0) for stream_id in stream_ids], dim=1)
+
+    def step(x):
+        if args.nstreams == 1:
+            return detector.update(x[0]).unsqueeze(0)
+        return detector.score(stream_ids, x)
+
+    for x in points[:args.warmup]:
+        step(x)
+    for stream_id in stream_ids:
+        detector.remove_stream(stream_id)
+        detector.add_stream(stream_id)
+
+    latencies = []
+    scores = []
+    start_time = time.perf_counter()
+    for x in points:
+        point_start_time = time.perf_counter()
+        scores.append(step(x))
+        if args.device != 'cpu':
+            torch.cuda.synchronize()
+        latencies.append(time.perf_counter() - point_start_time)
+    elapsed = time.perf_counter() - start_time
+    latencies = np.array(latencies) * 1000
+
+    print('-' * 89)
+    print('| points {:d} | streams {:d} | window {:d} | device {} |'.format(
+        len(stream), args.nstreams, detector.window, args.device))
+    print('| latency ms/call | mean {:5.4f} | p50 {:5.4f} | p99 {:5.4f} | max {:5.4f} |'.format(
+        latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()))
+    print('| throughput {:8.1f} points/s |'.format(len(stream) * args.nstreams / elapsed))
+
+    if args.check:
+        test_dataset = TimeseriesData.batchify(args, TimeseriesData.testData[:len(stream)], bsz=1)
+        args.prediction_window_size = detector.window
+        offline_scores = anomalyScore_multichannel(args, detector.model, test_dataset, detector.means, None,
+                                                   chols=detector.chols)[0]
+        print('| max relative difference to the offline scores {:.3e} |'.format(
+            ((torch.stack(scores)[:, 0].t() - offline_scores).abs().max() / offline_scores.abs().max()).item()))
+    print('-' * 89)
+
+
+if __name__ == '__main__':
+    main()
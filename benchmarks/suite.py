@@ -0,0 +1,211 @@
+"""Times the training and detection hot paths on synthetic series of several sizes, and compares them with a baseline
+
+    python -m benchmarks.suite --lengths 1000 10000 100000 --channels 2 8 --output benchmarks.json
+    python -m benchmarks.suite --lengths 1000 10000 100000 --channels 2 8 --baseline benchmarks.json --threshold 0.2
+
+For every length and number of channels, a labeled multichannel series (noisy sines with spikes in the test series)
+is written in a temporary directory, so no dataset needs to be downloaded, and the following are timed (the best of
+--repeat runs):
+    load             PickleDataLoad as in train.py (read, standardise, augment)
+    load_predict     PickleDataLoad as in predict.py (read, standardise)
+    batchify         batchify of the train series
+    train_epoch      one training epoch of train.py
+    fit_gaussian     fit_norm_distribution_param on the train series
+    anomaly_score    anomalyScore of the test series
+    precision_recall get_precision_recall of the scores
+The results are written as JSON. Given a baseline (an earlier output), every time that is more than --threshold
+(relative) slower than in the baseline is reported as a regression (unless it is shorter than --min_seconds in the
+baseline), and the exit status is 1 if there is one.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+import torch
+from pathlib import Path
+
+import preprocess_data
+import train
+from model.model import RNNPredictor
+from anomalyDetector import fit_norm_distribution_param, anomalyScore, get_precision_recall
+
+
+def synthetic_series(length, channels, anomalies=0, seed=0):
+    """Noisy sines of random periods and phases [ length * (channels + 1) ], the last column being the label.
+    `anomalies` spikes of 10 points are added, and labeled."""
+    rng = np.random.RandomState(seed)
+    t = np.arange(length)[:, None]
+    periods = rng.uniform(20, 200, size=channels)
+    phases = rng.uniform(0, 2 * np.pi, size=channels)
+    series = np.sin(2 * np.pi * t / periods + phases) + 0.05 * rng.randn(length, channels)
+    label = np.zeros((length, 1))
+    for start in rng.randint(0, max(1, length - 10), size=anomalies):
+        series[start:start + 10] += rng.uniform(1, 3, size=channels)
+        label[start:start + 10] = 1
+    return np.concatenate([series, label], axis=1)
+
+
+def write_dataset(data, filename, length, channels, seed=0):
+    for split, anomalies in [('train', 0), ('test', max(1, length // 1000))]:
+        path = Path('dataset', data, 'labeled', split, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(path), 'wb') as f:
+            pickle.dump(synthetic_series(length, channels, anomalies, seed + (split == 'test')).tolist(), f)
+
+
+def best_time(fn, repeat, device):
+    """The result of fn and its best time over repeat runs, in seconds."""
+    times = []
+    for _ in range(repeat):
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        result = fn()
+        if device != 'cpu':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start_time)
+    return result, min(times)
+
+
+def run(args, length, channels):
+    """Times every hot path on a series of length points and channels channels: { name: seconds }."""
+    filename = 'synthetic_{}_{}.pkl'.format(length, channels)
+    write_dataset('synthetic', filename, length, channels, seed=args.seed)
+    times = {}
+    torch.manual_seed(args.seed)
+    TimeseriesData, times['load'] = best_time(lambda: preprocess_data.PickleDataLoad(
+        data_type='synthetic', filename=filename), args.repeat, 'cpu')
+    # Scoring is done on the series as predict.py loads them, without augmentation
+    ScoringData, times['load_predict'] = best_time(lambda: preprocess_data.PickleDataLoad(
+        data_type='synthetic', filename=filename, augment_test_data=False, augment_train_data=False),
+        args.repeat, 'cpu')
+    _, times['batchify'] = best_time(lambda: TimeseriesData.batchify(args, TimeseriesData.trainData,
+                                                                     args.batch_size), args.repeat, args.device)
+
+    train_args = ['--data', 'synthetic', '--filename', filename, '--device', args.device, '--epochs', '1',
+                  '--save_interval', '2', '--batch_size', str(args.batch_size), '--eval_batch_size',
+                  str(args.batch_size), '--emsize', str(args.nhid), '--nhid', str(args.nhid), '--cache_size', '0',
+                  '--seed', str(args.seed)]
+    epoch_times = []
+    for _ in range(args.repeat):
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            epoch_times.append(train.main(train_args)['train_time'])
+    times['train_epoch'] = min(epoch_times)
+
+    model = RNNPredictor(rnn_type='LSTM', enc_inp_size=channels, rnn_inp_size=args.nhid, rnn_hid_size=args.nhid,
+                         dec_out_size=channels, nlayers=2).to(args.device)
+    train_dataset = ScoringData.batchify(args, ScoringData.trainData, bsz=1)
+    test_dataset = ScoringData.batchify(args, ScoringData.testData, bsz=1)
+    (mean, cov), times['fit_gaussian'] = best_time(lambda: fit_norm_distribution_param(args, model, train_dataset),
+                                                   args.repeat, args.device)
+    score, times['anomaly_score'] = best_time(lambda: anomalyScore(args, model, test_dataset, mean, cov)[0],
+                                              args.repeat, args.device)
+    label = ScoringData.testLabel.to(args.device)
+    _, times['precision_recall'] = best_time(lambda: get_precision_recall(args, score, label, num_samples=1000),
+                                             args.repeat, args.device)
+    return times
+
+
+def compare(results, baseline, threshold, min_seconds=0.0):
+    """Prints every time next to its baseline; returns the regressions (slower than the baseline by > threshold).
+    Times of less than min_seconds in the baseline are too noisy to be reported as regressions."""
+    reference = {(result['name'], result['length'], result['channels']): result['seconds']
+                 for result in baseline['results']}
+    regressions = []
+    print('| {:>16} | {:>8} | {:>8} | {:>10} | {:>10} | {:>7} |'.format(
+        'benchmark', 'length', 'channels', 'seconds', 'baseline', 'ratio'))
+    for result in results:
+        key = (result['name'], result['length'], result['channels'])
+        if key not in reference:
+            continue
+        ratio = result['seconds'] / reference[key]
+        regression = ratio > 1 + threshold and reference[key] >= min_seconds
+        print('| {:>16} | {:>8d} | {:>8d} | {:>10.4f} | {:>10.4f} | {:>7.2f} |{}'.format(
+            result['name'], result['length'], result['channels'], result['seconds'], reference[key], ratio,
+            ' regression' if regression else ''))
+        if regression:
+            regressions.append(dict(result, baseline=reference[key], ratio=ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the training and detection hot paths')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 10000],
+                        help='lengths of the synthetic train and test series')
+    parser.add_argument('--channels', type=int, nargs='+', default=[2],
+                        help='numbers of channels of the synthetic series')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='cuda or cpu')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs (the best one is kept)')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch size of training')
+    parser.add_argument('--nhid', type=int, default=32,
+                        help='number of hidden units per layer (and size of rnn input features)')
+    parser.add_argument('--prediction_window_size', type=int, default=10,
+                        help='prediction_window_size')
+    parser.add_argument('--rollout_batch_size', type=int, default=1024,
+                        help='number of starting points rolled out together')
+    parser.add_argument('--seed', type=int, default=1111,
+                        help='random seed')
+    parser.add_argument('--output', type=str, default=None,
+                        help='path of the JSON results (default: print them only)')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown over the baseline reported as a regression')
+    parser.add_argument('--min_seconds', type=float, default=1e-3,
+                        help='times shorter than this in the baseline are not reported as regressions')
+    args = parser.parse_args()
+
+    cwd = os.getcwd()
+    output = Path(cwd, args.output) if args.output else None
+    baseline = Path(cwd, args.baseline) if args.baseline else None
+    results = []
+    # The datasets, checkpoints and figures are written in a temporary directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for length in args.lengths:
+                for channels in args.channels:
+                    for name, seconds in run(args, length, channels).items():
+                        results.append({'name': name, 'length': length, 'channels': channels, 'seconds': seconds})
+                        print('=> {:>16} | length {:>8d} | channels {:>3d} | {:.4f} s'.format(
+                            name, length, channels, seconds))
+        finally:
+            os.chdir(cwd)
+
+    report = {'meta': {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'torch': torch.__version__,
+                       'platform': platform.platform(),
+                       'device': args.device,
+                       'threads': torch.get_num_threads(),
+                       'args': vars(args)},
+              'results': results}
+    if output is not None:
+        output.parent.mkdir(parents=True, exist_ok=True)
+        with open(str(output), 'w') as f:
+            json.dump(report, f, indent=2)
+        print('=> results saved to', output)
+
+    if baseline is not None:
+        with open(str(baseline)) as f:
+            baseline = json.load(f)
+        print('-' * 89)
+        regressions = compare(results, baseline, args.threshold, args.min_seconds)
+        print('-' * 89)
+        if regressions:
+            print('=> {} regression(s) over {:.0%}'.format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+"""Converts the labeled pickles of a dataset to the binary columnar format read by PickleDataLoad
+
+    python convert_dataset.py --data ecg
+
+Every dataset/<data>/labeled/{train,test,whole}/<name>.pkl is saved as <name>.tsd next to it.
+"""
+
+import argparse
+import pickle
+import numpy as np
+from pathlib import Path
+import preprocess_data
+
+
+def convert(pkl_path, channel_names=None):
+    with open(str(pkl_path), 'rb') as f:
+        series = np.asarray(pickle.load(f), dtype=np.float32)
+    columnar_path = pkl_path.with_suffix(preprocess_data.COLUMNAR_SUFFIX)
+    preprocess_data.save_columnar(columnar_path, series[:, :-1], series[:, -1], channel_names=channel_names)
+    return columnar_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert labeled pickles to the columnar format')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default=None,
+                        help='filename of the dataset (default: every file of the dataset)')
+    parser.add_argument('--channel_names', type=str, nargs='+', default=None,
+                        help='names of the channels (default: channel0, channel1, ...)')
+    args = parser.parse_args()
+
+    pattern = args.filename if args.filename is not None else '*.pkl'
+    for split in ['train', 'test', 'whole']:
+        for pkl_path in sorted(Path('dataset', args.data, 'labeled', split).glob(pattern)):
+            print('Converting', pkl_path, '->', convert(pkl_path, channel_names=args.channel_names))
+
+
+if __name__ == '__main__':
+    main()
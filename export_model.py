@@ -0,0 +1,138 @@
+"""Exports a trained detector as a self-contained TorchScript artifact, optionally with dynamic int8 quantization
+
+    python export_model.py --data ecg --filename chfdb_chf13_45590.pkl [--no_quantize]
+
+The artifact (save/<data>/export/<filename>.pt) scores streams one point at a time, like StreamingDetector, but
+needs nothing but torch: it bundles the predictor (its nn.LSTM/nn.GRU and nn.Linear layers quantized to int8 with
+torch.ao dynamic quantization), the normalisation mean/std of the train dataset and the gaussian error model.
+It is stateless, the state of the streams is passed in and returned:
+
+    detector = torch.jit.load('save/ecg/export/chfdb_chf13_45590.pt', _extra_files=extra_files)
+    config = json.loads(extra_files['config.json'])
+    h, c, predictions, t = initial_state(config, nstreams)
+    scores, h, c, predictions, t = detector(points, h, c, predictions, t)  # points: raw [ nstreams * feature_size ]
+
+With --format bundle, the inference bundle of model.bundle (save/<data>/bundle/<filename>.safetensors) is written
+instead, e.g. for checkpoints saved before train.py wrote one.
+"""
+
+import argparse
+import json
+import torch
+import torch.nn as nn
+from pathlib import Path
+from anomalyDetector import gaussian_score
+from streamingDetector import MultiStreamDetector
+from model.bundle import save_bundle, bundle_path
+
+
+class DetectorStep(nn.Module):
+    """One step of MultiStreamDetector.score as a pure function of the stream states, for tracing."""
+
+    def __init__(self, predictor, data_mean, data_std, means, chols):
+        super(DetectorStep, self).__init__()
+        self.predictor = predictor
+        self.is_lstm = predictor.rnn_type == 'LSTM'
+        self.register_buffer('data_mean', data_mean.float())
+        self.register_buffer('data_std', data_std.float())
+        self.register_buffer('means', means.double())
+        self.register_buffer('chols', chols.double())
+        self.window = means.size(-1)
+        self.register_buffer('step', torch.arange(self.window))
+
+    def forward(self, x, h, c, predictions, t):
+        """
+        :param x: raw points [ nstreams * feature_size ]
+        :param h, c: hidden and cell states [ nlayers * nstreams * rnn_hid_size ] (c is passed through for a GRU)
+        :param predictions: ring buffer of the last predictions [ nstreams * W * W * feature_size ]
+        :param t: number of points seen by every stream [ nstreams ]
+        :return: scores [ nstreams * channels ], and the next h, c, predictions, t
+        """
+        x = (x - self.data_mean) / self.data_std
+        rows = (t.unsqueeze(1) - self.window + self.step.unsqueeze(0)) % self.window
+        streams = torch.arange(x.size(0)).unsqueeze(1)
+        rearranged = predictions[streams, rows, (self.window - 1 - self.step).unsqueeze(0)]
+        errors = (rearranged - x.unsqueeze(1)) * (t >= self.window).to(x.dtype).view(-1, 1, 1)
+        scores = gaussian_score(errors.permute(2, 0, 1), self.means, self.chols).t()
+
+        hidden = (h, c) if self.is_lstm else h
+        out, hidden = self.predictor.forward(x.unsqueeze(0), hidden)
+        outs, _ = self.predictor.rollout(out, hidden, self.window - 1, mode='loop')
+        new_predictions = torch.cat([out, outs], dim=0).transpose(0, 1) # [ nstreams * W * feature_size ]
+        predictions = predictions.clone()
+        predictions[torch.arange(x.size(0)), t % self.window] = new_predictions
+        if self.is_lstm:
+            h, c = hidden
+        else:
+            h = hidden
+        return scores, h, c, predictions, t + 1
+
+
+def initial_state(config, nstreams):
+    """The state of nstreams new streams for an exported detector: h, c, predictions, t."""
+    h = torch.zeros(config['nlayers'], nstreams, config['nhid'])
+    predictions = torch.zeros(nstreams, config['window'], config['window'], config['feature_dim'])
+    return h, h.clone(), predictions, torch.zeros(nstreams, dtype=torch.long)
+
+
+def export(detector, quantize=True):
+    """Traces a MultiStreamDetector (on the cpu) into a DetectorStep artifact.
+    :return: TorchScript module, its config
+    """
+    predictor = detector.model.cpu().eval()
+    if predictor.rnn_type not in ['LSTM', 'GRU']:
+        raise ValueError('Only LSTM and GRU predictors can be exported')
+    if quantize:
+        predictor = torch.ao.quantization.quantize_dynamic(predictor, {nn.LSTM, nn.GRU, nn.Linear}, dtype=torch.qint8)
+    step = DetectorStep(predictor, detector.data_mean.cpu(), detector.data_std.cpu(), detector.means.cpu(),
+                        detector.chols.cpu()).eval()
+    config = {'rnn_type': predictor.rnn_type,
+              'nlayers': predictor.nlayers,
+              'nhid': predictor.rnn_hid_size,
+              'feature_dim': detector.feature_dim,
+              'window': detector.window,
+              'quantized': quantize}
+    # Traced with 2 streams, so that the number of streams is not specialised away
+    example = (torch.zeros(2, detector.feature_dim),) + initial_state(config, 2)
+    with torch.no_grad():
+        traced = torch.jit.trace(step, example, check_trace=False)
+    return traced, config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a trained anomaly detector as TorchScript')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--no_quantize', action='store_true',
+                        help='keep the float weights')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'bundle'],
+                        help='torchscript artifact, or inference bundle (see model.bundle, train.py writes one for '
+                             'new checkpoints)')
+    parser.add_argument('--output', type=str, default=None,
+                        help='path of the artifact (default: save/<data>/export/<filename>.pt, or '
+                             'save/<data>/bundle/<filename>.safetensors)')
+    args = parser.parse_args()
+
+    print("=> loading checkpoint ")
+    detector = MultiStreamDetector.from_checkpoint(args.data, args.filename, device='cpu', capacity=1)
+    print("=> loaded checkpoint")
+    if args.format == 'bundle':
+        # The checkpoint holds the training args (an argparse.Namespace), which the weights-only loader rejects
+        checkpoint = torch.load(str(Path('save', args.data, 'checkpoint', args.filename).with_suffix('.pth')),
+                                map_location=torch.device('cpu'), weights_only=False)
+        output = Path(args.output) if args.output else bundle_path(args.data, args.filename)
+        save_bundle(output, checkpoint['args'], checkpoint['state_dict'], checkpoint['means'], checkpoint['covs'],
+                    detector.data_mean, detector.data_std, chols=detector.chols, epoch=checkpoint['epoch'])
+        print('=> exported to', output)
+        return
+    traced, config = export(detector, quantize=not args.no_quantize)
+    output = Path(args.output) if args.output else Path('save', args.data, 'export', args.filename).with_suffix('.pt')
+    output.parent.mkdir(parents=True, exist_ok=True)
+    torch.jit.save(traced, str(output), _extra_files={'config.json': json.dumps(config)})
+    print('=> exported to', output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Inference-only bundle of a trained detector
+
+A bundle (save/<data>/bundle/<filename>.safetensors) holds only what scoring needs: the weights of the predictor,
+the gaussian error model (means, covs, their Cholesky factors and inverses, in float64) and the normalisation
+mean/std of the train dataset, plus a versioned JSON config with the hyperparameters of the predictor.
+It is written in the safetensors layout (an 8-byte little-endian header size, a JSON header, then the raw tensors),
+so it is read without pickle and without the safetensors package: the tensors are views of a memory map of the file.
+"""
+
+import os
+import json
+import struct
+import numpy as np
+import torch
+from pathlib import Path
+
+BUNDLE_VERSION = 1
+BUNDLE_SUFFIX = '.safetensors'
+CONFIG_KEYS = ['data', 'filename', 'model', 'emsize', 'nhid', 'nlayers', 'res_connection', 'seed']
+
+dtypes = {torch.float64: 'F64', torch.float32: 'F32', torch.float16: 'F16', torch.bfloat16: 'BF16',
+          torch.int64: 'I64', torch.int32: 'I32', torch.uint8: 'U8', torch.bool: 'BOOL'}
+# bfloat16 has no numpy dtype, it is read as int16 and viewed as bfloat16
+numpy_dtypes = {'F64': np.float64, 'F32': np.float32, 'F16': np.float16, 'BF16': np.int16,
+                'I64': np.int64, 'I32': np.int32, 'U8': np.uint8, 'BOOL': np.bool_}
+
+
+def bundle_path(data, filename):
+    return Path('save', data, 'bundle', filename).with_suffix(BUNDLE_SUFFIX)
+
+
+def write_tensors(path, tensors, metadata=None):
+    """Writes a dict of tensors in the safetensors layout, atomically.
+
+    :param metadata: dict of strings, stored in the header
+    """
+    # Largest items first, so that every tensor is aligned in the file
+    names = sorted(tensors, key=lambda name: -tensors[name].element_size())
+    header, buffers, offset = {}, [], 0
+    for name in names:
+        tensor = tensors[name].detach().cpu().contiguous()
+        data = tensor.view(torch.int16) if tensor.dtype == torch.bfloat16 else tensor
+        data = data.numpy().tobytes()
+        header[name] = {'dtype': dtypes[tensor.dtype], 'shape': list(tensor.shape),
+                        'data_offsets': [offset, offset + len(data)]}
+        buffers.append(data)
+        offset += len(data)
+    if metadata:
+        header['__metadata__'] = metadata
+    header = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    header += b' ' * (-len(header) % 8)
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(str(tmp), 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for data in buffers:
+            f.write(data)
+    os.replace(str(tmp), str(path))
+
+
+def read_tensors(path, device='cpu'):
+    """Reads a file written by write_tensors (or any safetensors file).
+
+    :return: dict of tensors (on the cpu, they share the memory map of the file), metadata
+    """
+    with open(str(path), 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    metadata = header.pop('__metadata__', {})
+    if not header:
+        return {}, metadata
+    # Copy-on-write, so that the tensors are writable but the file is never modified
+    buffer = np.memmap(str(path), dtype=np.uint8, mode='c', offset=8 + header_size)
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info['data_offsets']
+        array = buffer[begin:end].view(numpy_dtypes[info['dtype']]).reshape(info['shape'])
+        tensor = torch.from_numpy(array)
+        if info['dtype'] == 'BF16':
+            tensor = tensor.view(torch.bfloat16)
+        tensors[name] = tensor.to(device)
+    return tensors, metadata
+
+
+def save_bundle(path, args, state_dict, means, covs, data_mean, data_std, chols=None, epoch=None):
+    """Writes the bundle of a trained detector.
+
+    :param args: training arguments of the predictor (the ones in CONFIG_KEYS are kept)
+    :param means, covs: per-channel gaussian parameters [ channels * prediction_window_size (* prediction_window_size) ]
+    :param data_mean, data_std: normalisation statistics of the train dataset
+    """
+    from anomalyDetector import cholesky_factor
+
+    covs = torch.stack(list(covs)).double()
+    chols = cholesky_factor(covs) if chols is None else torch.stack(list(chols)).double()
+    tensors = {'model.' + name: tensor for name, tensor in state_dict.items()}
+    tensors.update({'gaussian.means': torch.stack(list(means)).double(),
+                    'gaussian.covs': covs,
+                    'gaussian.chols': chols,
+                    'gaussian.inv_covs': torch.cholesky_inverse(chols),
+                    'data.mean': data_mean.float(),
+                    'data.std': data_std.float()})
+    config = {key: getattr(args, key) for key in CONFIG_KEYS}
+    config.update({'version': BUNDLE_VERSION,
+                   'feature_dim': data_mean.size(0),
+                   'prediction_window_size': covs.size(-1),
+                   'epoch': epoch})
+    write_tensors(path, tensors, {'config': json.dumps(config)})
+
+
+def load_bundle(path, device='cpu'):
+    """Reads a bundle written by save_bundle.
+
+    :return: dict with the config, the state_dict of the predictor, means, covs, chols, inv_covs, data_mean, data_std
+    """
+    tensors, metadata = read_tensors(path, device)
+    config = json.loads(metadata['config'])
+    if config['version'] > BUNDLE_VERSION:
+        raise ValueError('Bundle {} has version {}, only versions up to {} are supported'.format(
+            path, config['version'], BUNDLE_VERSION))
+    return {'config': config,
+            'state_dict': {name[len('model.'):]: tensor for name, tensor in tensors.items()
+                           if name.startswith('model.')},
+            'means': tensors['gaussian.means'],
+            'covs': tensors['gaussian.covs'],
+            'chols': tensors['gaussian.chols'],
+            'inv_covs': tensors['gaussian.inv_covs'],
+            'data_mean': tensors['data.mean'],
+            'data_std': tensors['data.std']}
+
+
+def build_predictor(config):
+    """The RNNPredictor described by the config of a bundle (with untrained weights)."""
+    from .model import RNNPredictor
+
+    return RNNPredictor(rnn_type=config['model'],
+                        enc_inp_size=config['feature_dim'],
+                        rnn_inp_size=config['emsize'],
+                        rnn_hid_size=config['nhid'],
+                        dec_out_size=config['feature_dim'],
+                        nlayers=config['nlayers'],
+                        res_connection=config['res_connection'])
@@ -0,0 +1,118 @@
+import os
+import copy
+import queue
+import atexit
+import shutil
+import threading
+import torch
+from pathlib import Path
+
+
+def snapshot(state):
+    """Copies a (nested) checkpoint state to the cpu, so that training can go on while it is written."""
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return copy.deepcopy(state)
+
+
+def link_or_copy(src, dst):
+    """Atomically makes dst a hard link to src, or a copy of it where hard links are not supported."""
+    tmp = dst.with_name(dst.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(str(src), str(tmp))
+    except OSError:
+        shutil.copyfile(str(src), str(tmp))
+    os.replace(str(tmp), str(dst))
+
+
+def write_checkpoint(state, checkpoint, best=None, keep=1):
+    """Writes a checkpoint atomically: to a temporary file first, then renamed over the checkpoint.
+
+    :param checkpoint: path of the checkpoint
+    :param best: path the checkpoint is also linked to, if it is the best so far
+    :param keep: number of checkpoints kept, as <checkpoint>.epoch<N>.pth links next to the checkpoint (the latest
+                 being the checkpoint itself); older ones are removed
+    """
+    checkpoint = Path(checkpoint)
+    checkpoint.parent.mkdir(parents=True, exist_ok=True)
+    tmp = checkpoint.with_name(checkpoint.name + '.tmp')
+    torch.save(state, str(tmp))
+    os.replace(str(tmp), str(checkpoint))
+
+    if keep > 1:
+        link_or_copy(checkpoint, checkpoint.with_suffix('.epoch{}.pth'.format(state['epoch'])))
+        history = sorted(checkpoint.parent.glob(checkpoint.stem + '.epoch*.pth'),
+                         key=lambda path: int(path.suffixes[-2][len('.epoch'):]))
+        for path in history[:-keep]:
+            path.unlink()
+
+    if best is not None:
+        best = Path(best)
+        best.parent.mkdir(parents=True, exist_ok=True)
+        link_or_copy(checkpoint, best)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints on a background thread, so that training does not wait for the disk.
+
+    The state is copied to the cpu when `save` is called, and written by `write_checkpoint` in the order of the
+    calls. `flush` waits for the pending checkpoints; it is also called when the interpreter exits. `close` (or
+    leaving a `with` block) flushes and stops the thread.
+    An error raised while writing is raised again by the next call to `save`, `flush` or `close`.
+    """
+
+    def __init__(self, keep=1):
+        self.keep = keep
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            state, checkpoint, best = item
+            try:
+                write_checkpoint(state, checkpoint, best, self.keep)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def save(self, state, checkpoint, best=None):
+        if not self.thread.is_alive():
+            raise RuntimeError('save on a closed CheckpointWriter')
+        self.raise_error()
+        self.queue.put((snapshot(state), checkpoint, best))
+
+    def flush(self):
+        self.queue.join()
+        self.raise_error()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+            atexit.unregister(self.flush)
+        self.raise_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,48 @@
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(backend='gloo'):
+    """Joins the process group set up by torchrun (RANK, WORLD_SIZE, MASTER_ADDR and MASTER_PORT).
+    :return: rank, world_size
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def broadcast_parameters(model, src=0):
+    """Copies the parameters and buffers of the model on rank src to every rank."""
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def shard_columns(dataset, rank, world_size):
+    """The batch columns [ seq_len * (batch_size / world_size) * feature_size ] of a batchified dataset that a rank
+    trains on: columns rank, rank + world_size, rank + 2 * world_size, ..."""
+    columns = torch.arange(rank, dataset.size(1), world_size)
+    if hasattr(dataset, 'select_columns'):
+        return dataset.select_columns(columns)
+    return dataset[:, columns.to(dataset.device)]
+
+
+def allreduce_gradients(model, weight):
+    """Averages the gradients over the ranks, in one flat all-reduce.
+
+    :param weight: share of the batch of this rank (its number of columns over the total), so that the gradient is
+                   the one of the loss averaged over the whole batch
+    """
+    grads = [parameter.grad for parameter in model.parameters() if parameter.grad is not None]
+    flat = torch.cat([grad.reshape(-1) for grad in grads]) * weight
+    dist.all_reduce(flat)
+    offset = 0
+    for grad in grads:
+        grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+        offset += grad.numel()
+
+
+def allreduce_mean(values, weight):
+    """Weighted mean over the ranks of a tensor of values (e.g. losses averaged over the columns of each rank)."""
+    values = torch.cat([values * weight, values.new_tensor([weight])])
+    dist.all_reduce(values)
+    return values[:-1] / values[-1]
@@ -0,0 +1,174 @@
+"""Opt-in instrumentation: timers, counters and peak memory of a run, and torch.profiler traces
+
+    metrics = Metrics(path='result/ecg/metrics.prom', labels={'script': 'train'})
+    with metrics.timer('scoring', points=len(test_dataset)):
+        ...
+    metrics.emit('end')
+
+Every timer accumulates its total time, its number of calls and, if given, the number of points it processed, from
+which ms/call and points/s are derived. A timer nested in another is named <stage>/<sub-stage>, so that its time
+is read as a part of its parent's, not added to it. `emit` writes the current values to `path`: appended as one
+JSON line per call, or, if the path ends with .prom, as a Prometheus textfile (rewritten atomically, for the
+node_exporter textfile collector). A Metrics without a path is disabled, and its timers cost nothing.
+"""
+
+import os
+import sys
+import json
+import time
+import contextlib
+import torch
+from pathlib import Path
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+PROMETHEUS_SUFFIX = '.prom'
+PROMETHEUS_PREFIX = 'rnn_anomaly_'
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes (None where it is not available)."""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+class Metrics(object):
+
+    def __init__(self, path=None, labels=None, device='cpu'):
+        """
+        :param path: output file (.prom: Prometheus textfile, anything else: JSON lines), None to disable the metrics
+        :param labels: labels of the run (e.g. script, data, filename), added to every output
+        :param device: the cuda device is synchronised before reading a timer, so that the time of its kernels is
+                       counted where they are launched
+        """
+        self.path = Path(path) if path else None
+        self.enabled = self.path is not None
+        self.labels = labels or {}
+        self.synchronize = self.enabled and torch.device(device).type == 'cuda'
+        self.timers = {}
+        self.counters = {}
+        self.start_time = time.time()
+
+    @contextlib.contextmanager
+    def timer(self, name, points=None):
+        """Times the block. :param points: number of points processed by the block, for the throughput"""
+        if not self.enabled:
+            yield
+            return
+        if self.synchronize:
+            torch.cuda.synchronize()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            timer = self.timers.setdefault(name, {'seconds': 0.0, 'calls': 0, 'points': 0})
+            timer['seconds'] += time.perf_counter() - start_time
+            timer['calls'] += 1
+            timer['points'] += points or 0
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        timers = {}
+        for name, timer in self.timers.items():
+            timers[name] = dict(timer, ms_per_call=timer['seconds'] * 1000 / timer['calls'])
+            if timer['points']:
+                timers[name]['points_per_second'] = timer['points'] / timer['seconds'] if timer['seconds'] else None
+        return {'timers': timers, 'counters': dict(self.counters), 'peak_rss_bytes': peak_rss(),
+                'elapsed_seconds': time.time() - self.start_time}
+
+    def emit(self, event, **fields):
+        """Writes the current values of the metrics, for an event of the run (e.g. 'epoch', 'end')."""
+        if not self.enabled:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        record = dict(self.snapshot(), event=event, time=time.time(), labels=self.labels, **fields)
+        if self.path.suffix == PROMETHEUS_SUFFIX:
+            tmp = self.path.with_name(self.path.name + '.tmp')
+            with open(str(tmp), 'w') as f:
+                f.write(self.prometheus(record))
+            os.replace(str(tmp), str(self.path))
+        else:
+            with open(str(self.path), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def prometheus(self, record):
+        """The record in the Prometheus text format. The timers are labeled with their stage."""
+        labels = ['{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                  for key, value in sorted(self.labels.items())]
+        lines = []
+
+        def metric(name, kind, help, samples):
+            """:param samples: [ (extra labels, value) ], the samples of None are skipped"""
+            samples = [(extra, value) for extra, value in samples if value is not None]
+            if not samples:
+                return
+            name = PROMETHEUS_PREFIX + name
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for extra, value in samples:
+                lines.append('{}{{{}}} {}'.format(name, ','.join(extra + labels), repr(float(value))))
+
+        timers = [(['stage="{}"'.format(name)], timer) for name, timer in sorted(record['timers'].items())]
+        metric('stage_seconds_total', 'counter', 'Time spent in the stage',
+               [(stage, timer['seconds']) for stage, timer in timers])
+        metric('stage_calls_total', 'counter', 'Number of calls of the stage',
+               [(stage, timer['calls']) for stage, timer in timers])
+        metric('stage_ms_per_call', 'gauge', 'Mean time of a call of the stage',
+               [(stage, timer['ms_per_call']) for stage, timer in timers])
+        metric('stage_points_per_second', 'gauge', 'Points processed per second by the stage',
+               [(stage, timer.get('points_per_second')) for stage, timer in timers])
+        for name, value in sorted(record['counters'].items()):
+            metric(name + '_total', 'counter', 'Count of ' + name, [([], value)])
+        metric('peak_rss_bytes', 'gauge', 'Peak resident set size of the process', [([], record['peak_rss_bytes'])])
+        metric('last_event_timestamp_seconds', 'gauge', 'Time of the last update', [([], record['time'])])
+        return '\n'.join(lines) + '\n'
+
+
+class EpochProfiler(object):
+    """Captures torch.profiler traces of the epochs in [first, last] (chrome trace files <directory>/epoch<N>.json,
+    to open in chrome://tracing or Perfetto). Only `steps` batches of an epoch are recorded, after one of warm-up, as
+    a trace of a whole epoch takes gigabytes of memory; the training loop marks the batches with `step()`."""
+
+    def __init__(self, directory, epochs=None, steps=5, device='cpu'):
+        """
+        :param epochs: (first, last) epochs to profile, None to profile none
+        :param steps: number of batches recorded in every profiled epoch
+        """
+        self.directory = Path(directory)
+        self.first, self.last = epochs if epochs is not None else (1, 0)
+        self.steps = steps
+        self.activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.device(device).type == 'cuda':
+            self.activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = None
+
+    @contextlib.contextmanager
+    def epoch(self, epoch):
+        if not self.first <= epoch <= self.last:
+            yield
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = str(self.directory.joinpath('epoch{}.json'.format(epoch)))
+        with torch.profiler.profile(activities=self.activities,
+                                    schedule=torch.profiler.schedule(wait=0, warmup=1, active=self.steps, repeat=1),
+                                    on_trace_ready=lambda profiler: profiler.export_chrome_trace(path)) as profiler:
+            self.profiler = profiler
+            try:
+                yield
+            finally:
+                self.profiler = None
+
+    def step(self):
+        if self.profiler is not None:
+            self.profiler.step()
@@ -2,8 +2,19 @@ import torch.nn as nn
 import torch
 from torch.autograd import Variable
 import torch.nn.functional as F
-import shutil
+import contextlib
 from pathlib import Path
+from .checkpoint import write_checkpoint
+
+precisions = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+def autocast(device, precision='fp32'):
+    """Context in which the model runs in `precision` ('fp32', 'bf16' or 'fp16') with torch.autocast.
+    The weights stay in float32, and so do the losses."""
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=precisions[precision])
+
 
 class RNNPredictor(nn.Module):
     """Container module with an encoder, a recurrent module, and a decoder."""
@@ -75,8 +86,87 @@ class RNNPredictor(nn.Module):
 
         return decoded, hidden
 
+    def rollout(self, input, hidden, steps, return_hiddens=False, mode='fused'):
+        """Recursively predicts `steps` steps from `input`, feeding every prediction back as the next input.
+        Same as calling `forward(out, hidden)` `steps` times and concatenating the outputs.
+
+        :param input: [ 1 * batch_size * feature_size ]
+        :param mode: 'loop': one forward call per step,
+                     'fused': one cell call per layer and step on the weights of the rnn (LSTM, GRU, RNN_TANH and
+                     RNN_RELU; the other models fall back to 'loop'), writing into preallocated buffers when no
+                     gradient is needed,
+                     'compile': 'fused', compiled with torch.compile
+        :return: outputs [ steps * batch_size * feature_size ], hidden,
+                 (hiddens: outputs of the last layer [ steps * batch_size * rnn_hid_size ])
+        """
+        if mode not in ['loop', 'fused', 'compile']:
+            raise ValueError("An invalid rollout mode was supplied, options are ['loop', 'fused', 'compile']")
+        if mode == 'loop' or self.rnn_type not in self.rnn_cells:
+            outs, hids = [], []
+            out = input
+            for step in range(steps):
+                out, hidden, hid = self.forward(out, hidden, return_hiddens=True)
+                outs.append(out)
+                hids.append(hid)
+            if steps > 0:
+                outs, hids = torch.cat(outs, dim=0), torch.cat(hids, dim=0)
+            else:
+                outs = input.new_empty(0, input.size(1), self.decoder.out_features)
+                hids = input.new_empty(0, input.size(1), self.rnn_hid_size)
+        elif mode == 'compile':
+            if getattr(self, '_compiled_rollout', None) is None:
+                self._compiled_rollout = torch.compile(self._fused_rollout, dynamic=True)
+            outs, hidden, hids = self._compiled_rollout(input, hidden, steps)
+        else:
+            outs, hidden, hids = self._fused_rollout(input, hidden, steps)
+        if return_hiddens:
+            return outs, hidden, hids
+        return outs, hidden
+
+    rnn_cells = {'LSTM': torch.lstm_cell, 'GRU': torch.gru_cell,
+                 'RNN_TANH': torch.rnn_tanh_cell, 'RNN_RELU': torch.rnn_relu_cell}
+
+    def _fused_rollout(self, input, hidden, steps):
+        cell = self.rnn_cells[self.rnn_type]
+        weights = self.rnn.all_weights # [ w_ih, w_hh, b_ih, b_hh ] of every layer
+        # Per-layer hidden states [ batch_size * rnn_hid_size ]
+        if self.rnn_type == 'LSTM':
+            states = list(zip(hidden[0].unbind(0), hidden[1].unbind(0)))
+        else:
+            states = list(hidden.unbind(0))
+        inter_layer_dropout = self.rnn.dropout if self.training else 0
+        preallocate = not torch.is_grad_enabled()
+        if preallocate:
+            outs = input.new_empty(steps, input.size(1), self.decoder.out_features)
+            hids = input.new_empty(steps, input.size(1), self.rnn_hid_size)
+        else:
+            outs, hids = [], []
 
+        out = input[0]
+        for step in range(steps):
+            layer_input = self.drop(self.encoder(out))
+            for layer in range(self.nlayers):
+                states[layer] = cell(layer_input, states[layer], *weights[layer])
+                layer_input = states[layer][0] if self.rnn_type == 'LSTM' else states[layer]
+                if layer < self.nlayers - 1 and inter_layer_dropout > 0:
+                    layer_input = F.dropout(layer_input, p=inter_layer_dropout, training=True)
+            hid = self.drop(layer_input)
+            decoded = self.decoder(hid)
+            out = decoded + out if self.res_connection else decoded
+            if preallocate:
+                outs[step] = out
+                hids[step] = hid
+            else:
+                outs.append(out)
+                hids.append(hid)
+        if not preallocate:
+            outs, hids = torch.stack(outs), torch.stack(hids)
 
+        if self.rnn_type == 'LSTM':
+            hidden = (torch.stack([h for h, c in states]), torch.stack([c for h, c in states]))
+        else:
+            hidden = torch.stack(states)
+        return outs, hidden, hids
 
     def init_hidden(self, bsz):
         weight = next(self.parameters()).data
@@ -93,27 +183,49 @@ class RNNPredictor(nn.Module):
         else:
             return h.detach()
 
-    def save_checkpoint(self,state, is_best):
-        print("=> saving checkpoint ..")
-        args = state['args']
-        checkpoint_dir = Path('save',args.data,'checkpoint')
-        checkpoint_dir.mkdir(parents=True,exist_ok=True)
-        checkpoint = checkpoint_dir.joinpath(args.filename).with_suffix('.pth')
+    def concat_hidden(self,hiddens):
+        """Concatenates a list of hidden states along the batch dimension."""
+        if type(hiddens[0]) == tuple:
+            return tuple(self.concat_hidden(list(h)) for h in zip(*hiddens))
+        else:
+            return torch.cat(hiddens,dim=1)
+
+    def select_hidden(self,h,idx):
+        """Selects the batch entries idx of a hidden state."""
+        if type(h) == tuple:
+            return tuple(self.select_hidden(v,idx) for v in h)
+        else:
+            return h.index_select(1,idx)
 
-        torch.save(state, checkpoint)
-        if is_best:
-            model_best_dir = Path('save',args.data,'model_best')
-            model_best_dir.mkdir(parents=True,exist_ok=True)
+    def assign_hidden(self,h,idx,value):
+        """Overwrites the batch entries idx of a hidden state in place."""
+        if type(h) == tuple:
+            for v,v_ in zip(h,value):
+                self.assign_hidden(v,idx,v_)
+        else:
+            h.index_copy_(1,idx,value)
 
-            shutil.copyfile(checkpoint, model_best_dir.joinpath(args.filename).with_suffix('.pth'))
+    def save_checkpoint(self,state, is_best, writer=None):
+        """Saves the checkpoint to save/<data>/checkpoint, and links it into save/<data>/model_best if is_best.
+        :param writer: CheckpointWriter writing it in the background (by default it is written before returning)
+        """
+        print("=> saving checkpoint ..")
+        args = state['args']
+        checkpoint = Path('save',args.data,'checkpoint',args.filename).with_suffix('.pth')
+        best = Path('save',args.data,'model_best',args.filename).with_suffix('.pth') if is_best else None
 
-        print('=> checkpoint saved.')
+        if writer is None:
+            write_checkpoint(state, checkpoint, best, keep=getattr(args, 'keep_checkpoints', 1))
+            print('=> checkpoint saved.')
+        else:
+            writer.save(state, checkpoint, best)
+            print('=> checkpoint queued.')
 
     def extract_hidden(self, hidden):
         if self.rnn_type == 'LSTM':
-            return hidden[0][-1].data.cpu()  # hidden state last layer (hidden[1] is cell state)
+            return hidden[0][-1].data.float().cpu()  # hidden state last layer (hidden[1] is cell state)
         else:
-            return hidden[-1].data.cpu()  # last layer
+            return hidden[-1].data.float().cpu()  # last layer
 
     def initialize(self,args,feature_dim):
         self.__init__(rnn_type = args.model,
@@ -136,6 +248,12 @@ class RNNPredictor(nn.Module):
         args_.epochs = args.epochs
         args_.save_interval = args.save_interval
         args_.prediction_window_size=args.prediction_window_size
+        args_.rollout_batch_size=args.rollout_batch_size
+        args_.rollout=args.rollout
+        args_.keep_checkpoints=args.keep_checkpoints
+        args_.eval_interval=args.eval_interval
+        args_.distributed=args.distributed
+        args_.precision=args.precision
         self.initialize(args_, feature_dim=feature_dim)
         self.load_state_dict(checkpoint['state_dict'])
 
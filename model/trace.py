@@ -0,0 +1,95 @@
+"""Trace of a trained predictor on its train series: the hidden states and the prediction errors of every timestep
+
+The trace is written when the gaussian error model is fitted (train.py) and read by predict.py instead of running the
+predictor on the train series again, e.g. to fit the score baseline of --compensate. The anomaly scores of the train
+series are recomputed from the errors, so the trace stays valid when the gaussian is updated (update_gaussian.py).
+
+It is saved as two .npy files in save/<data>/trace/<filename>/<key>/, memory-mapped when read, where the key is a
+hash of the weights of the predictor, the prediction window size and the train series. Only the latest trace of a
+file is kept.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+from pathlib import Path
+
+
+def trace_key(state_dict, window, dataset):
+    """
+    :param state_dict: weights of the predictor
+    :param window: prediction window size
+    :param dataset: train series [ seq_len * 1 * feature_size ]
+    """
+    digest = hashlib.sha256()
+    for name, tensor in sorted(state_dict.items()):
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    digest.update(str(window).encode())
+    digest.update(dataset.cpu().float().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:32]
+
+
+def trace_path(data, filename, key):
+    return Path('save', data, 'trace', Path(filename).stem, key)
+
+
+class TraceWriter(object):
+    """Writes a trace chunk by chunk into memory-mapped .npy files; they appear at `path` once `close` is called."""
+
+    def __init__(self, path, seq_len, hidden_size, channels, window):
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + '.{}.tmp'.format(os.getpid()))
+        self.tmp.mkdir(parents=True, exist_ok=True)
+        self.hiddens = np.lib.format.open_memmap(str(self.tmp / 'hiddens.npy'), mode='w+', dtype=np.float32,
+                                                 shape=(seq_len, hidden_size))
+        self.errors = np.lib.format.open_memmap(str(self.tmp / 'errors.npy'), mode='w+', dtype=np.float32,
+                                                shape=(channels, seq_len, window))
+        self.written = 0
+
+    def write(self, start, end, errors, hiddens):
+        """
+        :param errors: [ channels * (end - start) * window ]
+        :param hiddens: [ (end - start) * hidden_size ]
+        """
+        self.errors[:, start:end] = errors.float().cpu().numpy()
+        self.hiddens[start:end] = hiddens.float().cpu().numpy()
+        self.written = max(self.written, end)
+
+    def close(self):
+        if self.written != len(self.hiddens):
+            raise ValueError('Incomplete trace: {} of {} timesteps written'.format(self.written, len(self.hiddens)))
+        self.hiddens.flush()
+        self.errors.flush()
+        del self.hiddens, self.errors
+        with open(str(self.tmp / 'meta.json'), 'w') as f:
+            json.dump({'key': self.path.name}, f)
+        # The older traces of the file are stale
+        for path in self.path.parent.iterdir():
+            if path != self.tmp and not path.name.endswith('.tmp'):
+                shutil.rmtree(str(path), ignore_errors=True)
+        os.replace(str(self.tmp), str(self.path))
+
+
+def save_trace(path, errors, hiddens):
+    """Writes a whole trace at once (errors [ channels * seq_len * window ], hiddens [ seq_len * hidden_size ])."""
+    writer = TraceWriter(path, len(hiddens), hiddens.size(-1), errors.size(0), errors.size(-1))
+    writer.write(0, len(hiddens), errors, hiddens)
+    writer.close()
+
+
+def load_trace(path):
+    """
+    :return: errors [ channels * seq_len * window ], hiddens [ seq_len * hidden_size ] (memory-mapped, on the cpu),
+             or None if there is no trace at path
+    """
+    path = Path(path)
+    if not (path / 'meta.json').exists():
+        return None
+    # Copy-on-write, so that the tensors are writable but the files are never modified
+    errors = torch.from_numpy(np.load(str(path / 'errors.npy'), mmap_mode='c'))
+    hiddens = torch.from_numpy(np.load(str(path / 'hiddens.npy'), mmap_mode='c'))
+    return errors, hiddens
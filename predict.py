@@ -1,21 +1,29 @@
 import argparse
+import time
 import torch
 import pickle
 import preprocess_data
 from torch import optim
 from pathlib import Path
 from matplotlib import pyplot as plt
-import numpy as np
-from sklearn.svm import SVR
-from sklearn.model_selection import GridSearchCV
-from anomalyDetector import fit_norm_distribution_param
-from anomalyDetector import anomalyScore
+from anomalyDetector import fit_norm_distribution_param_multichannel
+from anomalyDetector import anomalyScore_multichannel
+from anomalyDetector import cholesky_factor, gaussian_score
 from anomalyDetector import get_precision_recall
+from scoreBaseline import baselines, make_baseline
 
-def main():
-    """Run inference.""" 
+def main(argv=None):
+    """Run inference.
+
+    :param argv: command line arguments (default: sys.argv[1:])
+    :return: evaluation of every channel, [ {'channel', 'f_beta', 'precision', 'recall', 'threshold', ...} ],
+             with the compensated results under the 'compensated_' keys, and the timing of the run under 'time_'
+    """
 
     from model import model   
+    from model.bundle import load_bundle, bundle_path
+    from model.trace import load_trace, save_trace, trace_key, trace_path
+    from model.metrics import Metrics
 
     parser = argparse.ArgumentParser(description='PyTorch RNN Anomaly Detection Model')
     parser.add_argument('--prediction_window_size', type=int, default=10,
@@ -28,25 +36,61 @@ def main():
                         help='save results as figures')
     parser.add_argument('--compensate', action='store_true',
                         help='compensate anomaly score using anomaly score esimation')
+    parser.add_argument('--compensate_model', type=str, default='rff', choices=sorted(baselines),
+                        help='regressor of the anomaly scores used by --compensate: random Fourier features + ridge '
+                             '(rff), small MLP (mlp), or the original grid-searched kernel SVR (svr, slow)')
     parser.add_argument('--beta', type=float, default=1.0,
                         help='beta value for f-beta score')
     parser.add_argument('--device', type=str, default='cuda',
                         help='cuda or cpu')
+    parser.add_argument('--rollout_batch_size', type=int, default=1024,
+                        help='number of starting points rolled out together when scoring')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='precision of the model (autocast); the gaussian scoring is always done in float64')
+    parser.add_argument('--score_chunk_len', type=int, default=0,
+                        help='score long series in independent chunks of this many timesteps, predicted together '
+                             '(approximate, see --burn_in; 0: exact sequential scoring)')
+    parser.add_argument('--burn_in', type=int, default=1000,
+                        help='number of timesteps the hidden state of a chunk is warmed up on (at least '
+                             'prediction_window_size)')
+    parser.add_argument('--score_workers', type=int, default=0,
+                        help='number of processes the chunks are split between (0: one batch in this process)')
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help='cache the prepared series in dataset/<data>/cache, up to this size (MiB) (default 0: '
+                             'no cache)')
+    parser.add_argument('--bundle', action='store_true',
+                        help='load the inference bundle (save/<data>/bundle/<filename>.safetensors) written by '
+                             'train.py instead of the full checkpoint')
+    parser.add_argument('--metrics', type=str, default=None, metavar='PATH',
+                        help='write timers, throughputs and peak memory to PATH at the end of the run (JSON lines, '
+                             'or a Prometheus textfile if PATH ends with .prom; see model/metrics.py)')
 
-    args_ = parser.parse_args()
+    args_ = parser.parse_args(argv)
+    start_time = time.time()
+    metrics = Metrics(args_.metrics, device=args_.device,
+                      labels={'script': 'predict', 'data': args_.data, 'filename': args_.filename})
     print('-' * 89)
     print("=> loading checkpoint ")
-    if args_.device == 'cpu':
-        checkpoint = torch.load(str(Path('save',args_.data,'checkpoint',args_.filename).with_suffix('.pth')),
-                                map_location=torch.device('cpu'))
-    else:
-        checkpoint = torch.load(str(Path('save',args_.data,'checkpoint',args_.filename).with_suffix('.pth')))
-    args = checkpoint['args']
+    with metrics.timer('checkpoint_load'):
+        if args_.bundle:
+            checkpoint = load_bundle(bundle_path(args_.data, args_.filename), device=args_.device)
+            args = argparse.Namespace(**checkpoint['config'])
+        else:
+            # The checkpoint holds the training args (an argparse.Namespace), which the weights-only loader rejects
+            checkpoint = torch.load(str(Path('save',args_.data,'checkpoint',args_.filename).with_suffix('.pth')),
+                                    map_location=torch.device(args_.device), weights_only=False)
+            args = checkpoint['args']
     args.prediction_window_size= args_.prediction_window_size
     args.beta = args_.beta
     args.save_fig = args_.save_fig
     args.compensate = args_.compensate
+    args.compensate_model = args_.compensate_model
     args.device = args_.device
+    args.rollout_batch_size = args_.rollout_batch_size
+    args.score_chunk_len = args_.score_chunk_len
+    args.burn_in = args_.burn_in
+    args.score_workers = args_.score_workers
+    args.inference_precision = args_.precision
     print("=> loaded checkpoint")
 
     # Set the random seed manually for reproducibility.
@@ -56,9 +100,12 @@ def main():
     ###############################################################################
     # Load data
     ###############################################################################
-    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data,filename=args.filename, augment_test_data=False)
-    train_dataset = TimeseriesData.batchify(args,TimeseriesData.trainData[:TimeseriesData.length], bsz=1)
-    test_dataset = TimeseriesData.batchify(args,TimeseriesData.testData, bsz=1)
+    with metrics.timer('data_loading'):
+        TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data,filename=args.filename,
+                                                        augment_test_data=False, augment_train_data=False,
+                                                        cache_size=args_.cache_size * 2**20)
+        train_dataset = TimeseriesData.batchify(args,TimeseriesData.trainData[:TimeseriesData.length], bsz=1)
+        test_dataset = TimeseriesData.batchify(args,TimeseriesData.testData, bsz=1)
 
     ###############################################################################
     # Build the model
@@ -75,53 +122,92 @@ def main():
 
     scores, predicted_scores, precisions, recalls, f_betas = list(), list(), list(), list(), list()
     targets, mean_predictions, oneStep_predictions, Nstep_predictions = list(), list(), list(), list()
+    results = list()
+    load_time = time.time() - start_time
+    score_start_time = time.time()
+    score_time = None
     try:
+        ''' 1. Load mean and covariance if they are pre-calculated, if not calculate them. '''
+        # Mean and covariance are calculated on train dataset.
+        if 'means' in checkpoint.keys() and 'covs' in checkpoint.keys():
+            print('=> loading pre-calculated mean and covariance')
+            means = torch.stack(list(checkpoint['means'])).to(args.device)
+            covs = torch.stack(list(checkpoint['covs'])).to(args.device)
+        else:
+            print('=> calculating mean and covariance')
+            with metrics.timer('gaussian_fit', points=len(train_dataset)):
+                means, covs = fit_norm_distribution_param_multichannel(args, model, train_dataset)
+        if 'chols' in checkpoint.keys():
+            chols = torch.stack(list(checkpoint['chols'])).to(args.device)
+        else:
+            chols = cholesky_factor(covs)
+
+        ''' 2. Train anomaly score predictor (score baseline, see scoreBaseline.py). (Optional) '''
+        # An anomaly score predictor is trained
+        # given hidden layer output and the corresponding anomaly score on train dataset.
+        # Predicted anomaly scores on test dataset can be used for the baseline of the adaptive threshold.
+        if args.compensate:
+            print('=> training an anomaly score predictor ({})'.format(args.compensate_model))
+            # The hidden states and errors of the train series are read from its trace if train.py (or an earlier
+            # run) saved it for this model, and saved otherwise
+            path = trace_path(args.data, args.filename,
+                              trace_key(model.state_dict(), args.prediction_window_size, train_dataset))
+            with metrics.timer('train_scoring', points=len(train_dataset)):
+                trace = load_trace(path)
+                if trace is not None:
+                    print('=> loaded the trace of the train dataset')
+                    train_errors, hiddens = trace
+                    train_scores = gaussian_score(train_errors.to(args.device), means, chols)
+                else:
+                    train_scores, _, train_errors, hiddens, _ = anomalyScore_multichannel(args, model, train_dataset,
+                                                                                          means, covs, chols=chols)
+                    if not args.score_chunk_len:
+                        save_trace(path, train_errors, hiddens)
+            with metrics.timer('score_baseline_fit', points=len(train_dataset)):
+                score_baseline = make_baseline(args.compensate_model, seed=args.seed).fit(hiddens, train_scores)
+        else:
+            score_baseline=None
+
+        ''' 3. Calculate anomaly scores'''
+        # Anomaly scores are calculated on the test dataset
+        # given the mean and the covariance calculated on the train dataset
+        print('=> calculating anomaly scores')
+        with metrics.timer('scoring', points=len(test_dataset)):
+            channel_scores, sorted_predictions, sorted_errors, _, channel_predicted_scores = \
+                anomalyScore_multichannel(args, model, test_dataset, means, covs, score_baseline=score_baseline,
+                                          chols=chols)
+
+        score_time = time.time() - score_start_time
+
         # For each channel in the dataset
         for channel_idx in range(nfeatures):
-            ''' 1. Load mean and covariance if they are pre-calculated, if not calculate them. '''
-            # Mean and covariance are calculated on train dataset.
-            if 'means' in checkpoint.keys() and 'covs' in checkpoint.keys():
-                print('=> loading pre-calculated mean and covariance')
-                mean, cov = checkpoint['means'][channel_idx], checkpoint['covs'][channel_idx]
-            else:
-                print('=> calculating mean and covariance')
-                mean, cov = fit_norm_distribution_param(args, model, train_dataset, channel_idx=channel_idx)
-
-            ''' 2. Train anomaly score predictor using support vector regression (SVR). (Optional) '''
-            # An anomaly score predictor is trained
-            # given hidden layer output and the corresponding anomaly score on train dataset.
-            # Predicted anomaly scores on test dataset can be used for the baseline of the adaptive threshold.
-            if args.compensate:
-                print('=> training an SVR as anomaly score predictor')
-                train_score, _, _, hiddens, _ = anomalyScore(args, model, train_dataset, mean, cov, channel_idx=channel_idx)
-                score_predictor = GridSearchCV(SVR(), cv=5,param_grid={"C": [1e0, 1e1, 1e2],"gamma": np.logspace(-1, 1, 3)})
-                score_predictor.fit(torch.cat(hiddens,dim=0).numpy(), train_score.cpu().numpy())
-            else:
-                score_predictor=None
-
-            ''' 3. Calculate anomaly scores'''
-            # Anomaly scores are calculated on the test dataset
-            # given the mean and the covariance calculated on the train dataset
-            print('=> calculating anomaly scores')
-            score, sorted_prediction, sorted_error, _, predicted_score = anomalyScore(args, model, test_dataset, mean, cov,
-                                                                                    score_predictor=score_predictor,
-                                                                                    channel_idx=channel_idx)
+            score, sorted_prediction, sorted_error = \
+                channel_scores[channel_idx], sorted_predictions[channel_idx], sorted_errors[channel_idx]
+            predicted_score = channel_predicted_scores[channel_idx] if args.compensate else channel_predicted_scores
 
             ''' 4. Evaluate the result '''
             # The obtained anomaly scores are evaluated by measuring precision, recall, and f_beta scores
             # The precision, recall, f_beta scores are are calculated repeatedly,
             # sampling the threshold from 1 to the maximum anomaly score value, either equidistantly or logarithmically.
             print('=> calculating precision, recall, and f_beta')
-            precision, recall, f_beta = get_precision_recall(args, score, num_samples=1000, beta=args.beta,
-                                                            label=TimeseriesData.testLabel.to(args.device))
+            with metrics.timer('threshold_sweep'):
+                precision, recall, f_beta, th = get_precision_recall(args, score, num_samples=1000, beta=args.beta,
+                                                                label=TimeseriesData.testLabel.to(args.device))
             print('data: ',args.data,' filename: ',args.filename,
                 ' f-beta (no compensation): ', f_beta.max().item(),' beta: ',args.beta)
+            result = {'channel': channel_idx}
+            result.update(best_f_beta(precision, recall, f_beta, th))
             if args.compensate:
-                precision, recall, f_beta = get_precision_recall(args, score, num_samples=1000, beta=args.beta,
-                                                                label=TimeseriesData.testLabel.to(args.device),
-                                                                predicted_score=predicted_score)
+                with metrics.timer('threshold_sweep'):
+                    precision, recall, f_beta, th = get_precision_recall(args, score, num_samples=1000,
+                                                                         beta=args.beta,
+                                                                         label=TimeseriesData.testLabel.to(args.device),
+                                                                         predicted_score=predicted_score)
                 print('data: ',args.data,' filename: ',args.filename,
                     ' f-beta    (compensation): ', f_beta.max().item(),' beta: ',args.beta)
+                result.update({'compensated_' + key: value
+                               for key, value in best_f_beta(precision, recall, f_beta, th).items()})
+            results.append(result)
 
 
             target = preprocess_data.reconstruct(test_dataset.cpu()[:, 0, channel_idx],
@@ -147,46 +233,48 @@ def main():
 
 
             if args.save_fig:
-                save_dir = Path('result',args.data,args.filename).with_suffix('').joinpath('fig_detection')
-                save_dir.mkdir(parents=True,exist_ok=True)
-                plt.plot(precision.cpu().numpy(),label='precision')
-                plt.plot(recall.cpu().numpy(),label='recall')
-                plt.plot(f_beta.cpu().numpy(), label='f1')
-                plt.legend()
-                plt.xlabel('Threshold (log scale)')
-                plt.ylabel('Value')
-                plt.title('Anomaly Detection on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
-                plt.savefig(str(save_dir.joinpath('fig_f_beta_channel'+str(channel_idx)).with_suffix('.png')))
-                plt.close()
-
-
-                fig, ax1 = plt.subplots(figsize=(15,5))
-                ax1.plot(target,label='Target',
-                        color='black',  marker='.', linestyle='--', markersize=1, linewidth=0.5)
-                ax1.plot(mean_prediction, label='Mean predictions',
-                        color='purple', marker='.', linestyle='--', markersize=1, linewidth=0.5)
-                ax1.plot(oneStep_prediction, label='1-step predictions',
-                        color='green', marker='.', linestyle='--', markersize=1, linewidth=0.5)
-                ax1.plot(Nstep_prediction, label=str(args.prediction_window_size) + '-step predictions',
-                        color='blue', marker='.', linestyle='--', markersize=1, linewidth=0.5)
-                ax1.plot(sorted_errors_mean,label='Absolute mean prediction errors',
-                        color='orange', marker='.', linestyle='--', markersize=1, linewidth=1.0)
-                ax1.legend(loc='upper left')
-                ax1.set_ylabel('Value',fontsize=15)
-                ax1.set_xlabel('Index',fontsize=15)
-                ax2 = ax1.twinx()
-                ax2.plot(score.numpy().reshape(-1, 1), label='Anomaly scores from \nmultivariate normal distribution',
-                        color='red', marker='.', linestyle='--', markersize=1, linewidth=1)
-                if args.compensate:
-                    ax2.plot(predicted_score, label='Predicted anomaly scores from SVR',
-                            color='cyan', marker='.', linestyle='--', markersize=1, linewidth=1)
-                ax2.legend(loc='upper right')
-                ax2.set_ylabel('anomaly score',fontsize=15)
-                plt.title('Anomaly Detection on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
-                plt.tight_layout()
-                plt.xlim([0,len(test_dataset)])
-                plt.savefig(str(save_dir.joinpath('fig_scores_channel'+str(channel_idx)).with_suffix('.png')))
-                plt.close()
+                with metrics.timer('plotting'):
+                    save_dir = Path('result',args.data,args.filename).with_suffix('').joinpath('fig_detection')
+                    save_dir.mkdir(parents=True,exist_ok=True)
+                    plt.plot(precision.cpu().numpy(),label='precision')
+                    plt.plot(recall.cpu().numpy(),label='recall')
+                    plt.plot(f_beta.cpu().numpy(), label='f1')
+                    plt.legend()
+                    plt.xlabel('Threshold (log scale)')
+                    plt.ylabel('Value')
+                    plt.title('Anomaly Detection on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
+                    plt.savefig(str(save_dir.joinpath('fig_f_beta_channel'+str(channel_idx)).with_suffix('.png')))
+                    plt.close()
+
+
+                    fig, ax1 = plt.subplots(figsize=(15,5))
+                    ax1.plot(target,label='Target',
+                            color='black',  marker='.', linestyle='--', markersize=1, linewidth=0.5)
+                    ax1.plot(mean_prediction, label='Mean predictions',
+                            color='purple', marker='.', linestyle='--', markersize=1, linewidth=0.5)
+                    ax1.plot(oneStep_prediction, label='1-step predictions',
+                            color='green', marker='.', linestyle='--', markersize=1, linewidth=0.5)
+                    ax1.plot(Nstep_prediction, label=str(args.prediction_window_size) + '-step predictions',
+                            color='blue', marker='.', linestyle='--', markersize=1, linewidth=0.5)
+                    ax1.plot(sorted_errors_mean,label='Absolute mean prediction errors',
+                            color='orange', marker='.', linestyle='--', markersize=1, linewidth=1.0)
+                    ax1.legend(loc='upper left')
+                    ax1.set_ylabel('Value',fontsize=15)
+                    ax1.set_xlabel('Index',fontsize=15)
+                    ax2 = ax1.twinx()
+                    ax2.plot(score.numpy().reshape(-1, 1),
+                             label='Anomaly scores from \nmultivariate normal distribution',
+                             color='red', marker='.', linestyle='--', markersize=1, linewidth=1)
+                    if args.compensate:
+                        ax2.plot(predicted_score, label='Predicted anomaly scores ('+args.compensate_model+')',
+                                color='cyan', marker='.', linestyle='--', markersize=1, linewidth=1)
+                    ax2.legend(loc='upper right')
+                    ax2.set_ylabel('anomaly score',fontsize=15)
+                    plt.title('Anomaly Detection on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
+                    plt.tight_layout()
+                    plt.xlim([0,len(test_dataset)])
+                    plt.savefig(str(save_dir.joinpath('fig_scores_channel'+str(channel_idx)).with_suffix('.png')))
+                    plt.close()
 
     except KeyboardInterrupt:
         print('-' * 89)
@@ -207,5 +295,20 @@ def main():
     pickle.dump(f_betas, open(str(save_dir.joinpath('f_beta.pkl')),'wb'))
     print('-' * 89)
 
+    total_time = time.time() - start_time
+    for result in results:
+        result.update({'time_load': load_time, 'time_score': score_time, 'time_total': total_time})
+    metrics.emit('end', time_load=load_time, time_score=score_time, time_total=total_time)
+    return results
+
+
+def best_f_beta(precision, recall, f_beta, th):
+    """ The precision, recall and threshold at which the f_beta score is the highest. """
+    if len(f_beta) == 0:
+        return {'f_beta': 0.0, 'precision': 0.0, 'recall': 0.0, 'threshold': float('nan')}
+    best = int(f_beta.argmax())
+    return {'f_beta': f_beta[best].item(), 'precision': precision[best].item(), 'recall': recall[best].item(),
+            'threshold': th[best].item()}
+
 if __name__ == '__main__':
     main()
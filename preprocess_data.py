@@ -7,6 +7,17 @@ import numpy as np
 import shutil
 from pathlib import Path
 import pickle
+import json
+import hashlib
+
+# Binary columnar format: magic, little-endian uint64 header length, JSON header, padding to a multiple of
+# COLUMNAR_ALIGNMENT bytes, then the series as a C-contiguous float32 array of the shape given in the header.
+COLUMNAR_SUFFIX = '.tsd'
+COLUMNAR_MAGIC = b'RNNTSD01'
+COLUMNAR_ALIGNMENT = 64
+
+# Version of the prepared tensors in dataset/<data>/cache, to be bumped when the preprocessing changes.
+CACHE_VERSION = 1
 
 def normalization(seqData,max,min):
     return (seqData -min)/(max-min)
@@ -17,9 +28,232 @@ def standardization(seqData,mean,std):
 def reconstruct(seqData,mean,std):
     return seqData*std+mean
 
+def save_columnar(path, data, label, channel_names=None):
+    """ Save a labeled series [ seq_len * feature_size ] in the binary columnar format.
+    The label is stored as the last column, and the mean/std of the channels are precomputed in the header. """
+    data = np.asarray(data, dtype=np.float32)
+    label = np.asarray(label, dtype=np.float32).reshape(-1, 1)
+    array = np.ascontiguousarray(np.concatenate([data, label], axis=1))
+    if channel_names is None:
+        channel_names = ['channel'+str(i) for i in range(data.shape[1])]
+    header = {'shape': list(array.shape),
+              'dtype': 'float32',
+              'channel_names': list(channel_names),
+              'label_column': data.shape[1],
+              'mean': data.astype(np.float64).mean(axis=0).tolist(),
+              'std': data.astype(np.float64).std(axis=0, ddof=1).tolist()}
+    header = json.dumps(header).encode()
+    offset = len(COLUMNAR_MAGIC) + 8 + len(header)
+    header += b' ' * (-offset % COLUMNAR_ALIGNMENT)
+    with open(str(path), 'wb') as f:
+        f.write(COLUMNAR_MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        f.write(array.tobytes())
+
+def load_columnar(path):
+    """ Memory-map a series saved by save_columnar and wrap it as a tensor without copying it.
+    :return: series [ seq_len * (feature_size + 1) ] (the label is the last column), header """
+    with open(str(path), 'rb') as f:
+        if f.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(str(path) + ' is not a columnar time-series file')
+        header_length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(header_length))
+    offset = len(COLUMNAR_MAGIC) + 8 + header_length
+    # Copy-on-write: the series can be modified in memory without touching the file.
+    array = np.memmap(str(path), dtype=header['dtype'], mode='c', offset=offset, shape=tuple(header['shape']))
+    return torch.from_numpy(array), header
+
+def columnar_source(path):
+    """ The columnar file next to the pickle at path (same name, COLUMNAR_SUFFIX), None if there is none.
+    A columnar file older than its pickle (e.g. the pickle was regenerated after the conversion) is rebuilt from the
+    pickle, keeping its channel names, so that it never shadows newer data. """
+    columnar = path.with_suffix(COLUMNAR_SUFFIX)
+    if not columnar.exists():
+        return None
+    if path.exists() and path.stat().st_mtime > columnar.stat().st_mtime:
+        with open(str(path), 'rb') as f:
+            series = np.asarray(pickle.load(f), dtype=np.float32)
+        try:
+            channel_names = load_columnar(columnar)[1]['channel_names']
+        except (ValueError, KeyError):
+            channel_names = None
+        if channel_names is not None and len(channel_names) != series.shape[1] - 1:
+            channel_names = None
+        # Written aside and renamed, as other processes may be reading it
+        tmp = columnar.with_name('{}.{}.tmp'.format(columnar.name, os.getpid()))
+        save_columnar(tmp, series[:, :-1], series[:, -1], channel_names=channel_names)
+        os.replace(str(tmp), str(columnar))
+    return columnar
+
+class AugmentedSeries(object):
+    """ Lazy, standardised equivalent of PickleDataLoad.augmentation: the series followed by noisy replicas of it.
+    The replicas are never held in memory. The noise of a point is generated when the point is accessed, from a seed
+    derived from the replica and the block of points it belongs to, so every access returns the same values.
+    Unlike the eager version, every replica gets its own noise. """
+
+    block_size = 256
+
+    def __init__(self, data, label, mean, std, noise_ratio=0.05, noise_interval=0.0005, max_length=100000, seed=0):
+        self.data = data
+        self.labels = label
+        self.mean = mean
+        self.std = std
+        self.noise_ratio = noise_ratio
+        self.seed = seed
+        nreplicas = len(np.arange(0, noise_ratio, noise_interval))
+        self.length = len(data) if nreplicas == 0 else min(len(data) * (1 + nreplicas), max_length)
+
+    def __len__(self):
+        return self.length
+
+    def size(self, dim=None):
+        size = torch.Size([self.length, self.data.size(1)])
+        return size if dim is None else size[dim]
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.take(torch.arange(self.length)[idx])
+        return self.take(torch.tensor([idx]).remainder(self.length))[0]
+
+    @property
+    def label(self):
+        """ The labels of the whole augmented series (materialised). """
+        return self.labels[torch.arange(self.length) % len(self.data)]
+
+    def take(self, idx):
+        """ Standardised values of the points idx [ n ] of the augmented series: [ n * feature_size ] """
+        replica = idx // len(self.data)
+        offset = idx % len(self.data)
+        values = self.data[offset]
+        noise = torch.zeros_like(values)
+        block = offset // self.block_size
+        noisy = replica > 0
+        for replica_, block_ in torch.stack([replica[noisy], block[noisy]], dim=1).unique(dim=0).tolist():
+            generator = torch.Generator().manual_seed(((self.seed * 1000003 + replica_) * 1000003 + block_) % 2**63)
+            block_noise = torch.randn(self.block_size, values.size(1), generator=generator)
+            points = noisy & (replica == replica_) & (block == block_)
+            noise[points] = block_noise[offset[points] - block_ * self.block_size]
+        values = values + self.noise_ratio * self.std * noise
+        return standardization(values, self.mean, self.std)
+
+
+class BatchedSeries(object):
+    """ Lazy equivalent of PickleDataLoad.batchify for an AugmentedSeries: [ nbatch * bsz * feature_size ],
+    where only the rows accessed with [] are generated and moved to the device. """
+
+    def __init__(self, series, bsz, device, columns=None):
+        """ :param columns: the batch columns kept (default: all) """
+        self.series = series
+        self.bsz = bsz
+        self.nbatch = len(series) // bsz
+        self.device = device
+        self.columns = torch.arange(bsz) if columns is None else columns
+
+    def __len__(self):
+        return self.nbatch
+
+    def size(self, dim=None):
+        size = torch.Size([self.nbatch, len(self.columns), self.series.size(1)])
+        return size if dim is None else size[dim]
+
+    def select_columns(self, columns):
+        """ The batch columns columns of this batched series, as a BatchedSeries. """
+        return BatchedSeries(self.series, self.bsz, self.device, self.columns[columns])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            rows = torch.arange(self.nbatch)[idx]
+        else:
+            rows = torch.tensor([idx]).remainder(self.nbatch)
+        # Column b of the batched series is the b-th contiguous part of the series.
+        points = rows.unsqueeze(1) + self.nbatch * self.columns.unsqueeze(0)
+        batch = self.series.take(points.view(-1)).view(len(rows), len(self.columns), -1).to(self.device)
+        return batch if isinstance(idx, slice) else batch[0]
+
+    def cpu(self):
+        """ The whole batched series (materialised). """
+        return self[:].cpu()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """ sha256 of the content of a file. """
+    digest = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetCache(object):
+    """ On-disk cache of prepared tensors, bounded in size with least recently used eviction.
+    An entry is a dict of tensors saved with torch.save as <root>/<key>.pt; the modification time of the file is its
+    last use. Entries are written atomically, so several processes can share the cache. """
+
+    def __init__(self, root, max_bytes):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return self.root / (key + '.pt')
+
+    def get(self, key):
+        """ The entry of key (memory-mapped), or None. """
+        path = self.path(key)
+        try:
+            entry = torch.load(str(path), map_location='cpu', weights_only=True, mmap=True)
+            os.utime(str(path))
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Unreadable entry, e.g. written by another version of torch: recomputed
+            self.remove(path)
+            return None
+        return entry
+
+    def put(self, key, entry):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_name('{}.{}.tmp'.format(path.name, os.getpid()))
+        torch.save(entry, str(tmp))
+        os.replace(str(tmp), str(path))
+        self.evict()
+
+    def remove(self, path):
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """ Removes the least recently used entries until the cache fits in max_bytes. """
+        entries = []
+        for path in self.root.glob('*.pt'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+
 class PickleDataLoad(object):
-    def __init__(self, data_type, filename, augment_test_data=True):
+    def __init__(self, data_type, filename, augment_test_data=True, lazy_augment=False, augment_train_data=True,
+                 cache_size=None):
+        """ :param lazy_augment: keep the augmented series as AugmentedSeries views instead of materialising them
+        :param augment_train_data: augment the train series (the mean/std are the same either way, so scoring only
+        needs the un-augmented series)
+        :param cache_size: size bound in bytes of the cache of prepared series in dataset/<data_type>/cache
+        (default: no cache) """
+        self.augment_train_data=augment_train_data
         self.augment_test_data=augment_test_data
+        self.lazy_augment=lazy_augment
+        self.cache = DatasetCache(Path('dataset',data_type,'cache'), cache_size) if cache_size else None
         self.trainData, self.trainLabel = self.preprocessing(Path('dataset',data_type,'labeled','train',filename),train=True)
         self.testData, self.testLabel = self.preprocessing(Path('dataset',data_type,'labeled','test',filename),train=False)
 
@@ -38,20 +272,81 @@ class PickleDataLoad(object):
 
         return augmentedData, augmentedLabel
 
+    def lazy_augmentation(self,data,label):
+        # The seed is drawn from the global generator, so that it follows torch.manual_seed.
+        seed = int(torch.randint(2**31, (1,)))
+        augmentedData = AugmentedSeries(data,label,self.mean,self.std,seed=seed)
+        return augmentedData, augmentedData.label
+
     def preprocessing(self, path, train=True):
-        """ Read, Standardize, Augment """
+        """ Read, Standardize, Augment
+        The series is read from the columnar file next to the pickle (same name, COLUMNAR_SUFFIX) if there is one,
+        rebuilt first if it is older than the pickle (see columnar_source).
+        With a cache, the result is looked up by the content of that file and the preprocessing parameters: the random
+        state of torch is part of the key of an augmented series, and it is left as if the series had been augmented. """
 
-        with open(str(path), 'rb') as f:
-            data = torch.FloatTensor(pickle.load(f))
-            label = data[:,-1]
-            data = data[:,:-1]
+        if self.cache is None:
+            return self.prepare(path, train)
+
+        augment = self.augment_train_data if train else self.augment_test_data
+        lazy = augment and self.lazy_augment
+        eager = augment and not self.lazy_augment
+        source = columnar_source(path) or path
+        key = {'version': CACHE_VERSION, 'source': file_hash(source), 'train': train, 'augment': eager, 'lazy': lazy}
+        if not train:
+            key['mean'], key['std'] = self.mean.tolist(), self.std.tolist()
+        if eager:
+            key['random_state'] = hashlib.sha256(torch.get_rng_state().numpy().tobytes()).hexdigest()
+        key = hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+        entry = self.cache.get(key)
+        if entry is not None:
+            if train:
+                self.mean, self.std, self.length = entry['mean'], entry['std'], int(entry['length'])
+            if lazy:
+                return self.lazy_augmentation(entry['data'], entry['label'])
+            if eager:
+                torch.set_rng_state(entry['random_state'])
+            return entry['data'], entry['label']
+
+        data, label = self.prepare(path, train)
+        # A lazily augmented series is stored as its raw series, the augmentation itself costs nothing.
+        # The tensors are cloned, as torch.save would store the whole series they may be views of.
+        entry = {'data': (data.data if lazy else data).clone(), 'label': (data.labels if lazy else label).clone(),
+                 'random_state': torch.get_rng_state()}
+        if train:
+            entry.update({'mean': self.mean.clone(), 'std': self.std.clone(), 'length': self.length})
+        self.cache.put(key, entry)
+        return data, label
+
+    def prepare(self, path, train=True):
+        header = None
+        columnar = columnar_source(path)
+        if columnar is not None:
+            series, header = load_columnar(columnar)
+            label = series[:,header['label_column']]
+            data = series[:,:header['label_column']]
+        else:
+            with open(str(path), 'rb') as f:
+                data = torch.FloatTensor(pickle.load(f))
+                label = data[:,-1]
+                data = data[:,:-1]
         if train:
-            self.mean = data.mean(dim=0)
-            self.std= data.std(dim=0)
+            if header is not None:
+                self.mean = torch.FloatTensor(header['mean'])
+                self.std = torch.FloatTensor(header['std'])
+            else:
+                self.mean = data.mean(dim=0)
+                self.std= data.std(dim=0)
             self.length = len(data)
-            data,label = self.augmentation(data,label)
+            if self.augment_train_data:
+                if self.lazy_augment:
+                    return self.lazy_augmentation(data,label)
+                data,label = self.augmentation(data,label)
         else:
             if self.augment_test_data:
+                if self.lazy_augment:
+                    return self.lazy_augmentation(data,label)
                 data, label = self.augmentation(data, label)
 
         data = standardization(data,self.mean,self.std)
@@ -59,6 +354,8 @@ class PickleDataLoad(object):
         return data,label
 
     def batchify(self,args,data, bsz):
+        if isinstance(data, AugmentedSeries):
+            return BatchedSeries(data, bsz, device(args.device))
         nbatch = data.size(0) // bsz
         trimmed_data = data.narrow(0,0,nbatch * bsz)
         batched_data = trimmed_data.contiguous().view(bsz, -1, trimmed_data.size(-1)).transpose(0,1)
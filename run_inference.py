@@ -1,25 +1,102 @@
-"""Runs inference on the specified dataset
+"""Runs inference on every file of the specified dataset in a pool of processes
+
+    python run_inference.py --data ecg --device cpu --workers 16 --threads 4 [-- <predict.py arguments>]
+
+Arguments after `--` are passed on to predict.py (e.g. `-- --compensate --beta 0.5`).
+The output of every run goes to result/<data>/<file>/inference_log.txt, and the best f-beta score, the precision,
+recall and threshold it is obtained at, and the timing of every channel of every file are gathered in
+result/<data>/inference_results.csv.
 """
 
-import sys
 import os
+import csv
 import glob
+import time
 import argparse
-from predict import main
+import contextlib
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from run_train import set_num_threads
+
+fieldnames = ['filename', 'channel', 'status', 'f_beta', 'precision', 'recall', 'threshold',
+              'compensated_f_beta', 'compensated_precision', 'compensated_recall', 'compensated_threshold',
+              'time_load', 'time_score', 'time_total']
+
+
+def predict_file(data, pkl, device, predict_args):
+    """Runs inference on one file, logging to its own file. Runs in a worker process."""
+    from predict import main
+
+    log_path = Path('result', data, Path(pkl).stem, 'inference_log.txt')
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+    with open(str(log_path), 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            results = main(['--data', data, '--filename', pkl, '--save_fig', '--device', device] + predict_args)
+            status = 'done'
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            results = [{'time_total': time.time() - start_time}]
+            status = 'failed'
+    for result in results:
+        result.update({'filename': pkl, 'status': status})
+    return results
+
+
+def main():
+    run_parser = argparse.ArgumentParser(description='Run inference')
+    run_parser.add_argument('--data', type=str, default='ecg',
+                            help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    run_parser.add_argument('--device', type=str, default='cuda',
+                            help='cuda or cpu')
+    run_parser.add_argument('--threads', type=int, default=1,
+                            help='number of torch threads of every worker')
+    run_parser.add_argument('--workers', type=int, default=None,
+                            help='number of files processed in parallel (default: number of CPUs / threads)')
+    run_parser.add_argument('predict_args', nargs=argparse.REMAINDER,
+                            help='arguments passed on to predict.py, after --')
+    run_args = run_parser.parse_args()
+    predict_args = run_args.predict_args[1:] if run_args.predict_args[:1] == ['--'] else run_args.predict_args
+    workers = run_args.workers or max(1, (os.cpu_count() or 1) // run_args.threads)
+
+    pkl_paths = sorted(glob.glob(os.path.join(f'dataset/{run_args.data}/labeled/test', '*.pkl')))
+    pkl_files = list(map(os.path.basename, pkl_paths))
 
+    start_time = time.time()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_num_threads,
+                             initargs=(run_args.threads,)) as executor:
+        futures = []
+        for pkl in pkl_files:
+            print(f'----- Running inference on {pkl} -----')
+            futures.append(executor.submit(predict_file, run_args.data, pkl, run_args.device, predict_args))
+        for future in as_completed(futures):
+            file_results = future.result()
+            print(f'----- {file_results[0]["filename"]}: {file_results[0]["status"]} in '
+                  f'{file_results[0]["time_total"]:.1f}s -----')
+            results.extend(file_results)
 
-run_parser = argparse.ArgumentParser(description='Run inference')
-run_parser.add_argument('--data', type=str, default='ecg',
-                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
-run_parser.add_argument('--device', type=str, default='cuda',
-                        help='cuda or cpu')
-run_args = run_parser.parse_args()
+    results.sort(key=lambda result: (result['filename'], result.get('channel', -1)))
+    results_path = Path('result', run_args.data, 'inference_results.csv')
+    results_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(results_path), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
 
+    print('-' * 89)
+    print(f'{"filename":<30} {"channel":>7} {"status":<8} {"f-beta":>8} {"precision":>10} {"recall":>8} '
+          f'{"time (s)":>9}')
+    for result in results:
+        if result['status'] != 'done':
+            print(f'{result["filename"]:<30} {"":>7} {result["status"]:<8}')
+            continue
+        print(f'{result["filename"]:<30} {result["channel"]:>7} {result["status"]:<8} {result["f_beta"]:>8.4f} '
+              f'{result["precision"]:>10.4f} {result["recall"]:>8.4f} {result["time_total"]:>9.1f}')
+    print('-' * 89)
+    print(f'=> {len(pkl_files)} files in {time.time() - start_time:.1f}s, results saved to {results_path}')
 
-pkl_paths = glob.glob(os.path.join(f'dataset/{run_args.data}/labeled/test', '*.pkl'))
-pkl_files = list(map(os.path.basename, pkl_paths))
 
-for pkl in pkl_files:
-    print(f'----- Running inference on {pkl} -----')
-    sys.argv.extend(['--data', run_args.data, '--filename', pkl, '--save_fig', '--device', run_args.device])
+if __name__ == '__main__':
     main()
@@ -1,25 +1,118 @@
-"""Runs training on the specified dataset
+"""Runs training on every file of the specified dataset, one model per file, in a pool of processes
+
+    python run_train.py --data ecg --device cpu --workers 16 --threads 4 [-- <train.py arguments>]
+
+Arguments after `--` are passed on to train.py (e.g. `-- --epochs 100 --batch_size 32`).
+Files whose checkpoint is newer than their data are skipped unless --force is given.
+The output of every run goes to result/<data>/<file>/train_log.txt, and a summary table with the wall time, number
+of epochs and best validation loss of every file is written to result/<data>/train_summary.csv.
 """
 
-import sys
 import os
+import csv
 import glob
+import time
 import argparse
-from train import main
+import contextlib
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def set_num_threads(threads):
+    """Initializer of the worker processes."""
+    import torch
+    torch.set_num_threads(threads)
+
+
+def is_up_to_date(data, pkl):
+    """Whether the checkpoint of a file is newer than the file (and its columnar copy)."""
+    checkpoint = Path('save', data, 'checkpoint', pkl).with_suffix('.pth')
+    if not checkpoint.exists():
+        return False
+    sources = [path for split in ['train', 'test'] for path in Path('dataset', data, 'labeled', split).glob(
+        Path(pkl).stem + '.*')]
+    return all(checkpoint.stat().st_mtime > source.stat().st_mtime for source in sources)
+
+
+def train_file(data, pkl, device, train_args):
+    """Trains the model of one file, logging to its own file. Runs in a worker process."""
+    from train import main
+
+    log_path = Path('result', data, Path(pkl).stem, 'train_log.txt')
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    start_time = time.time()
+    with open(str(log_path), 'w') as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            summary = main(['--data', data, '--filename', pkl, '--save_fig', '--device', device] + train_args)
+            status = 'trained'
+        except (Exception, SystemExit):
+            traceback.print_exc()
+            summary = {'epoch': None, 'best_val_loss': None}
+            status = 'failed'
+    return {'filename': pkl,
+            'status': status,
+            'wall_time': time.time() - start_time,
+            'epochs': summary['epoch'],
+            'best_val_loss': summary['best_val_loss']}
+
+
+def main():
+    run_parser = argparse.ArgumentParser(description='Run training')
+    run_parser.add_argument('--data', type=str, default='ecg',
+                            help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    run_parser.add_argument('--device', type=str, default='cuda',
+                            help='cuda or cpu')
+    run_parser.add_argument('--threads', type=int, default=1,
+                            help='number of torch threads of every worker')
+    run_parser.add_argument('--workers', type=int, default=None,
+                            help='number of files trained in parallel (default: number of CPUs / threads)')
+    run_parser.add_argument('--force', action='store_true',
+                            help='retrain the files whose checkpoint is newer than their data')
+    run_parser.add_argument('train_args', nargs=argparse.REMAINDER,
+                            help='arguments passed on to train.py, after --')
+    run_args = run_parser.parse_args()
+    train_args = run_args.train_args[1:] if run_args.train_args[:1] == ['--'] else run_args.train_args
+    workers = run_args.workers or max(1, (os.cpu_count() or 1) // run_args.threads)
+
+    pkl_paths = sorted(glob.glob(os.path.join(f'dataset/{run_args.data}/labeled/train', '*.pkl')))
+    pkl_files = list(map(os.path.basename, pkl_paths))
 
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_num_threads,
+                             initargs=(run_args.threads,)) as executor:
+        futures = []
+        for pkl in pkl_files:
+            if not run_args.force and is_up_to_date(run_args.data, pkl):
+                print(f'----- Skipping {pkl} (checkpoint is up to date) -----')
+                results.append({'filename': pkl, 'status': 'skipped', 'wall_time': 0.0,
+                                'epochs': None, 'best_val_loss': None})
+                continue
+            print(f'----- Training on {pkl} -----')
+            futures.append(executor.submit(train_file, run_args.data, pkl, run_args.device, train_args))
+        for future in as_completed(futures):
+            result = future.result()
+            print(f'----- {result["filename"]}: {result["status"]} in {result["wall_time"]:.1f}s -----')
+            results.append(result)
 
-run_parser = argparse.ArgumentParser(description='Run training')
-run_parser.add_argument('--data', type=str, default='ecg',
-                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
-run_parser.add_argument('--device', type=str, default='cuda',
-                        help='cuda or cpu')
-run_args = run_parser.parse_args()
+    results.sort(key=lambda result: result['filename'])
+    summary_path = Path('result', run_args.data, 'train_summary.csv')
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(str(summary_path), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['filename', 'status', 'wall_time', 'epochs', 'best_val_loss'])
+        writer.writeheader()
+        writer.writerows(results)
 
+    print('-' * 89)
+    print(f'{"filename":<30} {"status":<8} {"wall time (s)":>14} {"epochs":>7} {"best val loss":>14}')
+    for result in results:
+        epochs = '' if result['epochs'] is None else result['epochs']
+        best_val_loss = '' if result['best_val_loss'] is None else f'{result["best_val_loss"]:.4f}'
+        print(f'{result["filename"]:<30} {result["status"]:<8} {result["wall_time"]:>14.1f} {epochs:>7} '
+              f'{best_val_loss:>14}')
+    print('-' * 89)
+    print(f'=> summary saved to {summary_path}')
 
-pkl_paths = glob.glob(os.path.join(f'dataset/{run_args.data}/labeled/train', '*.pkl'))
-pkl_files = list(map(os.path.basename, pkl_paths))
 
-for pkl in pkl_files:
-    print(f'----- Training on {pkl} -----')
-    sys.argv.extend(['--data', run_args.data, '--filename', pkl, '--save_fig', '--device', run_args.device])
+if __name__ == '__main__':
     main()
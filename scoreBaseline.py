@@ -0,0 +1,212 @@
+"""Score baselines: regressors of the anomaly scores of the train series from the hidden states of the predictor
+
+The baseline predicted on the test series is subtracted from its anomaly scores (predict.py --compensate), as an
+adaptive threshold. Every backend is fitted on all the channels at once, in mini-batches of hidden states, and
+predicts all the hidden states in one call:
+
+    baseline = make_baseline('rff').fit(hiddens, scores)  # hiddens [ n * rnn_hid_size ], scores [ channels * n ]
+    predicted_scores = baseline.predict(hiddens)          # [ channels * n ]
+
+A new backend subclasses ScoreBaseline and is added to `baselines`.
+"""
+
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class ScoreBaseline(object):
+    """Base class of the backends: standardises the hidden states with the statistics of the train series."""
+
+    def __init__(self, batch_size=4096, seed=0):
+        """
+        :param batch_size: number of hidden states per mini-batch, when fitting and predicting
+        :param seed: seed of the random parts of the backend
+        """
+        self.batch_size = batch_size
+        self.seed = seed
+
+    def fit(self, hiddens, scores):
+        """
+        :param hiddens: [ n * rnn_hid_size ]
+        :param scores: anomaly scores of every channel [ channels * n ]
+        :return: self
+        """
+        hiddens = hiddens.float()
+        self.mean = hiddens.mean(dim=0)
+        self.std = hiddens.std(dim=0).clamp(min=1e-6)
+        self.fit_standardized(self.standardize(hiddens), scores.to(hiddens.device).float())
+        return self
+
+    def standardize(self, hiddens):
+        return (hiddens.float().to(self.mean.device) - self.mean) / self.std
+
+    def batches(self, n, shuffle=False, generator=None):
+        order = torch.randperm(n, generator=generator) if shuffle else torch.arange(n)
+        return order.split(self.batch_size)
+
+    def predict(self, hiddens):
+        """
+        :param hiddens: [ n * rnn_hid_size ]
+        :return: predicted anomaly scores [ channels * n ]
+        """
+        hiddens = self.standardize(hiddens)
+        with torch.no_grad():
+            return torch.cat([self.predict_standardized(hiddens[batch])
+                              for batch in self.batches(len(hiddens))], dim=1)
+
+    def fit_standardized(self, hiddens, scores):
+        raise NotImplementedError
+
+    def predict_standardized(self, hiddens):
+        raise NotImplementedError
+
+
+class RFFBaseline(ScoreBaseline):
+    """Ridge regression on random Fourier features, which approximate an RBF kernel exp(-gamma * |x - y|^2).
+
+    The normal equations are accumulated over the mini-batches and solved once, so fitting is linear in the number of
+    hidden states (and exact for the sampled features). Like the grid search of the SVR, the width of the kernel and
+    the penalty are chosen on a held-out part of the train series if they are not given.
+    """
+
+    gammas = [0.1, 1.0, 10.0] # times 1 / rnn_hid_size
+    alphas = [1e-3, 1e-1, 1e1]
+
+    def __init__(self, nfeatures=1024, gamma=None, alpha=None, holdout=0.2, **kwargs):
+        """
+        :param nfeatures: number of random features
+        :param gamma: width of the kernel, on the standardised hidden states
+        :param alpha: ridge penalty, relative to the mean squared norm of a random feature over the hidden states
+        :param holdout: share of the hidden states held out to choose gamma and alpha
+        """
+        super(RFFBaseline, self).__init__(**kwargs)
+        self.nfeatures = nfeatures
+        self.gamma = gamma
+        self.alpha = alpha
+        self.holdout = holdout
+
+    def features(self, hiddens):
+        return math.sqrt(2.0 / self.nfeatures) * torch.cos(hiddens @ self.weight + self.bias)
+
+    def sample_features(self, ninputs, gamma, device):
+        generator = torch.Generator().manual_seed(self.seed)
+        self.weight = (torch.randn(ninputs, self.nfeatures, generator=generator) * math.sqrt(2 * gamma)).to(device)
+        self.bias = (torch.rand(self.nfeatures, generator=generator) * 2 * math.pi).to(device)
+
+    def solve(self, hiddens, scores, alphas):
+        """Ridge coefficients [ nfeatures * channels ] and intercepts [ channels ] for every penalty in alphas."""
+        # Centred normal equations, so that the intercept is not penalised
+        gram = hiddens.new_zeros(self.nfeatures, self.nfeatures, dtype=torch.float64)
+        moment = hiddens.new_zeros(self.nfeatures, scores.size(0), dtype=torch.float64)
+        feature_sum = hiddens.new_zeros(self.nfeatures, dtype=torch.float64)
+        for batch in self.batches(len(hiddens)):
+            features = self.features(hiddens[batch]).double()
+            gram += features.t() @ features
+            moment += features.t() @ scores[:, batch].t().double()
+            feature_sum += features.sum(dim=0)
+        n = len(hiddens)
+        feature_mean = feature_sum / n
+        score_mean = scores.double().mean(dim=1)
+        gram -= n * torch.outer(feature_mean, feature_mean)
+        moment -= n * torch.outer(feature_mean, score_mean)
+        eye = torch.eye(self.nfeatures, dtype=torch.float64, device=gram.device)
+        solutions = []
+        for alpha in alphas:
+            coef = torch.linalg.solve(gram + alpha * n / self.nfeatures * eye, moment)
+            solutions.append((coef.float(), (score_mean - feature_mean @ coef).float()))
+        return solutions
+
+    def fit_standardized(self, hiddens, scores):
+        gammas = [self.gamma] if self.gamma is not None else [gamma / hiddens.size(1) for gamma in self.gammas]
+        alphas = [self.alpha] if self.alpha is not None else self.alphas
+        if len(gammas) * len(alphas) > 1:
+            generator = torch.Generator().manual_seed(self.seed)
+            order = torch.randperm(len(hiddens), generator=generator).to(hiddens.device)
+            nval = int(len(hiddens) * self.holdout)
+            val, train = order[:nval], order[nval:]
+            errors = {}
+            for gamma in gammas:
+                self.sample_features(hiddens.size(1), gamma, hiddens.device)
+                for alpha, (self.coef, self.intercept) in zip(alphas, self.solve(hiddens[train], scores[:, train],
+                                                                                 alphas)):
+                    predicted = torch.cat([self.predict_standardized(hiddens[val][batch])
+                                           for batch in self.batches(nval)], dim=1)
+                    errors[gamma, alpha] = (predicted - scores[:, val]).pow(2).mean().item()
+            gamma, alpha = min(errors, key=errors.get)
+        else:
+            gamma, alpha = gammas[0], alphas[0]
+        self.chosen_gamma, self.chosen_alpha = gamma, alpha
+        self.sample_features(hiddens.size(1), gamma, hiddens.device)
+        (self.coef, self.intercept), = self.solve(hiddens, scores, [alpha])
+
+    def predict_standardized(self, hiddens):
+        return (self.features(hiddens) @ self.coef + self.intercept).t()
+
+
+class MLPBaseline(ScoreBaseline):
+    """Small multilayer perceptron trained with Adam on shuffled mini-batches (on standardised scores)."""
+
+    def __init__(self, hidden_size=64, epochs=20, lr=1e-3, weight_decay=1e-4, batch_size=256, **kwargs):
+        super(MLPBaseline, self).__init__(batch_size=batch_size, **kwargs)
+        self.hidden_size = hidden_size
+        self.epochs = epochs
+        self.lr = lr
+        self.weight_decay = weight_decay
+
+    def fit_standardized(self, hiddens, scores):
+        generator = torch.Generator().manual_seed(self.seed)
+        self.score_mean = scores.mean(dim=1, keepdim=True)
+        self.score_std = scores.std(dim=1, keepdim=True).clamp(min=1e-6)
+        targets = ((scores - self.score_mean) / self.score_std).t() # [ n * channels ]
+        # Initialised from the seed, without touching the global random state
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(self.seed)
+            self.net = nn.Sequential(nn.Linear(hiddens.size(1), self.hidden_size), nn.ReLU(),
+                                     nn.Linear(self.hidden_size, self.hidden_size), nn.ReLU(),
+                                     nn.Linear(self.hidden_size, scores.size(0))).to(hiddens.device)
+        optimizer = torch.optim.Adam(self.net.parameters(), lr=self.lr, weight_decay=self.weight_decay)
+        self.net.train()
+        for epoch in range(self.epochs):
+            for batch in self.batches(len(hiddens), shuffle=True, generator=generator):
+                batch = batch.to(hiddens.device)
+                optimizer.zero_grad()
+                loss = (self.net(hiddens[batch]) - targets[batch]).pow(2).mean()
+                loss.backward()
+                optimizer.step()
+        self.net.eval()
+
+    def predict_standardized(self, hiddens):
+        return self.net(hiddens).t() * self.score_std + self.score_mean
+
+
+class SVRBaseline(ScoreBaseline):
+    """The original baseline: a kernel SVR per channel, with its parameters chosen by a 5-fold grid search.
+    Its cost grows quadratically to cubically with the number of hidden states, so it is only usable on short series."""
+
+    def fit_standardized(self, hiddens, scores):
+        from sklearn.svm import SVR
+        from sklearn.model_selection import GridSearchCV
+
+        self.predictors = []
+        for score in scores:
+            predictor = GridSearchCV(SVR(), cv=5, param_grid={"C": [1e0, 1e1, 1e2], "gamma": np.logspace(-1, 1, 3)})
+            predictor.fit(hiddens.cpu().numpy(), score.cpu().numpy())
+            self.predictors.append(predictor)
+
+    def standardize(self, hiddens):
+        # The grid of gamma was chosen for the raw hidden states
+        return hiddens.float()
+
+    def predict_standardized(self, hiddens):
+        return torch.stack([torch.from_numpy(predictor.predict(hiddens.cpu().numpy())).float()
+                            for predictor in self.predictors]).to(hiddens.device)
+
+
+baselines = {'rff': RFFBaseline, 'mlp': MLPBaseline, 'svr': SVRBaseline}
+
+
+def make_baseline(name, **kwargs):
+    """A score baseline backend of `baselines` by name."""
+    return baselines[name](**kwargs)
@@ -0,0 +1,101 @@
+"""Serves a trained anomaly detector to many independent streams over a local HTTP API
+
+    python serve_detector.py --data ecg --filename chfdb_chf13_45590.pkl --device cpu --port 8000
+
+POST /score           {"points": {"<stream id>": [x_0, ..., x_F-1], ...}}
+                      -> {"scores": {"<stream id>": [score of channel 0, ...], ...}}
+                      All the points of one request are scored in a single batched call; unknown streams join.
+GET /streams          -> {"streams": [...]}
+DELETE /streams/<id>  ends a stream and releases its slot
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from streamingDetector import MultiStreamDetector
+
+
+def make_handler(detector):
+    lock = threading.Lock()
+
+    class DetectorRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/streams':
+                with lock:
+                    self.send_json(200, {'streams': detector.stream_ids})
+            else:
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/score':
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                stream_ids = list(request['points'].keys())
+                points = [request['points'][stream_id] for stream_id in stream_ids]
+                with lock:
+                    scores = detector.score(stream_ids, points) if stream_ids else []
+            except (ValueError, KeyError, TypeError, RuntimeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+            self.send_json(200, {'scores': dict(zip(stream_ids, [score.tolist() for score in scores]))})
+
+        def do_DELETE(self):
+            prefix = '/streams/'
+            if not self.path.startswith(prefix):
+                self.send_json(404, {'error': 'unknown path ' + self.path})
+                return
+            stream_id = self.path[len(prefix):].rstrip('/')
+            with lock:
+                if stream_id not in detector.slots:
+                    self.send_json(404, {'error': 'unknown stream ' + stream_id})
+                    return
+                detector.remove_stream(stream_id)
+            self.send_json(200, {'removed': stream_id})
+
+    return DetectorRequestHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve an RNN anomaly detector to many streams')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='cuda or cpu')
+    parser.add_argument('--capacity', type=int, default=1024,
+                        help='number of stream slots allocated up front')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on')
+    args = parser.parse_args()
+
+    print("=> loading checkpoint ")
+    detector = MultiStreamDetector.from_checkpoint(args.data, args.filename, device=args.device,
+                                                   capacity=args.capacity)
+    print("=> loaded checkpoint")
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(detector))
+    print('=> serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('-' * 89)
+        print('Exiting from serving')
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
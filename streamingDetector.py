@@ -0,0 +1,176 @@
+import torch
+import preprocess_data
+from pathlib import Path
+from anomalyDetector import cholesky_factor, gaussian_score
+
+
+class MultiStreamDetector(object):
+    """Online anomaly detector scoring many independent time-series that share one trained predictor.
+
+    Every stream owns a slot holding its hidden state and a ring buffer with the multi-step predictions made at its
+    last `prediction_window_size` points. The points of all the streams given to `score` are packed into the batch
+    dimension of one teacher-forced step and one rollout of the prediction window, so each call costs O(W) forward
+    passes regardless of the number of streams, and no history is ever recomputed.
+    The scores of a stream are the same as the ones of `anomalyDetector.anomalyScore_multichannel` on its whole series.
+    """
+
+    def __init__(self, model, means, covs, data_mean, data_std, chols=None, device='cpu', capacity=64):
+        """
+        :param model: trained RNNPredictor
+        :param means, covs: per-channel gaussian parameters of the prediction errors (as saved by train.py)
+        :param data_mean, data_std: normalisation statistics of the train dataset (from PickleDataLoad)
+        :param chols: Cholesky factors of covs, computed if not given
+        :param capacity: number of stream slots allocated up front (grown on demand)
+        """
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.means = torch.stack(list(means)).to(self.device) # [ channels * prediction_window_size ]
+        covs = torch.stack(list(covs)).to(self.device)
+        self.chols = cholesky_factor(covs) if chols is None else torch.stack(list(chols)).to(self.device)
+        self.data_mean = data_mean.to(self.device)
+        self.data_std = data_std.to(self.device)
+        self.window = self.means.size(-1)
+        self.feature_dim = self.data_mean.size(0)
+        self.step = torch.arange(self.window, device=self.device)
+        self.step_ahead = self.window - 1 - self.step
+
+        self.slots = dict()
+        self.free_slots = list()
+        self.capacity = 0
+        self.hidden = None
+        # predictions[slot][t % W][k]: prediction of x_{t+k+1} made after x_t of the stream was observed
+        self.predictions = torch.zeros(0, self.window, self.window, self.feature_dim, device=self.device)
+        self.t = torch.zeros(0, dtype=torch.long, device=self.device)
+        self.grow(max(capacity, 1))
+
+    @classmethod
+    def from_checkpoint(cls, data, filename, device='cpu', **kwargs):
+        """Builds a detector from save/<data>/checkpoint/<filename> and the train dataset statistics."""
+        from model import model
+
+        # The checkpoint holds the training args (an argparse.Namespace), which the weights-only loader rejects
+        checkpoint = torch.load(str(Path('save', data, 'checkpoint', filename).with_suffix('.pth')),
+                                map_location=torch.device(device), weights_only=False)
+        args = checkpoint['args']
+        TimeseriesData = preprocess_data.PickleDataLoad(data_type=data, filename=filename, augment_test_data=False,
+                                                        augment_train_data=False)
+        nfeatures = TimeseriesData.trainData.size(-1)
+        predictor = model.RNNPredictor(rnn_type=args.model,
+                                       enc_inp_size=nfeatures,
+                                       rnn_inp_size=args.emsize,
+                                       rnn_hid_size=args.nhid,
+                                       dec_out_size=nfeatures,
+                                       nlayers=args.nlayers,
+                                       res_connection=args.res_connection)
+        predictor.load_state_dict(checkpoint['state_dict'])
+
+        return cls(predictor, checkpoint['means'], checkpoint['covs'], TimeseriesData.mean, TimeseriesData.std,
+                   chols=checkpoint.get('chols'), device=device, **kwargs)
+
+    @classmethod
+    def from_bundle(cls, path, device='cpu', **kwargs):
+        """Builds a detector from an inference bundle (see model.bundle), without reading the dataset."""
+        from model.bundle import load_bundle, build_predictor
+
+        bundle = load_bundle(path, device=device)
+        predictor = build_predictor(bundle['config'])
+        predictor.load_state_dict(bundle['state_dict'])
+        return cls(predictor, bundle['means'], bundle['covs'], bundle['data_mean'], bundle['data_std'],
+                   chols=bundle['chols'], device=device, **kwargs)
+
+    def grow(self, capacity):
+        """Allocates slots up to `capacity`."""
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        hidden = self.model.init_hidden(extra)
+        self.hidden = hidden if self.hidden is None else self.model.concat_hidden([self.hidden, hidden])
+        self.predictions = torch.cat([self.predictions, self.predictions.new_zeros(
+            extra, self.window, self.window, self.feature_dim)], dim=0)
+        self.t = torch.cat([self.t, self.t.new_zeros(extra)])
+        self.free_slots.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    @property
+    def stream_ids(self):
+        return list(self.slots.keys())
+
+    def add_stream(self, stream_id):
+        """Starts a new stream (with an empty history). The other streams are not affected."""
+        if stream_id in self.slots:
+            raise KeyError('Stream {} already exists'.format(stream_id))
+        if not self.free_slots:
+            self.grow(2 * self.capacity)
+        slot = self.free_slots.pop()
+        idx = torch.tensor([slot], device=self.device)
+        self.model.assign_hidden(self.hidden, idx, self.model.init_hidden(1))
+        self.predictions[slot] = 0
+        self.t[slot] = 0
+        self.slots[stream_id] = slot
+
+    def remove_stream(self, stream_id):
+        """Ends a stream and releases its slot. The other streams are not affected."""
+        self.free_slots.append(self.slots.pop(stream_id))
+
+    def score(self, stream_ids, points):
+        """Consumes the next point of each of the given streams. Unknown streams are added first.
+
+        :param stream_ids: ids of the streams, without duplicates
+        :param points: raw (not standardised) points [ len(stream_ids) * feature_size ]
+        :return: anomaly score of every point for every channel [ len(stream_ids) * channels ]
+        """
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError('A stream can only receive one point per call')
+        nstreams = len(stream_ids)
+        x = torch.as_tensor(points, dtype=torch.float, device=self.device).view(nstreams, self.feature_dim)
+        x = preprocess_data.standardization(x, self.data_mean, self.data_std)
+        for stream_id in stream_ids:
+            if stream_id not in self.slots:
+                self.add_stream(stream_id)
+        idx = torch.tensor([self.slots[stream_id] for stream_id in stream_ids], device=self.device)
+        with torch.no_grad():
+            t = self.t[idx]
+            # The predictions of x_t made at t-W, ..., t-1
+            rows = (t.unsqueeze(1) - self.window + self.step.unsqueeze(0)) % self.window
+            rearranged = self.predictions[idx.unsqueeze(1), rows, self.step_ahead.unsqueeze(0)] # [ N * W * channels ]
+            errors = rearranged - x.unsqueeze(1)
+            errors = errors.masked_fill((t < self.window).view(nstreams, 1, 1), 0)
+            scores = gaussian_score(errors.permute(2, 0, 1), self.means, self.chols).t() # [ N * channels ]
+
+            predictions = x.new_zeros(nstreams, self.window, self.feature_dim)
+            out, hidden = self.model.forward(x.unsqueeze(0), self.model.select_hidden(self.hidden, idx))
+            self.model.assign_hidden(self.hidden, idx, hidden)
+            predictions[:, 0] = out[0]
+            outs, _ = self.model.rollout(out, hidden, self.window - 1)
+            predictions[:, 1:] = outs.transpose(0, 1)
+            self.predictions[idx, t % self.window] = predictions
+            self.t[idx] = t + 1
+
+        return scores
+
+
+class StreamingDetector(MultiStreamDetector):
+    """Online anomaly detector scoring a single time-series one point at a time.
+
+    Every incoming point costs one teacher-forced step and one rollout of the prediction window.
+    """
+
+    def __init__(self, model, means, covs, data_mean, data_std, chols=None, device='cpu'):
+        super(StreamingDetector, self).__init__(model, means, covs, data_mean, data_std, chols=chols, device=device,
+                                                capacity=1)
+        self.reset()
+
+    def reset(self):
+        """Forgets the history, as if the stream started over."""
+        if 0 in self.slots:
+            self.remove_stream(0)
+        self.add_stream(0)
+
+    def update(self, x):
+        """Consumes the next point of the stream.
+
+        :param x: raw (not standardised) point [ feature_size ]
+        :return: anomaly score of the point for every channel [ channels ]
+        """
+        return self.score([0], torch.as_tensor(x).view(1, -1))[0]
@@ -6,10 +6,21 @@ import preprocess_data
 from torch import optim
 from matplotlib import pyplot as plt
 from pathlib import Path
-from anomalyDetector import fit_norm_distribution_param
-
-def main():
-    """Run training"""
+from anomalyDetector import fit_gaussian_estimator, cholesky_factor
+from model.checkpoint import CheckpointWriter
+from model import distributed
+from model.model import autocast
+from model.bundle import save_bundle, bundle_path
+from model.trace import TraceWriter, trace_key, trace_path
+from model.metrics import Metrics, EpochProfiler
+
+def main(argv=None):
+    """Run training
+
+    :param argv: command line arguments (default: sys.argv[1:])
+    :return: summary of the run, {'epoch': last epoch, 'best_val_loss': best validation loss,
+             'train_time': seconds spent in training epochs}
+    """
     from model import model
 
     parser = argparse.ArgumentParser(description='PyTorch RNN Prediction Model on Time-series Dataset')
@@ -21,6 +32,11 @@ def main():
                         help='type of recurrent net (RNN_TANH, RNN_RELU, LSTM, GRU, SRU)')
     parser.add_argument('--augment', type=bool, default=True,
                         help='augment')
+    parser.add_argument('--lazy_augment', action='store_true',
+                        help='generate the augmented series on the fly instead of materialising them')
+    parser.add_argument('--cache_size', type=int, default=0,
+                        help='cache the prepared series in dataset/<data>/cache, up to this size (MiB) (default 0: '
+                             'no cache)')
     parser.add_argument('--emsize', type=int, default=32,
                         help='size of rnn input features')
     parser.add_argument('--nhid', type=int, default=32,
@@ -49,6 +65,8 @@ def main():
                         help='dropout applied to layers (0 = no dropout)')
     parser.add_argument('--tied', action='store_true',
                         help='tie the word embedding and softmax weights (deprecated)')
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'],
+                        help='precision of the forward passes (bf16: autocast, the weights and losses stay float32)')
     parser.add_argument('--seed', type=int, default=1111,
                         help='random seed')
     parser.add_argument('--device', type=str, default='cuda',
@@ -57,8 +75,16 @@ def main():
                         help='report interval')
     parser.add_argument('--save_interval', type=int, default=10, metavar='N',
                         help='save interval')
+    parser.add_argument('--eval_interval', type=int, default=1, metavar='N',
+                        help='validation interval (the model is also validated whenever it is saved)')
+    parser.add_argument('--keep_checkpoints', type=int, default=1, metavar='K',
+                        help='number of saved checkpoints kept as <filename>.epoch<N>.pth (the latest one is '
+                             'always <filename>.pth)')
     parser.add_argument('--save_fig', action='store_true',
                         help='save figure')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data-parallel training over the processes launched by torchrun (gloo backend): the '
+                             'batch columns are split between the processes')
     parser.add_argument('--resume','-r',
                         help='use checkpoint model parameters as initial parameters (default: False)',
                         action="store_true")
@@ -67,19 +93,51 @@ def main():
                         action="store_true")
     parser.add_argument('--prediction_window_size', type=int, default=10,
                         help='prediction_window_size')
-    args = parser.parse_args()
+    parser.add_argument('--rollout_batch_size', type=int, default=1024,
+                        help='number of starting points rolled out together when fitting the error distribution')
+    parser.add_argument('--rollout', type=str, default='fused', choices=['loop', 'fused', 'compile'],
+                        help='implementation of the recursive predictions (see RNNPredictor.rollout)')
+    parser.add_argument('--metrics', type=str, default=None, metavar='PATH',
+                        help='write timers, throughputs and peak memory to PATH after every epoch (JSON lines, or a '
+                             'Prometheus textfile if PATH ends with .prom; see model/metrics.py)')
+    parser.add_argument('--profile_epochs', type=int, nargs=2, default=None, metavar=('FIRST', 'LAST'),
+                        help='capture torch.profiler traces of the epochs FIRST to LAST '
+                             '(in result/<data>/<filename>/profile)')
+    parser.add_argument('--profile_steps', type=int, default=5,
+                        help='number of batches recorded in every profiled epoch')
+    args = parser.parse_args(argv)
+    if args.distributed:
+        rank, world_size = distributed.init_distributed()
+    else:
+        rank, world_size = 0, 1
+    # Only the first process writes checkpoints, figures and logs.
+    is_main = rank == 0
     # Set the random seed manually for reproducibility.
+    # The seed is the same for every process, so that they all build the same augmented series and model.
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
+    metrics = Metrics(args.metrics if is_main else None, device=args.device,
+                      labels={'script': 'train', 'data': args.data, 'filename': args.filename})
+    profiler = EpochProfiler(Path('result', args.data, args.filename).with_suffix('').joinpath('profile'),
+                             args.profile_epochs if is_main else None, steps=args.profile_steps, device=args.device)
 
     ###############################################################################
     # Load data
     ###############################################################################
-    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
-                                                    augment_test_data=args.augment)
-    train_dataset = TimeseriesData.batchify(args,TimeseriesData.trainData, args.batch_size)
-    test_dataset = TimeseriesData.batchify(args,TimeseriesData.testData, args.eval_batch_size)
-    gen_dataset = TimeseriesData.batchify(args,TimeseriesData.testData, 1)
+    with metrics.timer('data_loading'):
+        TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                        augment_test_data=args.augment,
+                                                        lazy_augment=args.lazy_augment,
+                                                        cache_size=args.cache_size * 2**20)
+        train_dataset = TimeseriesData.batchify(args,TimeseriesData.trainData, args.batch_size)
+        test_dataset = TimeseriesData.batchify(args,TimeseriesData.testData, args.eval_batch_size)
+    if args.distributed:
+        if args.batch_size < world_size or args.eval_batch_size < world_size:
+            raise ValueError('--batch_size and --eval_batch_size must be at least the number of processes')
+        train_dataset = distributed.shard_columns(train_dataset, rank, world_size)
+        test_dataset = distributed.shard_columns(test_dataset, rank, world_size)
+        train_weight = train_dataset.size(1) / args.batch_size
+        test_weight = test_dataset.size(1) / args.eval_batch_size
 
 
     ###############################################################################
@@ -97,6 +155,10 @@ def main():
                             res_connection=args.res_connection).to(args.device)
     optimizer = optim.Adam(model.parameters(), lr= args.lr,weight_decay=args.weight_decay)
     criterion = nn.MSELoss()
+    if args.distributed:
+        distributed.broadcast_parameters(model)
+        # Different dropout masks on every process
+        torch.manual_seed(args.seed + rank)
     ###############################################################################
     # Training code
     ###############################################################################
@@ -106,96 +168,83 @@ def main():
         target = source[i+1:i+1+seq_len] # [ (seq_len x batch_size x feature_size) ]
         return data, target
 
-    def generate_output(args,epoch, model, gen_dataset, disp_uncertainty=True,startPoint=500, endPoint=3500):
-        if args.save_fig:
-            # Turn on evaluation mode which disables dropout.
-            model.eval()
-            hidden = model.init_hidden(1)
-            outSeq = []
-            upperlim95 = []
-            lowerlim95 = []
-            with torch.no_grad():
-                for i in range(endPoint):
-                    if i>=startPoint:
-                        # if disp_uncertainty and epoch > 40:
-                        #     outs = []
-                        #     model.train()
-                        #     for i in range(20):
-                        #         out_, hidden_ = model.forward(out+0.01*Variable(torch.randn(out.size())).cuda(),hidden,noise=True)
-                        #         outs.append(out_)
-                        #     model.eval()
-                        #     outs = torch.cat(outs,dim=0)
-                        #     out_mean = torch.mean(outs,dim=0) # [bsz * feature_dim]
-                        #     out_std = torch.std(outs,dim=0) # [bsz * feature_dim]
-                        #     upperlim95.append(out_mean + 2.58*out_std/np.sqrt(20))
-                        #     lowerlim95.append(out_mean - 2.58*out_std/np.sqrt(20))
-
-                        out, hidden = model.forward(out, hidden)
-
-                        #print(out_mean,out)
-
-                    else:
-                        out, hidden = model.forward(gen_dataset[i].unsqueeze(0), hidden)
-                    outSeq.append(out.data.cpu()[0][0].unsqueeze(0))
-
-
-            outSeq = torch.cat(outSeq,dim=0) # [seqLength * feature_dim]
-
-            target= preprocess_data.reconstruct(gen_dataset.cpu(), TimeseriesData.mean, TimeseriesData.std)
-            outSeq = preprocess_data.reconstruct(outSeq, TimeseriesData.mean, TimeseriesData.std)
-            # if epoch>40:
-            #     upperlim95 = torch.cat(upperlim95, dim=0)
-            #     lowerlim95 = torch.cat(lowerlim95, dim=0)
-            #     upperlim95 = preprocess_data.reconstruct(upperlim95.data.cpu().numpy(),TimeseriesData.mean,TimeseriesData.std)
-            #     lowerlim95 = preprocess_data.reconstruct(lowerlim95.data.cpu().numpy(),TimeseriesData.mean,TimeseriesData.std)
-
-            plt.figure(figsize=(15,5))
-            for i in range(target.size(-1)):
-                plt.plot(target[:,:,i].numpy(), label='Target'+str(i),
-                        color='black', marker='.', linestyle='--', markersize=1, linewidth=0.5)
-                plt.plot(range(startPoint), outSeq[:startPoint,i].numpy(), label='1-step predictions for target'+str(i),
-                        color='green', marker='.', linestyle='--', markersize=1.5, linewidth=1)
-                # if epoch>40:
-                #     plt.plot(range(startPoint, endPoint), upperlim95[:,i].numpy(), label='upperlim'+str(i),
-                #              color='skyblue', marker='.', linestyle='--', markersize=1.5, linewidth=1)
-                #     plt.plot(range(startPoint, endPoint), lowerlim95[:,i].numpy(), label='lowerlim'+str(i),
-                #              color='skyblue', marker='.', linestyle='--', markersize=1.5, linewidth=1)
-                plt.plot(range(startPoint, endPoint), outSeq[startPoint:,i].numpy(), label='Recursive predictions for target'+str(i),
-                        color='blue', marker='.', linestyle='--', markersize=1.5, linewidth=1)
-
-            plt.xlim([startPoint-500, endPoint])
-            plt.xlabel('Index',fontsize=15)
-            plt.ylabel('Value',fontsize=15)
-            plt.title('Time-series Prediction on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
-            plt.legend()
-            plt.tight_layout()
-            plt.text(startPoint-500+10, target.min(), 'Epoch: '+str(epoch),fontsize=15)
-            save_dir = Path('result',args.data,args.filename).with_suffix('').joinpath('fig_prediction')
-            save_dir.mkdir(parents=True,exist_ok=True)
-            plt.savefig(save_dir.joinpath('fig_epoch'+str(epoch)).with_suffix('.png'))
-            #plt.show()
-            plt.close()
-            return outSeq
-
-        else:
-            pass
-
-    def evaluate_1step_pred(args, model, test_dataset):
-        # Turn on evaluation mode which disables dropout.
-        model.eval()
-        total_loss = 0
-        with torch.no_grad():
-            hidden = model.init_hidden(args.eval_batch_size)
-            for nbatch, i in enumerate(range(0, test_dataset.size(0) - 1, args.bptt)):
-
-                inputSeq, targetSeq = get_batch(args,test_dataset, i)
-                outSeq, hidden = model.forward(inputSeq, hidden)
-
-                loss = criterion(outSeq.view(args.batch_size,-1), targetSeq.view(args.batch_size,-1))
-                hidden = model.repackage_hidden(hidden)
-                total_loss+= loss.item()
-
-        return total_loss / nbatch
+    def plot_columns(args, test_dataset, endPoint=3500):
+        """Number of leading columns of test_dataset whose predictions are kept by evaluate for the figure: enough to
+        cover endPoint timesteps of the test series (batchify splits it in contiguous columns). The ranks of distributed
+        training hold interleaved columns, so only the first one is plotted there."""
+        if not args.save_fig or not is_main:
+            return 0
+        if args.distributed:
+            return 1
+        return min(test_dataset.size(1), -(-endPoint // max(1, test_dataset.size(0) - 1)))
+
+    def generate_output(args,epoch, outputs, endPoint=3500):
+        """Plots the 1-step and free running predictions of the validation pass (see evaluate) on the test series.
+        The predictions are drawn at their index in the test series; the first point of every batch column has none.
+        The free running predictions restart from the target every bptt steps, as in the free running loss."""
+        target = preprocess_data.reconstruct(TimeseriesData.testData[:endPoint].cpu(), TimeseriesData.mean,
+                                             TimeseriesData.std)
+        shown = outputs['index'] < len(target)
+        index = outputs['index'][shown].numpy()
+        oneStep = preprocess_data.reconstruct(outputs['one_step'][shown], TimeseriesData.mean, TimeseriesData.std)
+        freeRunning = preprocess_data.reconstruct(outputs['free_running'][shown], TimeseriesData.mean,
+                                                  TimeseriesData.std)
+
+        plt.figure(figsize=(15,5))
+        for i in range(target.size(-1)):
+            plt.plot(target[:,i].numpy(), label='Target'+str(i),
+                    color='black', marker='.', linestyle='--', markersize=1, linewidth=0.5)
+            plt.plot(index, oneStep[:,i].numpy(), label='1-step predictions for target'+str(i),
+                    color='green', marker='.', linestyle='--', markersize=1.5, linewidth=1)
+            plt.plot(index, freeRunning[:,i].numpy(),
+                     label='Free running predictions ({} steps) for target'.format(args.bptt)+str(i),
+                     color='blue', marker='.', linestyle='--', markersize=1.5, linewidth=1)
+
+        plt.xlim([0, len(target)])
+        plt.xlabel('Index',fontsize=15)
+        plt.ylabel('Value',fontsize=15)
+        plt.title('Time-series Prediction on ' + args.data + ' Dataset', fontsize=18, fontweight='bold')
+        plt.legend()
+        plt.tight_layout()
+        plt.text(10, target.min(), 'Epoch: '+str(epoch),fontsize=15)
+        save_dir = Path('result',args.data,args.filename).with_suffix('').joinpath('fig_prediction')
+        save_dir.mkdir(parents=True,exist_ok=True)
+        plt.savefig(save_dir.joinpath('fig_epoch'+str(epoch)).with_suffix('.png'))
+        #plt.show()
+        plt.close()
+
+    def compute_losses(args, model, inputSeq, targetSeq, hidden, return_outputs=False, span='train_step'):
+        """Losses of one batch, and the hidden state after it.
+        :param span: metrics stage the batch belongs to ('train_step' or 'validation'); the free running rollout and
+                     the teacher forced forward pass are timed as its sub-stages <span>/rollout and <span>/forward
+        :return: loss1 (free running), loss2 (teacher forcing, i.e. 1-step prediction), loss3 (professor forcing),
+                 hidden, and with return_outputs the free running and 1-step predictions
+                 [ seq_len * batch_size * feature_size ]
+        """
+        # inputSeq: [ seq_len * batch_size * feature_size ]
+        # targetSeq: [ seq_len * batch_size * feature_size ]
+        bsz = inputSeq.size(1)
+        hidden_ = model.repackage_hidden(hidden)
+
+        points = inputSeq.size(0) * bsz
+
+        '''Loss1: Free running loss'''
+        with metrics.timer(span + '/rollout', points=points):
+            outSeq1, hidden_, hids1 = model.rollout(inputSeq[0].unsqueeze(0), hidden_, inputSeq.size(0),
+                                                    return_hiddens=True, mode=args.rollout)
+            loss1 = criterion(outSeq1.contiguous().view(bsz,-1), targetSeq.contiguous().view(bsz,-1))
+
+        with metrics.timer(span + '/forward', points=points):
+            '''Loss2: Teacher forcing loss'''
+            outSeq2, hidden, hids2 = model.forward(inputSeq, hidden, return_hiddens=True)
+            loss2 = criterion(outSeq2.contiguous().view(bsz, -1), targetSeq.contiguous().view(bsz, -1))
+
+            '''Loss3: Simplified Professor forcing loss'''
+            loss3 = criterion(hids1.view(bsz,-1), hids2.view(bsz,-1).detach())
+
+        if return_outputs:
+            return loss1, loss2, loss3, hidden, outSeq1, outSeq2
+        return loss1, loss2, loss3, hidden
 
     def train(args, model, train_dataset,epoch):
 
@@ -204,48 +253,39 @@ def main():
             model.train()
             total_loss = 0
             start_time = time.time()
-            hidden = model.init_hidden(args.batch_size)
+            hidden = model.init_hidden(train_dataset.size(1))
             for batch, i in enumerate(range(0, train_dataset.size(0) - 1, args.bptt)):
                 inputSeq, targetSeq = get_batch(args,train_dataset, i)
                 # inputSeq: [ seq_len * batch_size * feature_size ]
                 # targetSeq: [ seq_len * batch_size * feature_size ]
-
-                # Starting each batch, we detach the hidden state from how it was previously produced.
-                # If we didn't, the model would try backpropagating all the way to start of the dataset.
-                hidden = model.repackage_hidden(hidden)
-                hidden_ = model.repackage_hidden(hidden)
-                optimizer.zero_grad()
-
-                '''Loss1: Free running loss'''
-                outVal = inputSeq[0].unsqueeze(0)
-                outVals=[]
-                hids1 = []
-                for i in range(inputSeq.size(0)):
-                    outVal, hidden_, hid = model.forward(outVal, hidden_,return_hiddens=True)
-                    outVals.append(outVal)
-                    hids1.append(hid)
-                outSeq1 = torch.cat(outVals,dim=0)
-                hids1 = torch.cat(hids1,dim=0)
-                loss1 = criterion(outSeq1.contiguous().view(args.batch_size,-1), targetSeq.contiguous().view(args.batch_size,-1))
-
-                '''Loss2: Teacher forcing loss'''
-                outSeq2, hidden, hids2 = model.forward(inputSeq, hidden, return_hiddens=True)
-                loss2 = criterion(outSeq2.contiguous().view(args.batch_size, -1), targetSeq.contiguous().view(args.batch_size, -1))
-
-                '''Loss3: Simplified Professor forcing loss'''
-                loss3 = criterion(hids1.view(args.batch_size,-1), hids2.view(args.batch_size,-1).detach())
-
-                '''Total loss = Loss1+Loss2+Loss3'''
-                loss = loss1+loss2+loss3
-                loss.backward()
-
-                # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
-                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
-                optimizer.step()
-
-                total_loss += loss.item()
-
-                if batch % args.log_interval == 0 and batch > 0:
+                points = inputSeq.size(0) * inputSeq.size(1)
+
+                with metrics.timer('train_step', points=points):
+                    # Starting each batch, we detach the hidden state from how it was previously produced.
+                    # If we didn't, the model would try backpropagating all the way to start of the dataset.
+                    hidden = model.repackage_hidden(hidden)
+                    optimizer.zero_grad()
+
+                    with autocast(args.device, args.precision):
+                        loss1, loss2, loss3, hidden = compute_losses(args, model, inputSeq, targetSeq, hidden)
+
+                    '''Total loss = Loss1+Loss2+Loss3'''
+                    loss = loss1+loss2+loss3
+                    with metrics.timer('train_step/backward', points=points):
+                        loss.backward()
+                        if args.distributed:
+                            distributed.allreduce_gradients(model, train_weight)
+
+                    with metrics.timer('train_step/optimizer_step'):
+                        # `clip_grad_norm` helps prevent the exploding gradient problem in RNNs / LSTMs.
+                        torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip)
+                        optimizer.step()
+
+                    total_loss += loss.item()
+                metrics.count('train_points', points)
+                profiler.step()
+
+                if batch % args.log_interval == 0 and batch > 0 and is_main:
                     cur_loss = total_loss / args.log_interval
                     elapsed = time.time() - start_time
                     print('| epoch {:3d} | {:5d}/{:5d} batches | ms/batch {:5.4f} | '
@@ -255,50 +295,58 @@ def main():
                     total_loss = 0
                     start_time = time.time()
 
-    def evaluate(args, model, test_dataset):
+    def evaluate(args, model, test_dataset, keep_columns=0):
+        """Validation losses, averaged over the batches of test_dataset.
+        :param keep_columns: number of leading columns of test_dataset whose predictions are also returned, for the
+                             figure of generate_output
+        :return: {'loss': loss1+loss2+loss3, 'loss1': free running, 'loss2': teacher forcing (1-step prediction),
+                  'loss3': professor forcing}, and with keep_columns 'outputs': {'one_step', 'free_running'},
+                  the predictions of the columns one after the other [ (keep_columns * (seq_len - 1)) * feature_size ],
+                  and 'index', the index of every point in the test series [ keep_columns * (seq_len - 1) ]
+        """
         # Turn on evaluation mode which disables dropout.
         model.eval()
+        outputs = {'one_step': [], 'free_running': []}
         with torch.no_grad():
-            total_loss = 0
-            hidden = model.init_hidden(args.eval_batch_size)
-            nbatch = 1
+            total_losses = torch.zeros(3)
+            hidden = model.init_hidden(test_dataset.size(1))
+            nbatch = 0
             for nbatch, i in enumerate(range(0, test_dataset.size(0) - 1, args.bptt)):
                 inputSeq, targetSeq = get_batch(args,test_dataset, i)
-                # inputSeq: [ seq_len * batch_size * feature_size ]
-                # targetSeq: [ seq_len * batch_size * feature_size ]
-                hidden_ = model.repackage_hidden(hidden)
-                '''Loss1: Free running loss'''
-                outVal = inputSeq[0].unsqueeze(0)
-                outVals=[]
-                hids1 = []
-                for i in range(inputSeq.size(0)):
-                    outVal, hidden_, hid = model.forward(outVal, hidden_,return_hiddens=True)
-                    outVals.append(outVal)
-                    hids1.append(hid)
-                outSeq1 = torch.cat(outVals,dim=0)
-                hids1 = torch.cat(hids1,dim=0)
-                loss1 = criterion(outSeq1.contiguous().view(args.batch_size,-1), targetSeq.contiguous().view(args.batch_size,-1))
-
-                '''Loss2: Teacher forcing loss'''
-                outSeq2, hidden, hids2 = model.forward(inputSeq, hidden, return_hiddens=True)
-                loss2 = criterion(outSeq2.contiguous().view(args.batch_size, -1), targetSeq.contiguous().view(args.batch_size, -1))
-
-                '''Loss3: Simplified Professor forcing loss'''
-                loss3 = criterion(hids1.view(args.batch_size,-1), hids2.view(args.batch_size,-1).detach())
-
-                '''Total loss = Loss1+Loss2+Loss3'''
-                loss = loss1+loss2+loss3
-
-                total_loss += loss.item()
-
-        return total_loss / (nbatch+1)
+                with autocast(args.device, args.precision):
+                    loss1, loss2, loss3, hidden, outSeq1, outSeq2 = compute_losses(args, model, inputSeq, targetSeq,
+                                                                                   hidden, return_outputs=True,
+                                                                                   span='validation')
+                total_losses += torch.stack([loss1, loss2, loss3]).cpu()
+                if keep_columns:
+                    outputs['one_step'].append(outSeq2[:, :keep_columns].float().cpu())
+                    outputs['free_running'].append(outSeq1[:, :keep_columns].float().cpu())
+
+        total_losses /= nbatch+1
+        if args.distributed:
+            total_losses = distributed.allreduce_mean(total_losses, test_weight)
+        loss1, loss2, loss3 = total_losses.tolist()
+        losses = {'loss': loss1+loss2+loss3, 'loss1': loss1, 'loss2': loss2, 'loss3': loss3}
+        if keep_columns:
+            # [ (seq_len - 1) * keep_columns * feature_size ] -> [ (keep_columns * (seq_len - 1)) * feature_size ]
+            losses['outputs'] = {key: torch.cat(value, dim=0).transpose(0, 1).reshape(-1, value[0].size(-1))
+                                 for key, value in outputs.items()}
+            # Column c holds the timesteps [c * seq_len, (c + 1) * seq_len) of the series, its first one not predicted
+            seq_len = test_dataset.size(0)
+            losses['outputs']['index'] = (torch.arange(keep_columns).unsqueeze(1) * seq_len + 1 +
+                                          torch.arange(seq_len - 1).unsqueeze(0)).view(-1)
+        return losses
 
 
     # Loop over epochs.
     if args.resume or args.pretrained:
         print("=> loading checkpoint ")
-        checkpoint = torch.load(Path('save', args.data, 'checkpoint', args.filename).with_suffix('.pth'))
+        # The checkpoint holds the training args (an argparse.Namespace), which the weights-only loader rejects
+        checkpoint = torch.load(Path('save', args.data, 'checkpoint', args.filename).with_suffix('.pth'),
+                                map_location=torch.device(args.device), weights_only=False)
         args, start_epoch, best_val_loss = model.load_checkpoint(args,checkpoint,feature_dim)
+        # load_checkpoint rebuilds the model's parameters: the optimizer is rebuilt on them before its state is loaded
+        optimizer = optim.Adam(model.parameters(), lr= args.lr,weight_decay=args.weight_decay)
         optimizer.load_state_dict((checkpoint['optimizer']))
         del checkpoint
         epoch = start_epoch
@@ -312,54 +360,99 @@ def main():
     print(args)
     print('-' * 89)
 
-    if not args.pretrained:
-        # At any point you can hit Ctrl + C to break out of training early.
-        try:
-            for epoch in range(start_epoch, args.epochs+1):
-
-                epoch_start_time = time.time()
-                train(args,model,train_dataset,epoch)
-                val_loss = evaluate(args,model,test_dataset)
-                print('-' * 89)
-                print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.4f} | '.format(epoch, (time.time() - epoch_start_time),                                                                                        val_loss))
+    # Checkpoints are written in the background while training goes on; the writer is closed (its thread stopped)
+    # when main returns, as main can be called many times in one process.
+    with CheckpointWriter(keep=args.keep_checkpoints) as checkpoint_writer:
+        train_time = 0
+        if not args.pretrained:
+            # At any point you can hit Ctrl + C to break out of training early.
+            try:
+                for epoch in range(start_epoch, args.epochs+1):
+
+                    epoch_start_time = time.time()
+                    with metrics.timer('train_epoch'), profiler.epoch(epoch):
+                        train(args,model,train_dataset,epoch)
+                    train_time += time.time() - epoch_start_time
+                    metrics.count('epochs')
+                    # The validation loss is needed to pick the best model, so it is always computed before saving.
+                    if epoch%args.eval_interval==0 or epoch%args.save_interval==0 or epoch==args.epochs:
+                        with metrics.timer('validation'):
+                            val_losses = evaluate(args,model,test_dataset,
+                                                  keep_columns=plot_columns(args, test_dataset))
+                        val_loss = val_losses['loss']
+                        if is_main:
+                            print('-' * 89)
+                            print('| end of epoch {:3d} | time: {:5.2f}s | valid loss {:5.4f} | free running {:5.4f} | '
+                                  '1-step {:5.4f} | professor forcing {:5.4f} |'.format(
+                                epoch, (time.time() - epoch_start_time), val_loss,
+                                val_losses['loss1'], val_losses['loss2'], val_losses['loss3']))
+                            print('-' * 89)
+
+                            if args.save_fig:
+                                with metrics.timer('plotting'):
+                                    generate_output(args,epoch,val_losses['outputs'])
+                    elif is_main:
+                        print('-' * 89)
+                        print('| end of epoch {:3d} | time: {:5.2f}s |'.format(epoch, (time.time() - epoch_start_time)))
+                        print('-' * 89)
+
+                    if epoch%args.save_interval==0 and is_main:
+                        # Save the model if the validation loss is the best we've seen so far.
+                        is_best = val_loss < best_val_loss
+                        best_val_loss = min(val_loss, best_val_loss)
+                        model_dictionary = {'epoch': epoch,
+                                            'best_loss': best_val_loss,
+                                            'state_dict': model.state_dict(),
+                                            'optimizer': optimizer.state_dict(),
+                                            'args':args
+                                            }
+                        with metrics.timer('checkpoint_save'):
+                            model.save_checkpoint(model_dictionary, is_best, writer=checkpoint_writer)
+                    metrics.emit('epoch', epoch=epoch)
+
+            except KeyboardInterrupt:
                 print('-' * 89)
-
-                generate_output(args,epoch,model,gen_dataset,startPoint=1500)
-
-                if epoch%args.save_interval==0:
-                    # Save the model if the validation loss is the best we've seen so far.
-                    is_best = val_loss < best_val_loss
-                    best_val_loss = min(val_loss, best_val_loss)
-                    model_dictionary = {'epoch': epoch,
-                                        'best_loss': best_val_loss,
-                                        'state_dict': model.state_dict(),
-                                        'optimizer': optimizer.state_dict(),
-                                        'args':args
-                                        }
-                    model.save_checkpoint(model_dictionary, is_best)
-
-        except KeyboardInterrupt:
-            print('-' * 89)
-            print('Exiting from training early')
-
-
-    # Calculate mean and covariance for each channel's prediction errors, and save them with the trained model
-    print('=> calculating mean and covariance')
-    means, covs = list(),list()
-    train_dataset = TimeseriesData.batchify(args, TimeseriesData.trainData, bsz=1)
-    for channel_idx in range(model.enc_input_size):
-        mean, cov = fit_norm_distribution_param(args,model,train_dataset[:TimeseriesData.length],channel_idx)
-        means.append(mean), covs.append(cov)
-    model_dictionary = {'epoch': max(epoch,start_epoch),
-                        'best_loss': best_val_loss,
-                        'state_dict': model.state_dict(),
-                        'optimizer': optimizer.state_dict(),
-                        'args': args,
-                        'means': means,
-                        'covs': covs
-                        }
-    model.save_checkpoint(model_dictionary, True)
-    print('-' * 89)
+                print('Exiting from training early')
+                checkpoint_writer.flush()
+
+        if args.distributed:
+            torch.distributed.destroy_process_group()
+            # The processes hold the same model, the first one fits the error distribution and saves it.
+            if not is_main:
+                return {'epoch': max(epoch,start_epoch), 'best_val_loss': best_val_loss, 'train_time': train_time}
+
+        # Calculate mean and covariance for each channel's prediction errors, and save them with the trained model
+        print('=> calculating mean and covariance')
+        train_dataset = TimeseriesData.batchify(args, TimeseriesData.trainData, bsz=1)[:TimeseriesData.length]
+        # The hidden states and errors of the train series are kept for predict.py (see model/trace.py)
+        trace = TraceWriter(trace_path(args.data, args.filename,
+                                       trace_key(model.state_dict(), args.prediction_window_size, train_dataset)),
+                            len(train_dataset), model.rnn_hid_size, feature_dim, args.prediction_window_size)
+        with metrics.timer('gaussian_fit', points=len(train_dataset)):
+            gaussian = fit_gaussian_estimator(args,model,train_dataset,trace=trace)
+            trace.close()
+        means, covs = gaussian.means, gaussian.covs
+        chols = cholesky_factor(covs)
+        model_dictionary = {'epoch': max(epoch,start_epoch),
+                            'best_loss': best_val_loss,
+                            'state_dict': model.state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'args': args,
+                            'means': means,
+                            'covs': covs,
+                            'chols': chols,
+                            'gaussian': gaussian.state_dict()
+                            }
+        with metrics.timer('checkpoint_save'):
+            model.save_checkpoint(model_dictionary, True, writer=checkpoint_writer)
+            save_bundle(bundle_path(args.data, args.filename), args, model.state_dict(), means, covs,
+                        TimeseriesData.mean, TimeseriesData.std, chols=chols, epoch=max(epoch,start_epoch))
+            checkpoint_writer.flush()
+        metrics.emit('end', epoch=max(epoch,start_epoch), train_time=train_time)
+        print('=> checkpoint saved.')
+        print('-' * 89)
+
+        return {'epoch': max(epoch,start_epoch), 'best_val_loss': best_val_loss, 'train_time': train_time}
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,95 @@
+"""Updates the gaussian error model of a trained detector with new normal data, without re-scanning the train set
+
+    python update_gaussian.py --data ecg --filename chfdb_chf13_45590.pkl --new_data new_normal_data.pkl
+
+The new series are in the format of dataset/<data>/labeled (a pickle or a columnar file, the label column is
+ignored) and are assumed to contain no anomalies. Their prediction errors are added to the running estimate saved
+in save/<data>/checkpoint/<filename>.pth, whose means, covs and chols are then replaced (and the inference bundle
+save/<data>/bundle/<filename>.safetensors rewritten).
+Checkpoints saved before the running estimate existed are refitted on their train set first.
+"""
+
+import argparse
+import pickle
+import torch
+import preprocess_data
+from pathlib import Path
+from anomalyDetector import GaussianEstimator, fit_gaussian_estimator, cholesky_factor
+from model.checkpoint import write_checkpoint
+from model.bundle import save_bundle, bundle_path
+
+
+def load_series(path):
+    """Reads a labeled series [ seq_len * (feature_size + 1) ] and drops its label column."""
+    path = Path(path)
+    if path.suffix == preprocess_data.COLUMNAR_SUFFIX:
+        series, header = preprocess_data.load_columnar(path)
+        return series[:, :header['label_column']]
+    with open(str(path), 'rb') as f:
+        return torch.FloatTensor(pickle.load(f))[:, :-1]
+
+
+def main():
+    from model import model
+
+    parser = argparse.ArgumentParser(description='Update the gaussian error model with new normal data')
+    parser.add_argument('--data', type=str, default='ecg',
+                        help='type of the dataset (ecg, gesture, power_demand, space_shuttle, respiration, nyc_taxi')
+    parser.add_argument('--filename', type=str, default='chfdb_chf13_45590.pkl',
+                        help='filename of the dataset')
+    parser.add_argument('--new_data', type=str, nargs='+', required=True,
+                        help='paths of the new normal series')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='cuda or cpu')
+    parser.add_argument('--rollout_batch_size', type=int, default=1024,
+                        help='number of starting points rolled out together')
+    args_ = parser.parse_args()
+
+    print("=> loading checkpoint ")
+    checkpoint_path = Path('save', args_.data, 'checkpoint', args_.filename).with_suffix('.pth')
+    # The checkpoint holds the training args (an argparse.Namespace), which the weights-only loader rejects
+    checkpoint = torch.load(str(checkpoint_path), map_location=torch.device(args_.device), weights_only=False)
+    args = checkpoint['args']
+    args.device = args_.device
+    args.rollout_batch_size = args_.rollout_batch_size
+    print("=> loaded checkpoint")
+
+    TimeseriesData = preprocess_data.PickleDataLoad(data_type=args.data, filename=args.filename,
+                                                    augment_test_data=False, augment_train_data=False)
+    nfeatures = TimeseriesData.trainData.size(-1)
+    predictor = model.RNNPredictor(rnn_type=args.model,
+                                   enc_inp_size=nfeatures,
+                                   rnn_inp_size=args.emsize,
+                                   rnn_hid_size=args.nhid,
+                                   dec_out_size=nfeatures,
+                                   nlayers=args.nlayers,
+                                   res_connection=args.res_connection).to(args.device)
+    predictor.load_state_dict(checkpoint['state_dict'])
+
+    if 'gaussian' in checkpoint:
+        gaussian = GaussianEstimator.from_state_dict(checkpoint['gaussian'], device=args.device)
+    else:
+        print('=> no running estimate in the checkpoint, fitting it on the train dataset')
+        train_dataset = TimeseriesData.batchify(args, TimeseriesData.trainData, bsz=1)
+        gaussian = fit_gaussian_estimator(args, predictor, train_dataset)
+    print('=> {} prediction errors so far'.format(gaussian.count))
+
+    for path in args_.new_data:
+        series = preprocess_data.standardization(load_series(path), TimeseriesData.mean, TimeseriesData.std)
+        dataset = TimeseriesData.batchify(args, series, bsz=1)
+        count = gaussian.count
+        fit_gaussian_estimator(args, predictor, dataset, estimator=gaussian)
+        print('=> added {} prediction errors from {}'.format(gaussian.count - count, path))
+
+    checkpoint['means'], checkpoint['covs'] = gaussian.means, gaussian.covs
+    checkpoint['chols'] = cholesky_factor(checkpoint['covs'])
+    checkpoint['gaussian'] = gaussian.state_dict()
+    write_checkpoint(checkpoint, checkpoint_path)
+    save_bundle(bundle_path(args.data, args.filename), args, checkpoint['state_dict'], checkpoint['means'],
+                checkpoint['covs'], TimeseriesData.mean, TimeseriesData.std, chols=checkpoint['chols'],
+                epoch=checkpoint['epoch'])
+    print('=> checkpoint saved.')
+
+
+if __name__ == '__main__':
+    main()